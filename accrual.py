@@ -0,0 +1,237 @@
+from datetime import date, datetime, timedelta
+from functools import partial
+
+from sqlalchemy import case, exists, func, insert, literal, select, update
+
+from app import app, db
+import app_cache
+from ledger import BALANCE_COLUMNS
+from models import LeaveBalance, LeaveBalanceSnapshot, LeaveLedgerEntry, User
+
+# Per leave type; ACCRUAL_POLICIES in the config overrides any of these keys.
+#   accrual: 'monthly', 'annual' or None
+#   days: accrued per year; monthly accrual spreads them over the months
+#   prorate: an account opened mid-year starts with the shares of the months from its opening month
+#   carry_over: most days kept into a new year (None keeps everything)
+#   carry_over_expires_months: carried days not used this many months into the year expire
+DEFAULT_POLICIES = {
+    'sick': {'accrual': 'annual', 'days': 10, 'prorate': True, 'carry_over': 0},
+    'vacation': {'accrual': 'monthly', 'days': 15, 'prorate': True, 'carry_over': 5,
+                 'carry_over_expires_months': 3},
+    'personal': {'accrual': 'annual', 'days': 5, 'prorate': True, 'carry_over': 0},
+}
+
+ACCRUALS = ('monthly', 'annual')
+
+# Debits and their reversals; what uses up carried-over days
+_USAGE = ('debit', 'reversal')
+
+
+def policies():
+    """{leave type: policy} with the configured overrides applied; raises ValueError if one is invalid."""
+    configured = app.config.get('ACCRUAL_POLICIES', {})
+    unknown = set(configured) - set(BALANCE_COLUMNS)
+    if unknown:
+        raise ValueError(f'Unknown leave types in ACCRUAL_POLICIES: {", ".join(sorted(unknown))}')
+    merged = {}
+    for leave_type in BALANCE_COLUMNS:
+        policy = {'accrual': None, 'days': 0, 'prorate': True, 'carry_over': None, 'carry_over_expires_months': None,
+                  **DEFAULT_POLICIES.get(leave_type, {}), **configured.get(leave_type, {})}
+        if policy['accrual'] not in ACCRUALS + (None,):
+            raise ValueError(f'{leave_type}: accrual must be one of {", ".join(ACCRUALS)} or None')
+        if policy['days'] < 0 or (policy['carry_over'] is not None and policy['carry_over'] < 0):
+            raise ValueError(f'{leave_type}: days and carry_over cannot be negative')
+        if policy['carry_over_expires_months'] is not None and not 1 <= policy['carry_over_expires_months'] <= 11:
+            raise ValueError(f'{leave_type}: carry_over_expires_months must be between 1 and 11')
+        merged[leave_type] = policy
+    return merged
+
+
+def month_start(year, month):
+    """First day of ``month`` of ``year``; months past 12 run into the following years."""
+    return date(year + (month - 1) // 12, (month - 1) % 12 + 1, 1)
+
+
+def monthly_share(days, month):
+    """Whole days accrued in ``month`` (1-12) out of ``days`` a year; the shares add up to ``days``."""
+    return days * month // 12 - days * (month - 1) // 12
+
+
+def opening_balances(joined):
+    """{leave type: days} a new account opened on ``joined`` starts with.
+
+    Accrual starts the year after the opening entry, so it holds the
+    allowance for the rest of this year.
+    """
+    balances = {}
+    for leave_type, policy in policies().items():
+        if policy['accrual'] is None:
+            balances[leave_type] = BALANCE_COLUMNS[leave_type].default.arg
+        elif policy['prorate']:
+            balances[leave_type] = policy['days'] - policy['days'] * (joined.month - 1) // 12
+        else:
+            balances[leave_type] = policy['days']
+    return balances
+
+
+def _done(user_id, leave_type, kind, period):
+    return exists().where(LeaveLedgerEntry.user_id == user_id, LeaveLedgerEntry.leave_type == leave_type,
+                          LeaveLedgerEntry.kind == kind, LeaveLedgerEntry.period == period)
+
+
+def _opened_since(user_id, leave_type, day):
+    # The opening balance is a full year's allowance, so accrual starts the year after it
+    return exists().where(LeaveLedgerEntry.user_id == user_id, LeaveLedgerEntry.leave_type == leave_type,
+                          LeaveLedgerEntry.kind == 'opening', LeaveLedgerEntry.effective_date >= day)
+
+
+def _held_before(leave_type, day, low, high):
+    """(user_id, balance) of the accounts in ``low``..``high`` at the start of ``day``."""
+    return select(LeaveLedgerEntry.user_id, func.sum(LeaveLedgerEntry.amount).label('balance')).where(
+        LeaveLedgerEntry.user_id.between(low, high), LeaveLedgerEntry.leave_type == leave_type,
+        LeaveLedgerEntry.effective_date < day,
+    ).group_by(LeaveLedgerEntry.user_id).subquery()
+
+
+def _accrued(leave_type, policy, period, label, low, high):
+    if policy['accrual'] == 'monthly':
+        amount = literal(monthly_share(policy['days'], period.month))
+    else:
+        amount = literal(policy['days'])
+    return select(LeaveBalance.user_id, amount.label('amount')).join(User, User.id == LeaveBalance.user_id).where(
+        LeaveBalance.user_id.between(low, high),
+        # Everyone employed by the end of the period being run
+        User.created_at < month_start(period.year, period.month + 1),
+        ~_done(LeaveBalance.user_id, leave_type, 'accrual', label),
+        ~_opened_since(LeaveBalance.user_id, leave_type, date(period.year, 1, 1)),
+    )
+
+
+def _forfeited(leave_type, policy, period, label, low, high):
+    held = _held_before(leave_type, date(period.year, 1, 1), low, high)
+    return select(held.c.user_id, (policy['carry_over'] - held.c.balance).label('amount')).where(
+        held.c.balance > policy['carry_over'], ~_done(held.c.user_id, leave_type, 'forfeit', label))
+
+
+def _expired(leave_type, policy, period, label, low, high):
+    year_start = date(period.year, 1, 1)
+    held = _held_before(leave_type, year_start, low, high)
+    used = select(LeaveLedgerEntry.user_id, (-func.sum(LeaveLedgerEntry.amount)).label('days')).where(
+        LeaveLedgerEntry.user_id.between(low, high), LeaveLedgerEntry.leave_type == leave_type,
+        LeaveLedgerEntry.kind.in_(_USAGE), LeaveLedgerEntry.effective_date >= year_start,
+        LeaveLedgerEntry.effective_date < _expiry_date(policy, period.year),
+    ).group_by(LeaveLedgerEntry.user_id).subquery()
+    carried = held.c.balance
+    if policy['carry_over'] is not None:
+        carried = case((held.c.balance < policy['carry_over'], held.c.balance), else_=policy['carry_over'])
+    # Leave taken early in the year uses the carried days first
+    unused = carried - func.coalesce(used.c.days, 0)
+    return select(held.c.user_id, (-unused).label('amount')).outerjoin(used, used.c.user_id == held.c.user_id).where(
+        unused > 0, ~_done(held.c.user_id, leave_type, 'expiry', label))
+
+
+def _expiry_date(policy, year):
+    return month_start(year, 1 + policy['carry_over_expires_months'])
+
+
+def steps(period):
+    """(leave type, kind, period label, date due, note, entries) for what is due in the month starting ``period``.
+
+    ``entries(low, high)`` selects (user_id, amount) of the ledger entries
+    still missing for the accounts of users ``low``..``high``.
+    """
+    due = []
+    year = str(period.year)
+    for leave_type, policy in policies().items():
+        if policy['carry_over'] is not None:
+            due.append((leave_type, 'forfeit', year, date(period.year, 1, 1),
+                        f'Carry-over above {policy["carry_over"]} days forfeited', _forfeited, policy))
+        if policy['carry_over_expires_months'] and period >= _expiry_date(policy, period.year):
+            due.append((leave_type, 'expiry', year, _expiry_date(policy, period.year),
+                        'Unused carry-over expired', _expired, policy))
+        if policy['accrual'] == 'monthly' and monthly_share(policy['days'], period.month):
+            label = f'{period:%Y-%m}'
+            due.append((leave_type, 'accrual', label, period, f'Monthly accrual {label}', _accrued, policy))
+        elif policy['accrual'] == 'annual' and policy['days']:
+            due.append((leave_type, 'accrual', year, date(period.year, 1, 1), f'Annual accrual {year}', _accrued,
+                        policy))
+    return [(leave_type, kind, label, day, note, partial(build, leave_type, policy, period, label))
+            for leave_type, kind, label, day, note, build, policy in due]
+
+
+def _chunks(chunk_size):
+    """User ids of the accounts, ``chunk_size`` at a time in id order."""
+    last = 0
+    while True:
+        ids = db.session.scalars(select(LeaveBalance.user_id).where(LeaveBalance.user_id > last)
+                                 .order_by(LeaveBalance.user_id).limit(chunk_size)).all()
+        if not ids:
+            return
+        yield ids
+        last = ids[-1]
+
+
+def _dated(day):
+    # Entries can't go on or before a day already snapshotted (see ledger.adjust)
+    snapshot = db.session.scalar(select(func.max(LeaveBalanceSnapshot.as_of)))
+    return max(day, snapshot + timedelta(days=1)) if snapshot else day
+
+
+def run(period, chunk_size=1000, dry_run=False, on_entry=None, on_chunk=None):
+    """Apply every accrual, forfeit and expiry due in the month starting ``period``.
+
+    Accounts are processed ``chunk_size`` users at a time, each chunk in its
+    own transaction: the ledger entries are inserted from one set-based
+    SELECT per step, then the balance cache is updated from them. An account
+    already holding an entry for a step and period is skipped, so rerunning a
+    period (after an interruption, or to catch people who joined since) only
+    adds what is missing. Accounts opened during the period's year accrue
+    nothing for it: their opening entry already holds that year's allowance,
+    and no entry is dated before it. With ``dry_run`` nothing is written and
+    ``on_entry(email, leave_type, kind, amount)`` sees each pending entry.
+    Returns {(leave type, kind, period label): [accounts, days]}.
+    """
+    if period.day != 1 or period > date.today():
+        raise ValueError('The period must be the first day of this or an earlier month.')
+    due = steps(period)
+    dates = {day: _dated(day) for _, _, _, day, _, _ in due}
+    totals = {(leave_type, kind, label): [0, 0] for leave_type, kind, label, _, _, _ in due}
+    for ids in _chunks(chunk_size):
+        low, high = ids[0], ids[-1]
+        run_at = datetime.now()
+        for leave_type, kind, label, day, note, entries in due:
+            pending = entries(low, high).subquery()
+            if dry_run:
+                for email, amount in db.session.execute(
+                        select(User.email, pending.c.amount).join(pending, pending.c.user_id == User.id)):
+                    totals[leave_type, kind, label][0] += 1
+                    totals[leave_type, kind, label][1] += amount
+                    if on_entry:
+                        on_entry(email, leave_type, kind, amount)
+                continue
+            db.session.execute(insert(LeaveLedgerEntry).from_select(
+                ['user_id', 'leave_type', 'amount', 'kind', 'effective_date', 'period', 'note', 'created_at'],
+                select(pending.c.user_id, literal(leave_type), pending.c.amount, literal(kind),
+                       literal(dates[day], db.Date), literal(label), literal(note), literal(run_at, db.DateTime))))
+            written = (LeaveLedgerEntry.user_id.between(low, high), LeaveLedgerEntry.leave_type == leave_type,
+                       LeaveLedgerEntry.kind == kind, LeaveLedgerEntry.period == label,
+                       LeaveLedgerEntry.created_at == run_at)
+            accounts, days = db.session.execute(
+                select(func.count(), func.coalesce(func.sum(LeaveLedgerEntry.amount), 0)).where(*written)).one()
+            if not accounts:
+                continue
+            column = BALANCE_COLUMNS[leave_type]
+            db.session.execute(
+                update(LeaveBalance).where(LeaveBalance.user_id == LeaveLedgerEntry.user_id, *written)
+                .values({column: column + LeaveLedgerEntry.amount}),
+                execution_options={'synchronize_session': False, 'invalidates': app_cache.touched_balances(ids)},
+            )
+            totals[leave_type, kind, label][0] += accounts
+            totals[leave_type, kind, label][1] += days
+        if dry_run:
+            db.session.rollback()
+        else:
+            db.session.commit()
+        if on_chunk:
+            on_chunk(high)
+    return totals
@@ -0,0 +1,158 @@
+from collections import defaultdict
+from datetime import date, timedelta
+import itertools
+import json
+
+from sqlalchemy import delete, func, insert, update
+
+from app import db
+from models import ArchivedLeaveRequest, LeaveRequest, LeaveUsageSummary, User
+import workdays
+
+_BUCKET = ('month', 'leave_type', 'employee_id', 'status')
+
+
+def month_start(day):
+    return day.replace(day=1)
+
+
+def _next_month(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+
+def month_slices(start, end, region=None):
+    """(first day of month, working days) for every month the inclusive range touches."""
+    month = month_start(start)
+    while month <= end:
+        following = _next_month(month)
+        days = workdays.duration(max(start, month), min(end, following - timedelta(days=1)), region)
+        yield month, days
+        month = following
+
+
+def month_days(start, end, region=None):
+    """The request's working days per month, as stored in ``LeaveRequest.month_days``."""
+    return json.dumps({month.isoformat(): days for month, days in month_slices(start, end, region)})
+
+
+def _stored_slices(start, end, region, stored):
+    # The split charged when the request was made; a holiday added since doesn't change it
+    if stored is None:
+        return list(month_slices(start, end, region))
+    return [(date.fromisoformat(month), days) for month, days in json.loads(stored).items()]
+
+
+def _deltas(leave_request, status, sign):
+    # Days are split across months; the request itself counts in its first month
+    slices = _stored_slices(leave_request.start_date, leave_request.end_date,
+                            workdays.region_of(leave_request.employee), leave_request.month_days)
+    for index, (month, days) in enumerate(slices):
+        yield {'month': month, 'leave_type': leave_request.leave_type, 'employee_id': leave_request.employee_id,
+               'status': status, 'days': sign * days, 'requests': sign if index == 0 else 0}
+
+
+def _upsert(rows):
+    """Add each row's days/requests to its bucket, creating missing buckets."""
+    if not rows:
+        return
+    dialect = db.session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        statement = dialect_insert(LeaveUsageSummary)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=list(_BUCKET),
+            set_={'days': LeaveUsageSummary.days + statement.excluded.days,
+                  'requests': LeaveUsageSummary.requests + statement.excluded.requests},
+        ), rows)
+        return
+    for row in rows:
+        result = db.session.execute(
+            update(LeaveUsageSummary)
+            .where(*(getattr(LeaveUsageSummary, key) == row[key] for key in _BUCKET))
+            .values(days=LeaveUsageSummary.days + row['days'],
+                    requests=LeaveUsageSummary.requests + row['requests']),
+            execution_options={'synchronize_session': False},
+        )
+        if result.rowcount == 0:
+            db.session.execute(insert(LeaveUsageSummary), [row])
+
+
+def record_created(leave_request):
+    """Count a new request in its pending buckets. Runs in the caller's transaction."""
+    _upsert(list(_deltas(leave_request, leave_request.status or 'pending', 1)))
+
+
+def record_transition(leave_requests, old_status, new_status):
+    """Move decided requests between status buckets. Runs in the caller's transaction."""
+    rows = []
+    for leave_request in leave_requests:
+        rows.extend(_deltas(leave_request, old_status, -1))
+        rows.extend(_deltas(leave_request, new_status, 1))
+    _upsert(rows)
+
+
+def rebuild(batch_size=5000):
+    """Recompute every summary from leave_requests and the archive. The caller commits."""
+    totals = defaultdict(lambda: [0, 0])
+    rows = itertools.chain.from_iterable(db.session.query(
+        model.employee_id, model.leave_type, model.status, model.start_date, model.end_date, model.month_days,
+        User.region,
+    ).join(User, model.employee_id == User.id).execution_options(yield_per=batch_size)
+        for model in (LeaveRequest, ArchivedLeaveRequest))
+    for employee_id, leave_type, status, start_date, end_date, stored, region in rows:
+        slices = _stored_slices(start_date, end_date, region or workdays.default_region(), stored)
+        for index, (month, days) in enumerate(slices):
+            bucket = totals[(month, leave_type, employee_id, status or 'pending')]
+            bucket[0] += days
+            bucket[1] += 1 if index == 0 else 0
+
+    db.session.execute(delete(LeaveUsageSummary))
+    buckets = [dict(zip(_BUCKET, key), days=days, requests=count) for key, (days, count) in totals.items()]
+    for offset in range(0, len(buckets), batch_size):
+        db.session.execute(insert(LeaveUsageSummary), buckets[offset:offset + batch_size])
+    return len(buckets)
+
+
+def monthly_usage(first_month, last_month, status='approved'):
+    """{month: {leave_type: days}} for the months in [first_month, last_month]."""
+    rows = db.session.query(
+        LeaveUsageSummary.month, LeaveUsageSummary.leave_type, func.sum(LeaveUsageSummary.days),
+    ).filter(
+        LeaveUsageSummary.status == status,
+        LeaveUsageSummary.month >= first_month,
+        LeaveUsageSummary.month <= last_month,
+    ).group_by(LeaveUsageSummary.month, LeaveUsageSummary.leave_type)
+
+    usage = {}
+    month = first_month
+    while month <= last_month:
+        usage[month] = {}
+        month = _next_month(month)
+    for month, leave_type, days in rows:
+        usage[month][leave_type] = days
+    return usage
+
+
+def top_employees(first_month, last_month, status='approved', limit=10):
+    """(user, days, requests) for the employees with the most leave in range."""
+    days = func.sum(LeaveUsageSummary.days).label('days')
+    totals = db.session.query(
+        LeaveUsageSummary.employee_id, days, func.sum(LeaveUsageSummary.requests),
+    ).filter(
+        LeaveUsageSummary.status == status,
+        LeaveUsageSummary.month >= first_month,
+        LeaveUsageSummary.month <= last_month,
+    ).group_by(LeaveUsageSummary.employee_id).order_by(days.desc()).limit(limit).all()
+
+    users = {user.id: user for user in User.query.filter(User.id.in_([row[0] for row in totals]))} if totals else {}
+    return [(users.get(employee_id), total_days, requests) for employee_id, total_days, requests in totals]
+
+
+def parse_month(value, default):
+    if not value:
+        return default
+    year, month = value.split('-')[:2]
+    return date(int(year), int(month), 1)
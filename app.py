@@ -1,31 +1,70 @@
 from dotenv import load_dotenv
 load_dotenv()
 
-from flask import Flask
+from flask import Flask, g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
 from sqlalchemy.orm import DeclarativeBase
+from sqlalchemy.sql.expression import CompoundSelect, Select, UpdateBase
 import os
 from werkzeug.middleware.proxy_fix import ProxyFix
-import logging
 from flask_login import LoginManager
+from log_config import configure_logging
 
-logging.basicConfig(level=logging.DEBUG)
+configure_logging()
 
 class Base(DeclarativeBase):
     pass
 
+class RoutingSession(Session):
+    """Sends plain SELECTs of replica-routed requests (see replicas.py) to the
+    chosen replica. Flushes, DML and raw SQL go to the primary, and once a
+    request has written, its later reads do too."""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or isinstance(clause, UpdateBase):
+                g.db_wrote = True
+                g.db_replica = None
+            elif g.get('db_replica') is not None and isinstance(clause, (Select, CompoundSelect)):
+                return g.db_replica
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+app.config["PASSWORD_HASH_METHOD"] = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
 app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     'pool_pre_ping': True,
     "pool_recycle": 300,
 }
+# Shared cache and pub/sub for every worker process; without it cache versions live in the database
+app.config["CACHE_REDIS_URL"] = os.environ.get("CACHE_REDIS_URL")
+# Unix sockets carrying dashboard events and cache invalidations between local workers (default: instance/live)
+app.config["LIVE_EVENTS_DIR"] = os.environ.get("LIVE_EVENTS_DIR")
+# SMTP settings for mailer.py; without MAIL_SERVER emails are only logged
+for name in ("MAIL_SERVER", "MAIL_USERNAME", "MAIL_PASSWORD", "MAIL_SENDER"):
+    if os.environ.get(name):
+        app.config[name] = os.environ[name]
+for name in ("MAIL_PORT", "MAIL_TIMEOUT"):
+    if os.environ.get(name):
+        app.config[name] = int(os.environ[name])
+for name in ("MAIL_USE_TLS", "MAIL_USE_SSL"):
+    if os.environ.get(name):
+        app.config[name] = os.environ[name].lower() in ("1", "true", "yes", "on")
+# Bearer token for /metrics, which is disabled without it; METRICS_DIR holds per-worker counters
+app.config["METRICS_TOKEN"] = os.environ.get("METRICS_TOKEN")
+app.config["METRICS_DIR"] = os.environ.get("METRICS_DIR")
+# Optional read replicas, comma-separated; reads are routed to them by replicas.py
+app.config["SQLALCHEMY_BINDS"] = {
+    f'replica_{number}': url.strip()
+    for number, url in enumerate(os.environ.get("DATABASE_REPLICA_URLS", "").split(",")) if url.strip()
+}
 
-db = SQLAlchemy(app, model_class=Base)
+db = SQLAlchemy(app, model_class=Base, session_options={'class_': RoutingSession})
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -33,6 +72,6 @@ login_manager.login_view = 'login'
 
 @login_manager.user_loader
 def load_user(user_id):
-    from models import User
-    return User.query.get(int(user_id))
+    from user_cache import user_cache
+    return user_cache.load(int(user_id))
 
@@ -0,0 +1,382 @@
+import json
+import logging
+import os
+import pickle
+import re
+import secrets
+import threading
+import time
+
+from datetime import datetime
+
+from flask import g, has_request_context
+from sqlalchemy import event, insert, inspect, select, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+from app import app, db
+import live
+from models import CacheVersion, LeaveBalance, LeaveRequest, User
+from user_cache import LocalLRU
+
+logger = logging.getLogger('leaveconnect.cache')
+
+# Tables whose writes invalidate cached reads
+TRACKED_TABLES = ('leave_requests', 'leave_balances', 'users')
+
+_PENDING = 'app_cache_invalidations'
+_TEXT_DML = re.compile(r'^\s*(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM)\s+(\w+)', re.IGNORECASE)
+
+
+def table_scope(table_name):
+    return f'table:{table_name}'
+
+
+def balance_scope(user_id):
+    return f'balance:{user_id}'
+
+
+def requests_scope(employee_id):
+    return f'requests:{employee_id}'
+
+
+def user_scope(user_id):
+    return f'user:{user_id}'
+
+
+def touched_balances(user_ids):
+    """Scopes to pass as the ``invalidates`` option of a bulk LeaveBalance UPDATE."""
+    return [balance_scope(user_id) for user_id in set(user_ids)]
+
+
+def touched_requests(employee_ids, statuses):
+    """Scopes to pass as the ``invalidates`` option of a bulk LeaveRequest UPDATE."""
+    scopes = [requests_scope(employee_id) for employee_id in set(employee_ids)]
+    return scopes + [status for status in ('pending', 'approved') if status in statuses]
+
+
+class SharedMemoryBackend:
+    """In-process stand-in for a shared cache such as Redis or memcached.
+
+    Values are pickled on the way in and out, as they would be over the
+    network, so anything that works here will survive a real shared store.
+    Give several AppCache instances the same backend to model several workers.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+        return pickle.loads(payload)
+
+    def set(self, key, value, ttl):
+        payload = pickle.dumps(value)
+        with self._lock:
+            self._entries[key] = (payload, time.monotonic() + ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+
+class RedisBackend:
+    """Adapts a redis-py client to the cache backend interface."""
+
+    def __init__(self, client, prefix='leaveconnect:'):
+        self.client = client
+        self.prefix = prefix
+
+    def get(self, key):
+        payload = self.client.get(self.prefix + key)
+        return pickle.loads(payload) if payload is not None else None
+
+    def set(self, key, value, ttl):
+        self.client.set(self.prefix + key, pickle.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+
+class DatabaseVersions:
+    """Version tokens kept in the cache_versions table.
+
+    Used when no shared cache is configured, so a commit in one worker
+    process still invalidates what every other worker cached. Tokens are read
+    and written on the primary, outside the request's session, and never
+    expire (``ttl`` is ignored). A row is only written when its scope is
+    invalidated; reads never write.
+    """
+
+    _table = CacheVersion.__table__
+
+    def get_many(self, keys):
+        with db.engine.connect() as connection:
+            return dict(connection.execute(
+                select(self._table.c.scope, self._table.c.token).where(self._table.c.scope.in_(keys))).all())
+
+    def get(self, key):
+        return self.get_many([key]).get(key)
+
+    def set_many(self, tokens, ttl=None):
+        rows = [{'scope': key, 'token': token, 'updated_at': datetime.now()} for key, token in sorted(tokens.items())]
+        with db.engine.begin() as connection:
+            dialect = {'sqlite': sqlite, 'postgresql': postgresql}.get(connection.dialect.name)
+            if dialect is not None:
+                statement = dialect.insert(self._table)
+                connection.execute(statement.on_conflict_do_update(
+                    index_elements=['scope'],
+                    set_={'token': statement.excluded.token, 'updated_at': statement.excluded.updated_at}), rows)
+                return
+            for row in rows:
+                if not connection.execute(update(self._table).where(self._table.c.scope == row['scope'])
+                                          .values(token=row['token'], updated_at=row['updated_at'])).rowcount:
+                    connection.execute(insert(self._table).values(**row))
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value})
+
+
+def _get_many(store, keys):
+    get_many = getattr(store, 'get_many', None)
+    return get_many(keys) if get_many else {key: store.get(key) for key in keys}
+
+
+class LocalVersions:
+    """This process's copy of the version tokens kept in ``store``.
+
+    A token read from the store is reused for ``APP_CACHE_VERSION_REFRESH``
+    seconds, so a cache hit costs no round trip. Tokens replaced here are
+    applied at once and sent to the other processes through ``broker``;
+    the refresh interval bounds how long a process that missed the message
+    keeps serving older entries.
+    """
+
+    def __init__(self, store, broker=None):
+        self.store = store
+        self.broker = broker
+        self._tokens = LocalLRU(app.config.get('APP_CACHE_SIZE', 20000))
+        self._lock = threading.Lock()
+        self._listening_pid = None
+
+    def _remember(self, tokens, read_at):
+        refresh = app.config.get('APP_CACHE_VERSION_REFRESH', 2)
+        with self._lock:
+            for key, token in tokens.items():
+                current = self._tokens.get(key)
+                if current is not None and current[1] > read_at:
+                    # A newer token arrived while this one was being read
+                    continue
+                self._tokens.set(key, (token, read_at), refresh)
+
+    def _deliver(self, message):
+        self._remember(json.loads(message), time.monotonic())
+
+    def _listen(self):
+        with self._lock:
+            if self.broker is None or self._listening_pid == os.getpid():
+                return
+            # First read in this process (or a forked copy of one)
+            self._tokens.clear()
+            self.broker.listen(self._deliver)
+            self._listening_pid = os.getpid()
+
+    def get_many(self, keys):
+        self._listen()
+        found, missing = {}, []
+        for key in keys:
+            entry = self._tokens.get(key)
+            if entry is None:
+                missing.append(key)
+            else:
+                found[key] = entry[0]
+        if missing:
+            read_at = time.monotonic()
+            fetched = _get_many(self.store, missing)
+            self._remember({key: fetched.get(key) for key in missing}, read_at)
+            found.update((key, fetched.get(key)) for key in missing)
+        return found
+
+    def set_many(self, tokens, ttl):
+        set_many = getattr(self.store, 'set_many', None)
+        if set_many:
+            set_many(tokens, ttl)
+        else:
+            for key, token in tokens.items():
+                self.store.set(key, token, ttl)
+        self._remember(tokens, time.monotonic())
+        if self.broker is None:
+            return
+        try:
+            self.broker.publish(json.dumps(tokens))
+        except Exception:
+            # Other processes pick the tokens up from the store within the refresh interval
+            logger.warning('Could not publish cache invalidations', exc_info=True)
+
+
+class AppCache:
+    """Read-through cache for hot, per-user and company-wide reads.
+
+    Every entry is stored under the current version token of each scope it
+    depends on (``balance:<id>``, ``requests:<id>``, ``pending``, ``approved``
+    and one ``table:<name>`` per table read). Committing a change to a
+    tracked table replaces the tokens of the scopes it touched, so older
+    entries become unreachable rather than being deleted one by one.
+
+    Values live in a local LRU. With a ``shared`` backend the version tokens,
+    and a copy of each value, live there too. Otherwise the tokens live in
+    ``versions`` (by default the database, see DatabaseVersions). Each
+    process reads the tokens through LocalVersions, and ``broker`` carries
+    new tokens to the other processes as soon as a commit replaces them.
+    """
+
+    def __init__(self, shared=None, local=None, versions=None, broker=None):
+        self.shared = shared
+        self.local = local or LocalLRU(app.config.get('APP_CACHE_SIZE', 20000))
+        self.versions = LocalVersions(shared or versions or DatabaseVersions(), broker)
+
+    def _versions(self, scopes):
+        keys = [f'version:{scope}' for scope in scopes]
+        found = self.versions.get_many(keys)
+        # A scope never invalidated (or whose token expired) is at version 0;
+        # its token is only written when something invalidates it
+        return [found.get(key) or '0' for key in keys]
+
+    def invalidate(self, scopes):
+        ttl = app.config.get('APP_CACHE_VERSION_TTL', 86400)
+        self.versions.set_many({f'version:{scope}': secrets.token_hex(6) for scope in set(scopes)}, ttl)
+
+    def get_or_load(self, key, scopes, loader, ttl=None):
+        """Cached ``loader()`` for ``key``, valid until any of ``scopes`` changes."""
+        session = db.session()
+        if session.info.get(_PENDING) or session.new or session.dirty or session.deleted:
+            # Reads inside an unfinished write could cache data that is rolled back
+            return loader()
+
+        versioned = f'{key}@' + '.'.join(self._versions(scopes))
+        value = self._get(versioned)
+        if value is not None:
+            return value
+        ttl = ttl or app.config.get('APP_CACHE_TTL', 300)
+        if has_request_context() and g.get('db_replica') is not None:
+            # A replica may not have the change behind the current version yet.
+            # Keep what it returns apart, and briefly, so requests pinned to
+            # the primary never see it.
+            versioned = f'replica:{versioned}'
+            ttl = min(ttl, app.config.get('REPLICA_MAX_LAG', 5))
+            value = self._get(versioned)
+            if value is not None:
+                return value
+        value = loader()
+        self.local.set(versioned, value, ttl)
+        if self.shared is not None:
+            self.shared.set(versioned, value, ttl)
+        return value
+
+    def _get(self, versioned):
+        value = self.local.get(versioned)
+        if value is None and self.shared is not None:
+            value = self.shared.get(versioned)
+        return value
+
+
+def _changed_statuses(leave_request):
+    history = inspect(leave_request).attrs.status.history
+    return set(history.added or ()) | set(history.deleted or ()) | set(history.unchanged or ()) | {
+        leave_request.status}
+
+
+def _queue(session, scopes):
+    session.info.setdefault(_PENDING, set()).update(scopes)
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_flushed(session, flush_context):
+    scopes = set()
+    for instance in list(session.new) + list(session.dirty) + list(session.deleted):
+        if instance in session.dirty and not session.is_modified(instance):
+            continue
+        if isinstance(instance, LeaveRequest):
+            scopes.add(requests_scope(instance.employee_id))
+            scopes.update(status for status in _changed_statuses(instance) if status in ('pending', 'approved'))
+            if instance in session.new or instance in session.deleted:
+                scopes.add('pending')
+        elif isinstance(instance, LeaveBalance):
+            scopes.add(balance_scope(instance.user_id))
+        elif isinstance(instance, User) and instance not in session.new:
+            # Names and emails appear on approved-leave calendars
+            scopes.update(('approved', user_scope(instance.id)))
+    if scopes:
+        _queue(session, scopes)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _collect_bulk(orm_execute_state):
+    if orm_execute_state.is_select:
+        return
+    statement = orm_execute_state.statement
+    table = getattr(statement, 'table', None)
+    if table is not None:
+        table_name = getattr(table, 'name', None)
+    else:
+        match = _TEXT_DML.match(str(statement))
+        table_name = match.group(1).lower() if match else None
+    if table_name not in TRACKED_TABLES:
+        return
+    hinted = orm_execute_state.execution_options.get('invalidates')
+    # Without a hint naming the rows touched, everything read from the table goes
+    _queue(orm_execute_state.session, hinted if hinted is not None else [table_scope(table_name)])
+
+
+@event.listens_for(Session, 'after_commit')
+def _publish(session):
+    if session.in_nested_transaction():
+        # A savepoint; the enclosing transaction may still roll back
+        return
+    scopes = session.info.pop(_PENDING, None)
+    if scopes:
+        app_cache.invalidate(scopes)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard(session):
+    if session.in_nested_transaction():
+        # Keep the enclosing transaction's scopes; invalidating a little too much is harmless
+        return
+    session.info.pop(_PENDING, None)
+
+
+def _configured_backend():
+    url = app.config.get('CACHE_REDIS_URL')
+    if not url:
+        return None
+    import redis
+    return RedisBackend(redis.Redis.from_url(url))
+
+
+app_cache = AppCache(shared=_configured_backend(), broker=live.configured_broker('cache'))
+
+
+def balance(user_id):
+    """{leave column: days} for a user, or None if they have no balance row."""
+    def load():
+        row = LeaveBalance.query.filter_by(user_id=user_id).first()
+        if row is None:
+            return None
+        return {'sick_leave': row.sick_leave, 'vacation_leave': row.vacation_leave,
+                'personal_leave': row.personal_leave}
+
+    return app_cache.get_or_load(f'balance:{user_id}', [table_scope('leave_balances'), balance_scope(user_id)], load)
+
+
+def pending_total():
+    return app_cache.get_or_load('pending_total', [table_scope('leave_requests'), 'pending'],
+                                 lambda: LeaveRequest.query.filter_by(status='pending').count())
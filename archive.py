@@ -0,0 +1,94 @@
+from datetime import date, datetime
+import time
+
+from sqlalchemy import delete, func, insert, literal, select, text, tuple_
+from sqlalchemy.orm import joinedload
+
+from app import app, db
+from models import ArchivedLeaveRequest, LeaveRequest
+
+DECIDED = ('approved', 'rejected')
+
+# Copied as-is; archived rows keep their id, so ledger entries still point at them
+COLUMNS = ('id', 'employee_id', 'manager_id', 'leave_type', 'start_date', 'end_date', 'reason', 'status',
+           'manager_comments', 'working_days', 'month_days', 'created_at', 'updated_at')
+
+# History cursors that continue into the archive start with this
+CURSOR_PREFIX = 'archived:'
+
+
+def cutoff(months=None):
+    """First day of the month ``months`` (default ARCHIVE_AFTER_MONTHS, 12) months ago."""
+    months = months if months is not None else app.config.get('ARCHIVE_AFTER_MONTHS', 12)
+    today = date.today()
+    index = today.year * 12 + today.month - 1 - months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def archive_batch(before, batch_size):
+    """Move up to ``batch_size`` requests decided and ended before ``before``; returns how many.
+
+    One short transaction: the rows are locked (skipping any another
+    archiver holds), copied and deleted.
+    """
+    ids = db.session.scalars(
+        select(LeaveRequest.id).where(
+            LeaveRequest.status.in_(DECIDED), LeaveRequest.end_date < before,
+            LeaveRequest.updated_at < datetime.combine(before, datetime.min.time()))
+        .limit(batch_size).with_for_update(skip_locked=True)
+    ).all()
+    if not ids:
+        db.session.rollback()
+        return 0
+    db.session.execute(insert(ArchivedLeaveRequest).from_select(
+        COLUMNS + ('archived_at',),
+        select(*[getattr(LeaveRequest, name) for name in COLUMNS], literal(datetime.now(), db.DateTime))
+        .where(LeaveRequest.id.in_(ids))))
+    db.session.execute(delete(LeaveRequest).where(LeaveRequest.id.in_(ids)),
+                       execution_options={'synchronize_session': False})
+    db.session.commit()
+    return len(ids)
+
+
+def archive(before, batch_size=1000, pause=0.0, should_stop=lambda: False, on_batch=None):
+    """Move every request decided and ended before ``before`` to the archive.
+
+    Batches commit one at a time, with ``pause`` seconds between them so
+    other writers get the tables in between. Returns how many were moved.
+    """
+    moved = 0
+    while not should_stop():
+        count = archive_batch(before, batch_size)
+        if not count:
+            break
+        moved += count
+        if on_batch:
+            on_batch(moved)
+        if pause:
+            time.sleep(pause)
+    if moved and db.session.get_bind().dialect.name == 'sqlite':
+        # Refresh the planner statistics the moved rows made stale
+        db.session.execute(text('PRAGMA optimize'))
+        db.session.commit()
+    return moved
+
+
+def newest_end_date():
+    """The latest end date in the archive, or None when it is empty."""
+    return db.session.scalar(select(func.max(ArchivedLeaveRequest.end_date)))
+
+
+def reaches(start):
+    """True when leave overlapping ``start`` or later may be archived."""
+    newest = newest_end_date()
+    return newest is not None and (start is None or start <= newest)
+
+
+def page(criteria, position, limit):
+    """Archived requests matching ``criteria``, newest first, after ``position`` (created_at, id)."""
+    query = ArchivedLeaveRequest.query.options(
+        joinedload(ArchivedLeaveRequest.employee), joinedload(ArchivedLeaveRequest.manager)).filter(*criteria)
+    if position:
+        query = query.filter(tuple_(ArchivedLeaveRequest.created_at, ArchivedLeaveRequest.id) < position)
+    return query.order_by(ArchivedLeaveRequest.created_at.desc(), ArchivedLeaveRequest.id.desc()).limit(limit).all()
+
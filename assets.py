@@ -0,0 +1,198 @@
+import gzip
+import hashlib
+import json
+import logging
+import mimetypes
+import os
+import posixpath
+import re
+import urllib.request
+
+from flask import abort, request, send_file, url_for
+from werkzeug.security import safe_join
+
+from app import app
+
+logger = logging.getLogger('leaveconnect.assets')
+
+# Third-party assets: logical name -> upstream URL
+VENDOR = {
+    'bootstrap.min.css': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/css/bootstrap.min.css',
+    'bootstrap.bundle.min.js': 'https://cdn.jsdelivr.net/npm/bootstrap@5.3.0/dist/js/bootstrap.bundle.min.js',
+    'bootstrap-icons.css': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.0/font/bootstrap-icons.css',
+    'fonts/bootstrap-icons.woff2': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.0/font/fonts/bootstrap-icons.woff2',
+    'fonts/bootstrap-icons.woff': 'https://cdn.jsdelivr.net/npm/bootstrap-icons@1.11.0/font/fonts/bootstrap-icons.woff',
+    'fullcalendar.global.min.js': 'https://cdn.jsdelivr.net/npm/fullcalendar@6.1.10/index.global.min.js',
+    'chart.umd.min.js': 'https://cdn.jsdelivr.net/npm/chart.js@4.4.1/dist/chart.umd.min.js',
+}
+
+STATIC_DIR = os.path.join(app.root_path, 'static')
+SOURCE_DIR = os.path.join(STATIC_DIR, 'src')        # our own assets
+VENDOR_DIR = os.path.join(STATIC_DIR, 'vendor')     # downloaded copies of VENDOR
+DIST_DIR = os.path.join(STATIC_DIR, 'dist')         # fingerprinted build output
+MANIFEST = os.path.join(DIST_DIR, 'manifest.json')
+
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.map')
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+FINGERPRINTED = re.compile(r'\.[0-9a-f]{12}\.\w+$')
+CSS_URL = re.compile(r'''url\(\s*(['"]?)([^'")?#]+)([?#][^'")]*)?\1\s*\)''')
+ONE_YEAR = 365 * 24 * 3600
+
+mimetypes.add_type('font/woff2', '.woff2')
+mimetypes.add_type('font/woff', '.woff')
+
+_manifest = None
+
+
+def fingerprinted(name, content):
+    """``name`` with a hash of ``content`` before the extension."""
+    root, ext = posixpath.splitext(name)
+    return f'{root}.{hashlib.sha256(content).hexdigest()[:12]}{ext}'
+
+
+def _rewrite_css_urls(name, css, manifest):
+    """Point url(...) references at the fingerprinted files they resolve to."""
+    base = posixpath.dirname(name)
+
+    def replace(match):
+        target = posixpath.normpath(posixpath.join(base, match.group(2)))
+        if target not in manifest:
+            return match.group(0)
+        return f'url("{posixpath.relpath(manifest[target], base or ".")}")'
+
+    return CSS_URL.sub(replace, css.decode('utf-8')).encode('utf-8')
+
+
+def fetch_vendor(offline=False):
+    """Download any VENDOR file missing from static/vendor; returns names fetched."""
+    fetched = []
+    for name, url in VENDOR.items():
+        path = os.path.join(VENDOR_DIR, *name.split('/'))
+        if os.path.exists(path):
+            continue
+        if offline:
+            raise FileNotFoundError(f'{path} is missing; copy it in or build without --offline')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with urllib.request.urlopen(url, timeout=60) as response:
+            content = response.read()
+        with open(path + '.part', 'wb') as handle:
+            handle.write(content)
+        os.replace(path + '.part', path)
+        fetched.append(name)
+    return fetched
+
+
+def _sources():
+    """(logical name, path) of every asset to build."""
+    for name in VENDOR:
+        yield name, os.path.join(VENDOR_DIR, *name.split('/'))
+    for directory, _, files in os.walk(SOURCE_DIR):
+        for filename in sorted(files):
+            path = os.path.join(directory, filename)
+            yield os.path.relpath(path, SOURCE_DIR).replace(os.sep, '/'), path
+
+
+def _write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path):
+        return
+    with open(path + '.part', 'wb') as handle:
+        handle.write(content)
+    os.replace(path + '.part', path)
+
+
+def build():
+    """Fingerprint every asset into static/dist with gzip and brotli variants.
+
+    CSS is built last so its url(...) references can point at fingerprinted
+    fonts and images. Earlier builds' files are kept, so pages still open in
+    a browser can load the assets they reference; the manifest is replaced
+    atomically. Returns the manifest and whether brotli variants were made.
+    """
+    try:
+        import brotli
+    except ImportError:
+        brotli = None
+
+    manifest = {}
+    sources = sorted(_sources(), key=lambda source: source[0].endswith('.css'))
+    for name, path in sources:
+        with open(path, 'rb') as handle:
+            content = handle.read()
+        if name.endswith('.css'):
+            content = _rewrite_css_urls(name, content, manifest)
+        hashed = fingerprinted(name, content)
+        manifest[name] = hashed
+        target = os.path.join(DIST_DIR, *hashed.split('/'))
+        _write(target, content)
+        if not name.endswith(COMPRESSIBLE):
+            continue
+        # Only keep a variant when it is actually smaller
+        variants = [('.gz', gzip.compress(content, compresslevel=9, mtime=0))]
+        if brotli is not None:
+            variants.append(('.br', brotli.compress(content, quality=11)))
+        for suffix, compressed in variants:
+            if len(compressed) < len(content):
+                _write(target + suffix, compressed)
+
+    os.makedirs(DIST_DIR, exist_ok=True)
+    with open(MANIFEST + '.part', 'w') as handle:
+        json.dump(manifest, handle, indent=2, sort_keys=True)
+    os.replace(MANIFEST + '.part', MANIFEST)
+    global _manifest
+    _manifest = None
+    return manifest, brotli is not None
+
+
+def _load_manifest():
+    global _manifest
+    if _manifest is None or app.debug:
+        try:
+            with open(MANIFEST) as handle:
+                _manifest = json.load(handle)
+        except FileNotFoundError:
+            if _manifest is None:
+                logger.warning('No asset build in %s; serving vendor assets from their CDN. '
+                               'Run flask build-assets.', DIST_DIR)
+            _manifest = {}
+    return _manifest
+
+
+@app.template_global()
+def asset_url(name):
+    """URL of a static asset, fingerprinted once ``flask build-assets`` has run.
+
+    Before the first build, vendor assets fall back to their CDN and our own
+    to the unhashed source under /static.
+    """
+    hashed = _load_manifest().get(name)
+    if hashed:
+        return url_for('asset', filename=hashed)
+    if name in VENDOR:
+        return VENDOR[name]
+    return url_for('static', filename=f'src/{name}')
+
+
+@app.route('/assets/<path:filename>')
+def asset(filename):
+    path = safe_join(DIST_DIR, filename)
+    if path is None or filename == 'manifest.json' or not os.path.isfile(path):
+        abort(404)
+
+    mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    served, encoding = path, None
+    for candidate, suffix in ENCODINGS:
+        if request.accept_encodings[candidate] and os.path.isfile(path + suffix):
+            served, encoding = path + suffix, candidate
+            break
+
+    # The name of a fingerprinted file changes whenever its content does
+    immutable = bool(FINGERPRINTED.search(filename))
+    response = send_file(served, mimetype=mimetype, conditional=True, etag=True,
+                         max_age=ONE_YEAR if immutable else None)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if immutable:
+        response.cache_control.immutable = True
+    return response
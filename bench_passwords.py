@@ -0,0 +1,65 @@
+# bench_passwords.py
+#
+# Login hashing benchmark. For each hash method/cost, measures how many
+# password checks one core sustains, then how many the PasswordHasher pool
+# sustains with every worker busy, and reports the pool's rate per core.
+#
+#   python bench_passwords.py [--seconds 3] [--methods scrypt:16384:8:1 scrypt pbkdf2:sha256:600000]
+
+import argparse
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_METHODS = [
+    'scrypt:16384:8:1',
+    'scrypt:32768:8:1',
+    'scrypt:65536:8:1',
+    'pbkdf2:sha256:260000',
+    'pbkdf2:sha256:600000',
+    'pbkdf2:sha256:1000000',
+]
+
+
+def measure(check, seconds):
+    done = 0
+    started = time.perf_counter()
+    while time.perf_counter() - started < seconds:
+        check()
+        done += 1
+    return done / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark login throughput per password hash cost.')
+    parser.add_argument('--seconds', type=float, default=3.0)
+    parser.add_argument('--methods', nargs='+', default=DEFAULT_METHODS)
+    args = parser.parse_args()
+
+    os.environ.setdefault('SESSION_SECRET', 'bench')
+    os.environ.setdefault('DATABASE_URL', 'sqlite://')
+    from werkzeug.security import generate_password_hash, check_password_hash
+    from passwords import PasswordHasher
+
+    cores = os.cpu_count() or 1
+    hasher = PasswordHasher(workers=cores, queue_size=cores)
+    print(f'{cores} cores, {args.seconds:g}s per measurement')
+    print(f'{"method":<24} {"ms/check":>9} {"1 core/s":>9} {"pool/s":>9} {"pool/core/s":>12}')
+
+    for method in args.methods:
+        password_hash = generate_password_hash('correct horse', method)
+        single = measure(lambda: check_password_hash(password_hash, 'correct horse'), args.seconds)
+
+        # Keep every pool worker busy from as many client threads
+        with ThreadPoolExecutor(max_workers=cores) as clients:
+            per_client = list(clients.map(
+                lambda _: measure(lambda: hasher.verify(password_hash, 'correct horse'), args.seconds),
+                range(cores)))
+        pooled = sum(per_client)
+        print(f'{method:<24} {1000 / single:>9.1f} {single:>9.1f} {pooled:>9.1f} {pooled / cores:>12.1f}')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
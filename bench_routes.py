@@ -0,0 +1,445 @@
+# bench_routes.py
+#
+# Route latency benchmark. Seeds a synthetic org (or reuses one), then drives
+# the hot routes twice: sequentially through the Flask test client, and from
+# several concurrent HTTP clients against a threaded server (or --url). Reports
+# p50/p95/p99 latency, throughput and SQL statements per request, and can save
+# the results as a baseline JSON file or compare against one.
+#
+#   python bench_routes.py [--users 5000] [--requests 200000] [--save baseline.json]
+#   python bench_routes.py --database-url sqlite:////tmp/org.db --users 50000 --requests 2000000
+#   python bench_routes.py --database-url sqlite:////tmp/org.db --reuse --compare baseline.json
+
+import argparse
+import http.cookiejar
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+PASSWORD = 'password'
+MANAGER_EVERY = 20
+
+# scenario: (endpoint, role, share of the HTTP mix)
+SCENARIOS = {
+    'login': ('login', 'employee', 2),
+    'dashboard': ('dashboard', 'employee', 20),
+    'request_leave': ('request_leave', 'employee', 8),
+    'calendar': ('calendar', 'employee', 10),
+    'calendar_events': ('calendar_events', 'employee', 25),
+    'manager_dashboard': ('manager_dashboard', 'manager', 20),
+    'approve_leave': ('approve_leave', 'manager', 8),
+    'reject_leave': ('reject_leave', 'manager', 7),
+}
+
+
+def _chunks(rows, size):
+    iterator = iter(rows)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _synthetic_requests(rng, users, count, today):
+    leave_types = ['vacation', 'sick', 'personal']
+    for _ in range(count):
+        leave_type = rng.choices(leave_types, weights=[55, 30, 15])[0]
+        employee_id = rng.randint(1, users)
+        # Three years of history and six months of upcoming leave
+        start = today + timedelta(days=rng.randrange(-3 * 365, 182))
+        length = rng.choices([1, 2, 3, 5, 10], weights=[40, 20, 15, 15, 10])[0]
+        lead = rng.randrange(0, 3) if leave_type == 'sick' else rng.randrange(7, 90)
+        created = datetime.combine(start, datetime.min.time()) - timedelta(days=lead, minutes=rng.randrange(1440))
+        if start > today:
+            status = rng.choices(['pending', 'approved', 'rejected'], weights=[40, 50, 10])[0]
+        else:
+            status = rng.choices(['approved', 'rejected', 'pending'], weights=[85, 13, 2])[0]
+        yield {
+            'employee_id': employee_id, 'leave_type': leave_type, 'start_date': start,
+            'end_date': start + timedelta(days=length - 1), 'reason': 'Synthetic leave', 'status': status,
+            'manager_id': None if status == 'pending' else ((employee_id - 1) // MANAGER_EVERY) * MANAGER_EVERY + 1,
+            'created_at': created, 'updated_at': created,
+        }
+
+
+def seed(db, users, requests, password_hash, batch_size=10000):
+    from models import LeaveBalance, LeaveRequest, User
+
+    rng = random.Random(42)
+    now = datetime.now()
+    today = date.today()
+
+    def user_rows():
+        for i in range(1, users + 1):
+            manager = i % MANAGER_EVERY == 1
+            yield {
+                'id': i, 'email': f'user{i}@example.com', 'password_hash': password_hash,
+                'first_name': f'User{i}', 'last_name': 'Synthetic', 'role': 'manager' if manager else 'employee',
+                'manager_id': None if manager else ((i - 1) // MANAGER_EVERY) * MANAGER_EVERY + 1,
+                'created_at': now, 'updated_at': now,
+            }
+
+    for table, rows in (
+        (User.__table__, user_rows()),
+        (LeaveBalance.__table__, ({'user_id': i, 'sick_leave': 10, 'vacation_leave': 25, 'personal_leave': 5,
+                                   'created_at': now, 'updated_at': now} for i in range(1, users + 1))),
+        (LeaveRequest.__table__, _synthetic_requests(rng, users, requests, today)),
+    ):
+        for chunk in _chunks(rows, batch_size):
+            db.session.execute(table.insert(), chunk)
+            db.session.commit()
+
+    if db.engine.dialect.name == 'postgresql':
+        # Users were inserted with explicit ids
+        db.session.execute(db.text("SELECT setval(pg_get_serial_sequence('users', 'id'), (SELECT MAX(id) FROM users))"))
+        db.session.commit()
+    elif db.engine.dialect.name == 'sqlite':
+        db.session.execute(db.text('ANALYZE'))
+        db.session.commit()
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(latencies, errors, elapsed, queries=None):
+    ordered = sorted(latencies)
+    result = {
+        'requests': len(ordered),
+        'errors': errors,
+        'p50_ms': percentile(ordered, 0.50) * 1000 if ordered else None,
+        'p95_ms': percentile(ordered, 0.95) * 1000 if ordered else None,
+        'p99_ms': percentile(ordered, 0.99) * 1000 if ordered else None,
+        'mean_ms': statistics.fmean(ordered) * 1000 if ordered else None,
+        'throughput_rps': len(ordered) / elapsed if elapsed else None,
+        'queries_per_request': queries,
+    }
+    return result
+
+
+class Workload:
+    """Picks users, request ids and form data for each scenario."""
+
+    def __init__(self, users, pending_ids, seed_value):
+        self.users = users
+        self.managers = [i for i in range(1, users + 1) if i % MANAGER_EVERY == 1]
+        self.employees = [i for i in range(1, users + 1) if i % MANAGER_EVERY != 1]
+        self._pending = iter(pending_ids)
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed_value)
+
+    def rng(self):
+        with self._lock:
+            return random.Random(self._rng.random())
+
+    def next_pending(self):
+        with self._lock:
+            return next(self._pending, None)
+
+    def credentials(self, role, rng):
+        user_id = rng.choice(self.managers if role == 'manager' else self.employees)
+        return {'email': f'user{user_id}@example.com', 'password': PASSWORD}
+
+    def call(self, scenario, rng):
+        """(method, path, form data) for one request of ``scenario``, or None if exhausted."""
+        if scenario == 'login':
+            return 'POST', '/login', self.credentials('employee', rng)
+        if scenario == 'dashboard':
+            return 'GET', '/dashboard', None
+        if scenario == 'request_leave':
+            # Far-future dates so requests rarely collide with seeded leave
+            start = date.today() + timedelta(days=400 + rng.randrange(3000))
+            return 'POST', '/request-leave', {
+                'leave_type': rng.choice(['vacation', 'sick', 'personal']), 'start_date': start.isoformat(),
+                'end_date': (start + timedelta(days=rng.randrange(3))).isoformat(), 'reason': 'Benchmark'}
+        if scenario == 'calendar':
+            return 'GET', '/calendar', None
+        if scenario == 'calendar_events':
+            month = date.today().replace(day=1) + timedelta(days=31 * rng.randrange(-3, 3))
+            start = month.replace(day=1) - timedelta(days=7)
+            query = urllib.parse.urlencode({'start': f'{start.isoformat()}T00:00:00',
+                                            'end': f'{(start + timedelta(days=42)).isoformat()}T00:00:00'})
+            return 'GET', f'/api/calendar-events?{query}', None
+        if scenario == 'manager_dashboard':
+            return 'GET', '/manager', None
+        if scenario in ('approve_leave', 'reject_leave'):
+            leave_id = self.next_pending()
+            if leave_id is None:
+                return None
+            action = 'approve' if scenario == 'approve_leave' else 'reject'
+            return 'POST', f'/manager/{action}/{leave_id}', {'comments': 'Benchmark'}
+        raise ValueError(scenario)
+
+
+def run_test_client(app, workload, scenarios, iterations):
+    import metrics
+
+    results = {}
+    clients = {}
+    for role in ('employee', 'manager'):
+        client = app.test_client()
+        response = client.post('/login', data=workload.credentials(role, random.Random(role)))
+        if response.status_code != 302:
+            raise SystemExit(f'Could not log in a benchmark {role}: {response.status_code}')
+        clients[role] = client
+
+    for scenario in scenarios:
+        endpoint, role, _ = SCENARIOS[scenario]
+        rng = workload.rng()
+        latencies, errors = [], 0
+        before = metrics.QUERIES.totals(endpoint)
+        for _ in range(iterations):
+            call = workload.call(scenario, rng)
+            if call is None:
+                break
+            method, path, data = call
+            client = app.test_client() if scenario == 'login' else clients[role]
+            started = time.perf_counter()
+            response = client.open(path, method=method, data=data)
+            latencies.append(time.perf_counter() - started)
+            errors += response.status_code >= 400
+        after = metrics.QUERIES.totals(endpoint)
+        served = after[0] - before[0]
+        queries = (after[1] - before[1]) / served if served else None
+        results[scenario] = summarize(latencies, errors, sum(latencies), queries)
+    return results
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+def _http_session(base_url, credentials):
+    opener = urllib.request.build_opener(
+        urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect())
+    status = _http_call(opener, base_url, 'POST', '/login', credentials)
+    if status != 302:
+        raise SystemExit(f'Could not log in over HTTP: {status}')
+    return opener
+
+
+def _http_call(opener, base_url, method, path, data):
+    body = urllib.parse.urlencode(data).encode() if data is not None else None
+    try:
+        with opener.open(urllib.request.Request(base_url + path, data=body, method=method), timeout=30) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as error:
+        # Redirects surface here because they are not followed
+        error.read()
+        return error.code
+
+
+def run_http(base_url, workload, scenarios, workers, duration, in_process):
+    import metrics
+
+    mix = [scenario for scenario in scenarios for _ in range(SCENARIOS[scenario][2])]
+    samples = {scenario: [] for scenario in scenarios}
+    errors = dict.fromkeys(scenarios, 0)
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration
+    before = {scenario: metrics.QUERIES.totals(SCENARIOS[scenario][0]) for scenario in scenarios}
+
+    def worker(index):
+        rng = workload.rng()
+        sessions = {role: _http_session(base_url, workload.credentials(role, rng)) for role in ('employee', 'manager')}
+        while time.perf_counter() < deadline:
+            scenario = rng.choice(mix)
+            call = workload.call(scenario, rng)
+            if call is None:
+                continue
+            method, path, data = call
+            role = SCENARIOS[scenario][1]
+            opener = urllib.request.build_opener(
+                urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect()
+            ) if scenario == 'login' else sessions[role]
+            started = time.perf_counter()
+            status = _http_call(opener, base_url, method, path, data)
+            elapsed = time.perf_counter() - started
+            with lock:
+                samples[scenario].append(elapsed)
+                errors[scenario] += status >= 400
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(worker, range(workers)))
+    elapsed = time.perf_counter() - started
+
+    results = {}
+    for scenario in scenarios:
+        queries = None
+        if in_process:
+            after = metrics.QUERIES.totals(SCENARIOS[scenario][0])
+            served = after[0] - before[scenario][0]
+            queries = (after[1] - before[scenario][1]) / served if served else None
+        results[scenario] = summarize(samples[scenario], errors[scenario], elapsed, queries)
+    total = sum(len(values) for values in samples.values())
+    results['_all'] = summarize([value for values in samples.values() for value in values],
+                                sum(errors.values()), elapsed)
+    results['_all']['workers'] = workers
+    results['_all']['throughput_rps'] = total / elapsed
+    return results
+
+
+def print_results(title, results):
+    print(f'\n{title}')
+    print(f'{"route":<20} {"n":>7} {"err":>5} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"req/s":>9} {"q/req":>6}')
+    for scenario, stats in results.items():
+        if not stats['requests']:
+            print(f'{scenario:<20} {0:>7}')
+            continue
+        queries = f'{stats["queries_per_request"]:.1f}' if stats['queries_per_request'] is not None else '-'
+        print(f'{scenario:<20} {stats["requests"]:>7} {stats["errors"]:>5} {stats["p50_ms"]:>8.1f} '
+              f'{stats["p95_ms"]:>8.1f} {stats["p99_ms"]:>8.1f} {stats["throughput_rps"]:>9.1f} {queries:>6}')
+
+
+def compare(baseline, current, tolerance):
+    """Lines describing regressions of ``current`` against ``baseline``."""
+    problems = []
+    for phase, routes in current['results'].items():
+        for scenario, stats in routes.items():
+            old = baseline.get('results', {}).get(phase, {}).get(scenario)
+            if not old or not old.get('requests') or not stats['requests']:
+                continue
+            if old['p95_ms'] and stats['p95_ms'] > old['p95_ms'] * (1 + tolerance):
+                problems.append(f'{phase}/{scenario}: p95 {old["p95_ms"]:.1f} -> {stats["p95_ms"]:.1f} ms')
+            if (old.get('queries_per_request') is not None and stats['queries_per_request'] is not None
+                    and stats['queries_per_request'] > old['queries_per_request'] + 0.5):
+                problems.append(f'{phase}/{scenario}: queries/request '
+                                f'{old["queries_per_request"]:.1f} -> {stats["queries_per_request"]:.1f}')
+    return problems
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark route latency, throughput and queries per request.')
+    parser.add_argument('--database-url', help='database to seed and benchmark (default: a temporary SQLite file)')
+    parser.add_argument('--reuse', action='store_true', help='benchmark an already-seeded database')
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=200000)
+    parser.add_argument('--iterations', type=int, default=200, help='test-client requests per route')
+    parser.add_argument('--workers', type=int, default=8, help='concurrent HTTP clients')
+    parser.add_argument('--duration', type=float, default=20.0, help='seconds of HTTP load')
+    parser.add_argument('--url', help='benchmark a running server instead of an in-process one')
+    parser.add_argument('--routes', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--skip-http', action='store_true')
+    parser.add_argument('--save', help='write results to this baseline JSON file')
+    parser.add_argument('--compare', help='baseline JSON file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p95 slowdown before failing')
+    args = parser.parse_args()
+
+    database_url = args.database_url or f'sqlite:///{os.path.join(tempfile.mkdtemp(prefix="leaveconnect-bench-"), "bench.db")}'
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('SESSION_SECRET', 'route-benchmark')
+
+    from werkzeug.security import generate_password_hash
+    from werkzeug.serving import make_server
+    import main as entry_point  # noqa: F401  (registers routes and metrics)
+    from app import app, db
+    from migrations import upgrade
+    from models import LeaveRequest, User
+
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    app.config['MAX_QUERIES_PER_REQUEST'] = 10 ** 6
+    app.config['SLOW_QUERY_MS'] = 10 ** 6
+
+    with app.app_context():
+        db.create_all()
+        if args.reuse:
+            users = db.session.query(db.func.max(User.id)).scalar() or 0
+            if not users:
+                raise SystemExit('--reuse given but the database has no users')
+        else:
+            if db.session.query(User.id).first():
+                raise SystemExit('Database already has users; pass --reuse to benchmark it as is')
+            users = args.users
+            started = time.perf_counter()
+            seed(db, users, args.requests, generate_password_hash(PASSWORD, app.config['PASSWORD_HASH_METHOD']))
+            upgrade()
+            print(f'Seeded {users} users and {args.requests} requests in {time.perf_counter() - started:.1f}s')
+        # Enough pending requests for every approve/reject either phase can issue
+        pending_ids = [leave_id for (leave_id,) in db.session.query(LeaveRequest.id)
+                       .filter_by(status='pending').order_by(LeaveRequest.id).limit(200000)]
+        request_total = db.session.query(db.func.count(LeaveRequest.id)).scalar()
+
+    workload = Workload(users, pending_ids, 7)
+    report = {
+        'meta': {
+            'commit': _git_commit(),
+            'recorded_at': datetime.now().isoformat(timespec='seconds'),
+            'dialect': database_url.split(':', 1)[0],
+            'users': users,
+            'leave_requests': request_total,
+            'iterations': args.iterations,
+            'workers': args.workers,
+            'duration': args.duration,
+            'python': platform.python_version(),
+            'cpus': os.cpu_count(),
+        },
+        'results': {},
+    }
+
+    report['results']['test_client'] = run_test_client(app, workload, args.routes, args.iterations)
+    print_results('Test client (sequential)', report['results']['test_client'])
+
+    if not args.skip_http:
+        server = None
+        base_url = args.url
+        if not base_url:
+            server = make_server('127.0.0.1', 0, app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = f'http://127.0.0.1:{server.server_port}'
+        try:
+            report['results']['http'] = run_http(base_url.rstrip('/'), workload, args.routes, args.workers,
+                                                  args.duration, in_process=server is not None)
+        finally:
+            if server:
+                server.shutdown()
+        print_results(f'HTTP ({args.workers} workers, {args.duration:g}s)', report['results']['http'])
+
+    if args.save:
+        with open(args.save, 'w') as handle:
+            json.dump(report, handle, indent=2)
+        print(f'\nSaved baseline to {args.save}')
+
+    if args.compare:
+        with open(args.compare) as handle:
+            baseline = json.load(handle)
+        problems = compare(baseline, report, args.tolerance)
+        print(f'\nCompared with {args.compare} (commit {baseline["meta"].get("commit")}):')
+        for problem in problems:
+            print(f'  REGRESSION {problem}')
+        if problems:
+            return 1
+        print('  no regressions')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
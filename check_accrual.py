@@ -0,0 +1,94 @@
+# check_accrual.py
+#
+# Accrual regression check. Runs the accrual engine against a throwaway SQLite
+# database for the two cases where an opening balance already holds the
+# allowance for its year: someone hired mid-year, who opens with a pro-rated
+# share, and the first run after the migration that backfilled opening entries
+# for existing accounts. Exits non-zero if either account is credited twice
+# or gets an entry dated before it opened.
+#
+#   python check_accrual.py
+
+import os
+import sys
+import tempfile
+from datetime import date, datetime
+
+
+def main():
+    workdir = tempfile.mkdtemp(prefix='leaveconnect-accrual-')
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(workdir, "accrual.db")}'
+    os.environ.setdefault('SESSION_SECRET', 'accrual-check')
+
+    from sqlalchemy import func, select
+    from app import app, db
+    import accrual
+    import ledger
+    import migrations
+    from models import LeaveBalance, LeaveLedgerEntry, User
+
+    app.logger.setLevel('WARNING')
+    failures = []
+
+    def balances(user_id):
+        row = db.session.get(LeaveBalance, db.session.scalar(select(LeaveBalance.id).filter_by(user_id=user_id)))
+        db.session.refresh(row)
+        return {'sick': row.sick_leave, 'vacation': row.vacation_leave, 'personal': row.personal_leave}
+
+    def expect(case, user_id, expected):
+        actual = balances(user_id)
+        ledgered = {leave_type: ledger.balance_as_of(user_id, leave_type, date.max)
+                    for leave_type in ledger.BALANCE_COLUMNS}
+        ok = actual == expected and ledgered == expected
+        print(f'{"ok  " if ok else "FAIL"} {case}: balances {actual}, ledger {ledgered}, expected {expected}')
+        if not ok:
+            failures.append(case)
+
+    def expect_no_backdating(case, user_id):
+        opened = db.session.scalar(select(func.min(LeaveLedgerEntry.effective_date)).filter_by(
+            user_id=user_id, kind='opening'))
+        early = db.session.scalar(select(func.count()).select_from(LeaveLedgerEntry).filter(
+            LeaveLedgerEntry.user_id == user_id, LeaveLedgerEntry.effective_date < opened))
+        print(f'{"ok  " if not early else "FAIL"} {case}: {early} entries dated before the opening on {opened}')
+        if early:
+            failures.append(case)
+
+    this_year = date.today().year
+    with app.app_context():
+        db.create_all()
+
+        # Existing employee before the ledger: a cached balance and no entries
+        veteran = User(email='veteran@example.com', role='employee', created_at=datetime(this_year - 5, 3, 1))
+        veteran.leave_balance = LeaveBalance(sick_leave=10, vacation_leave=15, personal_leave=5)
+        db.session.add(veteran)
+        db.session.commit()
+        migrations.upgrade()
+        accrual.run(date.today().replace(day=1))
+        expect('first run after migration', veteran.id, {'sick': 10, 'vacation': 15, 'personal': 5})
+        expect_no_backdating('first run after migration', veteran.id)
+
+        # Hired in July last year, with the opening entries dated that day
+        hired = datetime(this_year - 1, 7, 15)
+        hire = User(email='hire@example.com', role='employee', created_at=hired)
+        ledger.open_account(hire)
+        db.session.add(hire)
+        db.session.flush()
+        for entry in hire.ledger_entries:
+            entry.effective_date = hired.date()
+        db.session.commit()
+        for month in range(7, 13):
+            accrual.run(date(this_year - 1, month, 1))
+        # The shares of July to December: 5 sick, 8 vacation and 3 personal days
+        expect('mid-year hire, joining year', hire.id, {'sick': 5, 'vacation': 8, 'personal': 3})
+        accrual.run(date(this_year, 1, 1))
+        # Carry-over caps: sick 0, vacation 5, personal 0; then a year of sick and
+        # personal and January's vacation share
+        expect('mid-year hire, next January', hire.id, {'sick': 10, 'vacation': 6, 'personal': 5})
+        expect_no_backdating('mid-year hire', hire.id)
+
+    print(f'{len(failures)} failures')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+# check_query_plans.py
+#
+# Query-plan regression check. Seeds a throwaway SQLite database with a large
+# synthetic org, drives every hot route through the Flask test client, and runs
+# EXPLAIN QUERY PLAN on each SELECT the routes issued. Exits non-zero if any of
+# them full-scans a table or sorts an unbounded result with a temporary
+# B-tree, so a change that loses an index fails the build.
+#
+#   python check_query_plans.py [--users 2000] [--requests 100000]
+
+import argparse
+import os
+import random
+import re
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+SCAN = re.compile(r'^SCAN (?:TABLE )?(\w+)(?: AS \w+)?(?: USING (?:COVERING )?INDEX (\w+))?')
+TEMP_SORT = 'USE TEMP B-TREE FOR ORDER BY'
+
+# Statements that read most of a table on purpose, with the reason
+ALLOWED = {
+    'GROUP BY leave_usage_summary.employee_id ORDER BY': 'ranks per-employee totals of an indexed summary range',
+}
+
+
+SUBQUERY = re.compile(r'^(?:MATERIALIZE|CO-ROUTINE) (\w+)')
+# FTS5 finds the rows of a MATCH through its own index ('M' in the index string)
+FTS_MATCH = re.compile(r'VIRTUAL TABLE INDEX \d+:M')
+
+
+def regressions(plan, statement):
+    """Plan steps that scan a whole table or sort an unbounded result."""
+    steps = [row[-1] for row in plan]
+    subqueries = {match.group(1) for match in map(SUBQUERY.match, steps) if match}
+    # Sorting rows driven by a primary-key lookup is bounded by the keys
+    top = [row[-1] for row in plan if row[1] == 0 and row[-1].startswith(('SCAN', 'SEARCH'))]
+    keyed = bool(top) and 'USING INTEGER PRIMARY KEY' in top[0]
+    # Ranking full-text results sorts only the rows the search matched
+    ranked = bool(top) and FTS_MATCH.search(top[0]) and 'ORDER BY bm25(' in statement
+
+    problems = []
+    for step in steps:
+        match = SCAN.match(step)
+        if match and match.group(1) not in subqueries and not FTS_MATCH.search(step):
+            # Walking an index in order to fill one unfiltered page stops after LIMIT rows
+            if not (match.group(2) and re.search(r'\bLIMIT\b', statement) and not re.search(r'\bWHERE\b', statement)):
+                problems.append(step)
+        elif TEMP_SORT in step and not (keyed or ranked):
+            problems.append(step)
+    return problems
+
+
+def seed(connection, users, requests, password_hash):
+    rng = random.Random(42)
+    now = datetime(2025, 1, 1)
+    connection.executemany(
+        'INSERT INTO users (id, email, password_hash, first_name, role, created_at, updated_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        [(i, f'user{i}@example.com', password_hash, f'User{i}', 'manager' if i % 20 == 1 else 'employee', now, now)
+         for i in range(1, users + 1)],
+    )
+    connection.executemany(
+        'INSERT INTO leave_balances (user_id, sick_leave, vacation_leave, personal_leave, created_at, updated_at) '
+        'VALUES (?, 10, 15, 5, ?, ?)',
+        [(i, now, now) for i in range(1, users + 1)],
+    )
+    rows = []
+    for i in range(1, requests + 1):
+        start = date(2020, 1, 1) + timedelta(days=rng.randrange(5 * 365))
+        created = datetime.combine(start, datetime.min.time()) - timedelta(days=rng.randrange(1, 60))
+        status = rng.choices(['approved', 'rejected', 'pending'], weights=[75, 15, 10])[0]
+        rows.append((i, rng.randint(1, users), rng.choice(['sick', 'vacation', 'personal']), start,
+                     start + timedelta(days=rng.randrange(10)), 'Synthetic leave', status, created, created))
+    connection.executemany(
+        'INSERT INTO leave_requests (id, employee_id, leave_type, start_date, end_date, reason, status, '
+        'created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        rows,
+    )
+    connection.execute("UPDATE users SET calendar_token = 'plan-check' WHERE id = 1")
+    # Teams of 20 under each manager, for the per-team absence cap
+    connection.execute("UPDATE users SET manager_id = id - (id - 1) % 20 WHERE role = 'employee'")
+    connection.commit()
+    connection.execute('ANALYZE')
+
+
+def exercise(app, captured):
+    """Hit every hot route, tagging captured statements with the route name."""
+    def visit(client, name, method, url, **kwargs):
+        captured['route'] = name
+        response = getattr(client, method)(url, **kwargs)
+        if response.status_code >= 400:
+            raise SystemExit(f'{name}: {method.upper()} {url} returned {response.status_code}')
+
+    employee = app.test_client()
+    visit(employee, 'login', 'post', '/login', data={'email': 'user2@example.com', 'password': 'password'})
+    visit(employee, 'dashboard', 'get', '/dashboard')
+    visit(employee, 'request_leave', 'get', '/request-leave')
+    visit(employee, 'request_leave', 'post', '/request-leave', data={
+        'leave_type': 'personal', 'start_date': '2031-03-03', 'end_date': '2031-03-04', 'reason': 'Plan check'})
+    visit(employee, 'calendar', 'get', '/calendar')
+    visit(employee, 'calendar_events', 'get', '/api/calendar-events?start=2024-03-01T00:00:00&end=2024-04-12T00:00:00')
+
+    manager = app.test_client()
+    visit(manager, 'login', 'post', '/login', data={'email': 'user1@example.com', 'password': 'password'})
+    visit(manager, 'manager_dashboard', 'get', '/manager')
+    cursor = '2023-06-01T00:00:00_1'
+    visit(manager, 'manager_dashboard', 'get', f'/manager?pending_cursor={cursor}&history_cursor={cursor}')
+    visit(manager, 'staffing', 'get', '/manager/staffing?start=2024-03-01&day=2024-03-05')
+    visit(manager, 'calendar_feed', 'get', '/feeds/plan-check/team.ics')
+    visit(manager, 'calendar_feed', 'get', '/feeds/plan-check/me.ics')
+    visit(manager, 'leave_analytics', 'get', '/manager/analytics?from=2023-01&to=2023-12')
+    visit(manager, 'leave_usage_api', 'get', '/api/analytics/leave-usage?from=2023-01&to=2023-12')
+    visit(manager, 'search_requests', 'get', '/manager/search?q=user5&status=approved&from=2023-01-01&to=2023-12-31')
+    visit(manager, 'search_requests', 'get', '/manager/search?q=synthetic&cursor=-0.000001_500')
+
+    from models import LeaveRequest
+    captured['route'] = 'setup'
+    with app.app_context():
+        pending = [leave_id for (leave_id,) in LeaveRequest.query.with_entities(LeaveRequest.id)
+                   .filter_by(status='pending').limit(4)]
+    visit(manager, 'decision_form', 'get', f'/manager/requests/{pending[0]}/approve-form')
+    visit(manager, 'approve_leave', 'post', f'/manager/approve/{pending[0]}')
+    visit(manager, 'reject_leave', 'post', f'/manager/reject/{pending[1]}', data={'comments': 'Plan check'})
+    visit(manager, 'bulk_decide', 'post', '/manager/decisions', json={'ids': pending[2:], 'decision': 'approve'})
+
+    import archive
+    captured['route'] = 'archive'
+    with app.app_context():
+        archive.archive(date(2022, 1, 1), batch_size=5000)
+    visit(employee, 'dashboard_archived', 'get', f'/dashboard?cursor={archive.CURSOR_PREFIX}')
+    visit(manager, 'manager_archived', 'get', f'/manager?history_cursor={archive.CURSOR_PREFIX}{cursor}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the query plans of every hot route.')
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--requests', type=int, default=100000)
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix='leaveconnect-plans-')
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(workdir, "plans.db")}'
+    os.environ.setdefault('SESSION_SECRET', 'query-plan-check')
+
+    from sqlalchemy import event
+    from werkzeug.security import generate_password_hash
+    from app import app, db
+    import routes  # noqa: F401
+
+    app.logger.setLevel('WARNING')
+    app.config['MAX_CONCURRENT_ABSENCES'] = 1000
+    with app.app_context():
+        db.create_all()
+        raw = db.engine.raw_connection()
+        try:
+            seed(raw.driver_connection, args.users, args.requests, generate_password_hash('password'))
+        finally:
+            raw.close()
+        import analytics
+        analytics.rebuild()
+        db.session.commit()
+        import search
+        with db.engine.begin() as connection:
+            search.install(connection)
+
+        captured = {'route': None, 'statements': {}}
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith(('SELECT', 'WITH')):
+                captured['statements'].setdefault((captured['route'], statement), parameters)
+
+    exercise(app, captured)
+
+    failures = 0
+    with app.app_context(), db.engine.connect() as connection:
+        for (route, statement), parameters in captured['statements'].items():
+            rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + statement, parameters).all()
+            plan = [row[-1] for row in rows]
+            problems = regressions(rows, statement)
+            allowed = next((why for marker, why in ALLOWED.items() if marker in statement), None)
+            if problems and not allowed:
+                failures += 1
+                print(f'FAIL {route}: {" ".join(statement.split())}')
+                for step in plan:
+                    print(f'    {step}')
+            else:
+                print(f'ok   {route}: {"; ".join(plan)}' + (f'  [allowed: {allowed}]' if problems else ''))
+
+    print(f'{len(captured["statements"])} statements checked, {failures} regressions')
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,269 @@
+from datetime import date, datetime, timedelta
+import csv
+import signal
+import time
+
+import click
+
+from app import app, db
+import accrual
+import analytics
+import archive
+import assets
+import exports
+import importer
+import jobs
+import ledger
+from models import Holiday, User
+import search
+import workdays
+
+
+@app.cli.command('snapshot-balances')
+@click.option('--as-of', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help='Day to snapshot (default: yesterday).')
+def snapshot_balances(as_of):
+    """Snapshot every leave balance as of the end of a day."""
+    as_of = as_of.date() if as_of else date.today() - timedelta(days=1)
+    written = ledger.take_snapshots(as_of)
+    db.session.commit()
+    click.echo(f'Wrote {written} balance snapshots as of {as_of}.')
+
+
+@app.cli.command('accrue-leave')
+@click.option('--period', type=click.DateTime(formats=['%Y-%m']), default=None,
+              help='Month to run, as YYYY-MM (default: this month).')
+@click.option('--dry-run', is_flag=True, help='Report the changes without writing them.')
+@click.option('--details', type=click.File('w'), default=None,
+              help='With --dry-run, also write each account\'s change to this CSV file.')
+@click.option('--chunk-size', default=1000, show_default=True, help='Accounts per transaction.')
+def accrue_leave(period, dry_run, details, chunk_size):
+    """Accrue leave, and forfeit or expire carried-over days, per ACCRUAL_POLICIES.
+
+    Run it monthly; a month already run only gets what is still missing.
+    """
+    if details and not dry_run:
+        raise click.ClickException('--details needs --dry-run.')
+    period = period.date() if period else date.today().replace(day=1)
+    writer = csv.writer(details) if details else None
+    if writer:
+        writer.writerow(['email', 'leave_type', 'kind', 'amount'])
+    try:
+        totals = accrual.run(period, chunk_size=chunk_size, dry_run=dry_run,
+                             on_entry=(lambda *entry: writer.writerow(entry)) if writer else None,
+                             on_chunk=lambda last: click.echo(f'accounts through user {last} done', err=True))
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    for (leave_type, kind, label), (accounts, days) in totals.items():
+        click.echo(f'{leave_type} {kind} {label}: {accounts} accounts, {days:+d} days')
+    if dry_run:
+        click.echo('Dry run; nothing was written.')
+
+
+@app.cli.command('adjust-balance')
+@click.argument('email')
+@click.argument('leave_type', type=click.Choice(sorted(ledger.BALANCE_COLUMNS)))
+@click.argument('amount', type=int)
+@click.option('--note', required=True, help='Why the balance is being adjusted.')
+def adjust_balance(email, leave_type, amount, note):
+    """Credit (positive AMOUNT) or debit (negative AMOUNT) an employee's leave."""
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        raise click.ClickException(f'No user with email {email}')
+    try:
+        ledger.adjust(user.id, leave_type, amount, note)
+    except ValueError as error:
+        raise click.ClickException(str(error))
+    db.session.commit()
+    click.echo(f'Adjusted {email} {leave_type} leave by {amount:+d}.')
+
+
+@app.cli.command('balance-as-of')
+@click.argument('email')
+@click.argument('day', type=click.DateTime(formats=['%Y-%m-%d']))
+def balance_as_of(email, day):
+    """Print an employee's balances at the end of DAY."""
+    user = User.query.filter_by(email=email).first()
+    if user is None:
+        raise click.ClickException(f'No user with email {email}')
+    for leave_type in ledger.BALANCE_COLUMNS:
+        click.echo(f'{leave_type}: {ledger.balance_as_of(user.id, leave_type, day.date())}')
+
+
+@app.cli.command('rebuild-balances')
+def rebuild_balances():
+    """Recompute the cached LeaveBalance columns from the ledger."""
+    ledger.rebuild_balance_cache()
+    db.session.commit()
+    click.echo('Leave balances rebuilt from the ledger.')
+
+
+@app.cli.command('rebuild-leave-summary')
+@click.option('--batch-size', default=5000, show_default=True)
+def rebuild_leave_summary(batch_size):
+    """Recompute the leave analytics summaries from every leave request."""
+    buckets = analytics.rebuild(batch_size)
+    db.session.commit()
+    click.echo(f'Rebuilt {buckets} leave usage summary rows.')
+
+
+@app.cli.command('archive-leave')
+@click.option('--months', type=int, default=None,
+              help='Archive leave decided and ended before the start of the month this many months ago '
+                   '(default: ARCHIVE_AFTER_MONTHS, 12).')
+@click.option('--batch-size', default=1000, show_default=True, help='Requests moved per transaction.')
+@click.option('--pause', default=0.05, show_default=True, help='Seconds to wait between batches.')
+def archive_leave(months, batch_size, pause):
+    """Move long-decided leave requests from leave_requests to the archive table."""
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(signum))
+    before = archive.cutoff(months)
+    moved = archive.archive(before, batch_size=batch_size, pause=pause, should_stop=lambda: bool(stopping),
+                            on_batch=lambda total: click.echo(f'{total} moved', err=True))
+    click.echo(f'Archived {moved} leave requests that ended before {before}.')
+
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index():
+    """Re-index every leave request for manager search."""
+    with db.engine.begin() as connection:
+        if not search.supported(connection.dialect.name):
+            raise click.ClickException(f'Search is not available on {connection.dialect.name}.')
+        indexed = search.install(connection, rebuild=True)
+    click.echo(f'Indexed {indexed} leave requests.')
+
+
+@app.cli.command('export-leave')
+@click.option('--format', 'fmt', type=click.Choice(sorted(exports.FORMATS)), default='csv', show_default=True)
+@click.option('--from', 'start', type=click.DateTime(formats=['%Y-%m-%d']), default=None)
+@click.option('--to', 'end', type=click.DateTime(formats=['%Y-%m-%d']), default=None)
+@click.option('--status', type=click.Choice(['pending', 'approved', 'rejected']), default=None)
+@click.option('--employee', 'employee_email', default=None, help='Only this employee (email).')
+@click.option('--output', type=click.File('w'), default='-', help='File to write (default: stdout).')
+@click.option('--batch-size', default=1000, show_default=True)
+def export_leave(fmt, start, end, status, employee_email, output, batch_size):
+    """Stream leave requests with employee and manager as CSV or JSONL."""
+    rows = exports.leave_rows(start=start.date() if start else None, end=end.date() if end else None,
+                              status=status, employee_email=employee_email, batch_size=batch_size)
+    for chunk in exports.render(fmt, rows):
+        output.write(chunk)
+
+
+@app.cli.command('build-assets')
+@click.option('--offline', is_flag=True, help='Use only files already in static/vendor; never download.')
+def build_assets(offline):
+    """Vendor CDN assets and build fingerprinted, precompressed copies in static/dist."""
+    try:
+        fetched = assets.fetch_vendor(offline=offline)
+    except OSError as error:
+        raise click.ClickException(str(error))
+    for name in fetched:
+        click.echo(f'Downloaded {name}')
+    manifest, with_brotli = assets.build()
+    click.echo(f'Built {len(manifest)} assets into {assets.DIST_DIR}.')
+    if not with_brotli:
+        click.echo('brotli is not installed; only gzip variants were written.')
+
+
+@app.cli.command('import-employees')
+@click.argument('source', type=click.File('r', encoding='utf-8-sig'))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='Input format (default: from the file extension).')
+@click.option('--chunk-size', default=1000, show_default=True, help='Rows per transaction.')
+@click.option('--workers', type=int, default=None, help='Password hashing processes (default: CPU count).')
+@click.option('--invites', type=click.File('w'), default=None,
+              help='Write email,invite URL for each user imported without a password.')
+@click.option('--base-url', default='', help='Prefix for invite URLs, e.g. https://leave.example.com')
+def import_employees(source, fmt, chunk_size, workers, invites, base_url):
+    """Bulk-create employees with roles, managers and starting balances from CSV or JSONL.
+
+    Columns: email (required), first_name, last_name, role, manager_email,
+    region, password, and a starting balance per leave type (sick, vacation,
+    personal). Existing emails are skipped, so an interrupted import can
+    simply be run again.
+    """
+    fmt = fmt or ('jsonl' if source.name.endswith(('.jsonl', '.json')) else 'csv')
+    invalid = []
+
+    def rows():
+        for line_number, raw in importer.read_rows(source, fmt):
+            try:
+                yield importer.clean(raw)
+            except ValueError as error:
+                invalid.append(line_number)
+                click.echo(f'Line {line_number}: {error}; skipped.', err=True)
+
+    def progress(stats):
+        elapsed = time.monotonic() - stats['started']
+        click.echo(f'{stats["read"]} rows read, {stats["created"]} created '
+                   f'({stats["read"] / elapsed if elapsed else 0:.0f} rows/s)', err=True)
+
+    stats = importer.import_users(rows(), chunk_size=chunk_size, workers=workers, on_progress=progress)
+    if invites is not None:
+        writer = csv.writer(invites)
+        writer.writerow(['email', 'invite_url'])
+        for email, token in stats['invites']:
+            writer.writerow([email, f'{base_url.rstrip("/")}/invite/{token}'])
+    for manager_email in sorted(stats['missing_managers']):
+        click.echo(f'Manager {manager_email} not found; reports left without a manager.', err=True)
+    rate = stats['read'] / stats['elapsed'] if stats['elapsed'] else 0
+    click.echo(f'Imported {stats["created"]} users ({stats["skipped"]} already present, {len(invalid)} invalid, '
+               f'{stats["linked"]} manager links, {len(stats["invites"])} invites) '
+               f'in {stats["elapsed"]:.1f}s: {rate:.0f} rows/s.')
+
+
+@app.cli.command('run-jobs')
+@click.option('--once', is_flag=True, help='Exit when no jobs are due instead of polling.')
+@click.option('--batch-size', type=int, default=None, help='Jobs claimed per round (default: JOB_BATCH_SIZE).')
+@click.option('--poll-interval', type=float, default=None, help='Seconds to sleep when idle.')
+def run_jobs(once, batch_size, poll_interval):
+    """Run queued background jobs (notifications and emails)."""
+    stopping = []
+
+    def stop(signum, frame):
+        # Finish the current batch, then exit
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    ran = jobs.run_worker(batch_size=batch_size, poll_interval=poll_interval, once=once,
+                          should_stop=lambda: bool(stopping))
+    click.echo(f'Ran {ran} jobs.')
+
+
+@app.cli.command('purge-jobs')
+@click.option('--days', default=7, show_default=True, help='Keep finished jobs this many days.')
+def purge_jobs(days):
+    """Delete finished and failed jobs older than --days."""
+    removed = jobs.purge(datetime.now() - timedelta(days=days))
+    click.echo(f'Removed {removed} finished jobs.')
+
+
+@app.cli.command('add-holiday')
+@click.argument('region')
+@click.argument('day', type=click.DateTime(formats=['%Y-%m-%d']))
+@click.argument('name')
+def add_holiday(region, day, name):
+    """Make DAY a non-working day in REGION ('default' for users without a region).
+
+    Requests already made keep the duration they were charged.
+    """
+    if Holiday.query.filter_by(region=region, day=day.date()).first():
+        raise click.ClickException(f'{region} already has a holiday on {day.date()}')
+    db.session.add(Holiday(region=region, day=day.date(), name=name))
+    db.session.commit()
+    workdays.forget()
+    click.echo(f'Added {name} on {day.date()} in {region}.')
+
+
+@app.cli.command('remove-holiday')
+@click.argument('region')
+@click.argument('day', type=click.DateTime(formats=['%Y-%m-%d']))
+def remove_holiday(region, day):
+    """Make DAY a working day in REGION again."""
+    removed = Holiday.query.filter_by(region=region, day=day.date()).delete()
+    db.session.commit()
+    workdays.forget()
+    if not removed:
+        raise click.ClickException(f'{region} has no holiday on {day.date()}')
+    click.echo(f'Removed the holiday on {day.date()} in {region}.')
@@ -0,0 +1,115 @@
+from collections import defaultdict
+
+from sqlalchemy import update
+from sqlalchemy.orm import selectinload
+
+from app import db
+import analytics
+import app_cache
+import feeds
+import jobs
+from ledger import BALANCE_COLUMNS, record_debits
+from models import LeaveBalance, LeaveRequest
+
+DECISION_STATUSES = {'approve': 'approved', 'reject': 'rejected'}
+
+
+class _GroupConflict(Exception):
+    pass
+
+
+def _claim(items, status, manager_id, comments):
+    """Move still-pending requests to ``status``; returns how many moved."""
+    result = db.session.execute(
+        update(LeaveRequest)
+        .where(LeaveRequest.id.in_([item.id for item in items]), LeaveRequest.status == 'pending')
+        .values(status=status, manager_id=manager_id, manager_comments=comments),
+        execution_options={'synchronize_session': False,
+                           'invalidates': app_cache.touched_requests([item.employee_id for item in items],
+                                                                     ('pending', status))},
+    )
+    return result.rowcount
+
+
+def _debit(employee_id, leave_type, days):
+    """Atomically subtract ``days`` if the balance covers it; True on success."""
+    column = BALANCE_COLUMNS.get(leave_type)
+    if column is None:
+        return False
+    result = db.session.execute(
+        update(LeaveBalance)
+        .where(LeaveBalance.user_id == employee_id, column >= days)
+        .values({column: column - days}),
+        execution_options={'synchronize_session': False, 'invalidates': app_cache.touched_balances([employee_id])},
+    )
+    return result.rowcount == 1
+
+
+def _apply(items, decision, manager_id, comments):
+    status = DECISION_STATUSES[decision]
+    savepoint = db.session.begin_nested()
+    try:
+        if _claim(items, status, manager_id, comments) != len(items):
+            raise _GroupConflict()
+        analytics.record_transition(items, 'pending', status)
+        if decision == 'approve':
+            first = items[0]
+            if not _debit(first.employee_id, first.leave_type, sum(item.days_count for item in items)):
+                raise _GroupConflict()
+            record_debits(items, manager_id)
+    except _GroupConflict:
+        savepoint.rollback()
+        return False
+    savepoint.commit()
+    return True
+
+
+def decide(request_ids, decision, manager_id, comments=''):
+    """Approve or reject a batch of leave requests in one transaction.
+
+    Approvals are grouped per employee and leave type so each group costs one
+    conditional balance UPDATE; a group that cannot be applied as a whole is
+    retried request by request. Returns ``{request_id: outcome}`` where outcome
+    is the new status or one of ``not_found``, ``already_decided`` and
+    ``insufficient_balance``.
+    """
+    if decision not in DECISION_STATUSES:
+        raise ValueError(f'Unknown decision: {decision}')
+    status = DECISION_STATUSES[decision]
+
+    request_ids = list(dict.fromkeys(request_ids))
+    results = {request_id: 'not_found' for request_id in request_ids}
+    # Employees are needed for their working-day region in the analytics update
+    pending = LeaveRequest.query.filter(LeaveRequest.id.in_(request_ids)).options(
+        selectinload(LeaveRequest.employee)).order_by(LeaveRequest.created_at, LeaveRequest.id).with_for_update().all()
+
+    groups = defaultdict(list)
+    for leave_request in pending:
+        if leave_request.status != 'pending':
+            results[leave_request.id] = 'already_decided'
+            continue
+        key = (leave_request.employee_id, leave_request.leave_type) if decision == 'approve' else None
+        groups[key].append(leave_request)
+
+    changed_employees = set()
+    for items in groups.values():
+        if _apply(items, decision, manager_id, comments):
+            for item in items:
+                results[item.id] = status
+                changed_employees.add(item.employee_id)
+            continue
+        for item in items:
+            if _apply([item], decision, manager_id, comments):
+                results[item.id] = status
+                changed_employees.add(item.employee_id)
+            elif decision == 'approve' and db.session.query(LeaveRequest.status).filter_by(id=item.id).scalar() == 'pending':
+                results[item.id] = 'insufficient_balance'
+            else:
+                results[item.id] = 'already_decided'
+
+    if decision == 'approve':
+        # Rejecting a pending request leaves the approved-leave feeds unchanged
+        feeds.bump_for_employees(changed_employees)
+    jobs.leave_decided([request_id for request_id, outcome in results.items() if outcome == status], status)
+    db.session.commit()
+    return results
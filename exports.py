@@ -0,0 +1,103 @@
+import csv
+import io
+import json
+
+from sqlalchemy.orm import aliased
+
+from app import db
+import archive
+from models import ArchivedLeaveRequest, LeaveRequest, User
+import workdays
+
+FIELDS = (
+    'id', 'employee_email', 'employee_first_name', 'employee_last_name', 'leave_type', 'start_date', 'end_date',
+    'days', 'status', 'reason', 'manager_email', 'manager_comments', 'created_at', 'updated_at',
+)
+
+FORMATS = {
+    'csv': 'text/csv',
+    'jsonl': 'application/x-ndjson',
+}
+
+
+def leave_rows(start=None, end=None, status=None, employee_email=None, batch_size=1000):
+    """Yield one dict per leave request, joined with employee and manager.
+
+    Rows are fetched ``batch_size`` at a time (a server-side cursor where the
+    driver supports one) as plain columns, so memory stays flat however many
+    requests match. ``start``/``end`` keep requests overlapping that range.
+    When the range reaches back into the archive, archived requests come
+    first, then live ones, each in id order.
+    """
+    models = (ArchivedLeaveRequest, LeaveRequest) if archive.reaches(start) else (LeaveRequest,)
+    for model in models:
+        yield from _model_rows(model, start, end, status, employee_email, batch_size)
+
+
+def _model_rows(model, start, end, status, employee_email, batch_size):
+    employee = aliased(User)
+    manager = aliased(User)
+    query = db.session.query(
+        model.id,
+        employee.email.label('employee_email'),
+        employee.first_name.label('employee_first_name'),
+        employee.last_name.label('employee_last_name'),
+        model.leave_type,
+        model.start_date,
+        model.end_date,
+        model.status,
+        model.reason,
+        manager.email.label('manager_email'),
+        model.manager_comments,
+        model.created_at,
+        model.updated_at,
+        model.working_days,
+        employee.region,
+    ).join(employee, model.employee_id == employee.id).outerjoin(manager, model.manager_id == manager.id)
+
+    if start:
+        query = query.filter(model.end_date >= start)
+    if end:
+        query = query.filter(model.start_date <= end)
+    if status:
+        query = query.filter(model.status == status)
+    if employee_email:
+        query = query.filter(employee.email == employee_email)
+
+    query = query.order_by(model.id).execution_options(yield_per=batch_size, stream_results=True)
+    for row in query:
+        record = dict(row._mapping)
+        del record['working_days'], record['region']
+        record['days'] = row.working_days if row.working_days is not None else workdays.duration(
+            row.start_date, row.end_date, row.region or workdays.default_region())
+        for field in ('start_date', 'end_date', 'created_at', 'updated_at'):
+            record[field] = record[field].isoformat() if record[field] else None
+        yield record
+
+
+def as_csv(rows, rows_per_chunk=500):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=FIELDS)
+    writer.writeheader()
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % rows_per_chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def as_jsonl(rows, rows_per_chunk=500):
+    chunk = []
+    for row in rows:
+        chunk.append(json.dumps(row))
+        if len(chunk) == rows_per_chunk:
+            yield '\n'.join(chunk) + '\n'
+            chunk = []
+    if chunk:
+        yield '\n'.join(chunk) + '\n'
+
+
+def render(fmt, rows):
+    return as_csv(rows) if fmt == 'csv' else as_jsonl(rows)
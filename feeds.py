@@ -0,0 +1,147 @@
+from datetime import date, datetime, timedelta, timezone
+import secrets
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+
+from app import app, db
+from models import FeedVersion, LeaveRequest, User
+from user_cache import LocalLRU
+
+SCOPES = ('me', 'team', 'company')
+
+_rendered = LocalLRU(app.config.get('FEED_CACHE_SIZE', 1000))
+
+
+def feed_key(scope, user):
+    if scope == 'me':
+        return f'user:{user.id}'
+    if scope == 'team':
+        return f'team:{user.id}'
+    return 'company'
+
+
+def ensure_token(user):
+    """The user's secret feed token, created on first use. The caller commits."""
+    if not user.calendar_token:
+        user.calendar_token = secrets.token_urlsafe(24)
+    return user.calendar_token
+
+
+def bump(keys):
+    """Advance the version of each feed key. Runs in the caller's transaction."""
+    keys = sorted(set(keys))
+    if not keys:
+        return
+    db.session.execute(
+        update(FeedVersion).where(FeedVersion.feed_key.in_(keys))
+        .values(version=FeedVersion.version + 1, updated_at=datetime.now()),
+        execution_options={'synchronize_session': False},
+    )
+    existing = {key for (key,) in db.session.query(FeedVersion.feed_key).filter(FeedVersion.feed_key.in_(keys))}
+    for key in keys:
+        if key in existing:
+            continue
+        savepoint = db.session.begin_nested()
+        try:
+            db.session.execute(insert(FeedVersion), [{'feed_key': key, 'version': 2, 'updated_at': datetime.now()}])
+            savepoint.commit()
+        except IntegrityError:
+            # Another worker created it first; count this change on top
+            savepoint.rollback()
+            db.session.execute(update(FeedVersion).where(FeedVersion.feed_key == key)
+                               .values(version=FeedVersion.version + 1, updated_at=datetime.now()))
+
+
+def bump_for_employees(employee_ids):
+    """Bump every feed showing these employees' approved leave."""
+    employee_ids = set(employee_ids)
+    if not employee_ids:
+        return
+    managers = {manager_id for (manager_id,) in db.session.query(User.manager_id).filter(
+        User.id.in_(employee_ids), User.manager_id.isnot(None))}
+    bump([f'user:{employee_id}' for employee_id in employee_ids]
+         + [f'team:{manager_id}' for manager_id in managers] + ['company'])
+
+
+def version_of(key):
+    """(version, last modified) of a feed; feeds never bumped are at version 1."""
+    row = db.session.query(FeedVersion.version, FeedVersion.updated_at).filter_by(feed_key=key).first()
+    return (row.version, row.updated_at) if row else (1, None)
+
+
+def window_start():
+    return date.today() - timedelta(days=app.config.get('FEED_HISTORY_DAYS', 90))
+
+
+def etag_for(key, version, since):
+    # The window slides daily, so the start date is part of the feed's identity
+    return f'{key}-v{version}-{since.isoformat()}'
+
+
+def _escape(value):
+    return (value.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,')
+            .replace('\r\n', '\\n').replace('\n', '\\n'))
+
+
+def _fold(line):
+    """Fold content lines at 75 octets as RFC 5545 requires."""
+    encoded = line.encode('utf-8')
+    if len(encoded) <= 75:
+        return line
+    parts, current = [], b''
+    for char in line:
+        piece = char.encode('utf-8')
+        if len(current) + len(piece) > (75 if not parts else 74):
+            parts.append(current.decode('utf-8'))
+            current = b''
+        current += piece
+    parts.append(current.decode('utf-8'))
+    return '\r\n '.join(parts)
+
+
+def render(scope, user, since):
+    employee = aliased(User)
+    query = db.session.query(
+        LeaveRequest.id, LeaveRequest.leave_type, LeaveRequest.start_date, LeaveRequest.end_date,
+        LeaveRequest.updated_at, employee.first_name, employee.email,
+    ).join(employee, LeaveRequest.employee_id == employee.id).filter(
+        LeaveRequest.status == 'approved', LeaveRequest.end_date >= since)
+    if scope == 'me':
+        query = query.filter(LeaveRequest.employee_id == user.id)
+    elif scope == 'team':
+        query = query.filter(LeaveRequest.employee_id.in_(select(User.id).where(User.manager_id == user.id)))
+
+    host = app.config.get('FEED_UID_DOMAIN', 'leaveconnect')
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//LeaveConnect//Leave Portal//EN',
+        'CALSCALE:GREGORIAN',
+        f'X-WR-CALNAME:{_escape({"me": "My leave", "team": "Team leave", "company": "Company leave"}[scope])}',
+    ]
+    for leave_id, leave_type, start_date, end_date, updated_at, first_name, email in query:
+        # Timestamps are stored in server local time; DTSTAMP must be UTC
+        stamp = (updated_at or datetime.now()).astimezone(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+        lines.extend([
+            'BEGIN:VEVENT',
+            f'UID:leave-{leave_id}@{host}',
+            f'DTSTAMP:{stamp}',
+            f'DTSTART;VALUE=DATE:{start_date.strftime("%Y%m%d")}',
+            f'DTEND;VALUE=DATE:{(end_date + timedelta(days=1)).strftime("%Y%m%d")}',
+            f'SUMMARY:{_escape(f"{first_name or email} - {leave_type.capitalize()}")}',
+            'TRANSP:TRANSPARENT',
+            'END:VEVENT',
+        ])
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_fold(line) for line in lines) + '\r\n'
+
+
+def cached_render(scope, user, etag, since):
+    """Rendered feed for this ETag, reused across polls until the version moves."""
+    body = _rendered.get(etag)
+    if body is None:
+        body = render(scope, user, since)
+        _rendered.set(etag, body, app.config.get('FEED_CACHE_TTL', 86400))
+    return body
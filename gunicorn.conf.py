@@ -0,0 +1,51 @@
+# gunicorn.conf.py
+#
+# Prefork server settings. Every value can be overridden from the
+# environment: BIND, WEB_CONCURRENCY (worker processes), WEB_THREADS
+# (threads per worker), WEB_TIMEOUT and WEB_MAX_REQUESTS.
+
+import os
+
+cpus = os.cpu_count() or 1
+
+wsgi_app = 'wsgi:app'
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# One process per core; threads cover requests waiting on the database
+workers = int(os.environ.get('WEB_CONCURRENCY') or cpus)
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS') or 4)
+
+# Import the app once in the master so workers share its pages copy-on-write
+preload_app = True
+
+timeout = int(os.environ.get('WEB_TIMEOUT', 30))
+graceful_timeout = 30
+keepalive = 5
+max_requests = int(os.environ.get('WEB_MAX_REQUESTS', 5000))
+max_requests_jitter = max_requests // 10
+
+# Request timing is exported by /metrics; access logs are opt-in
+accesslog = os.environ.get('ACCESS_LOG') or None
+errorlog = '-'
+
+
+def post_fork(server, worker):
+    from wsgi import after_fork
+    after_fork()
+
+
+def on_starting(server):
+    # Worker pids are reused across restarts; start the /metrics totals afresh
+    import metrics
+    metrics.clear()
+
+
+def worker_exit(server, worker):
+    import metrics
+    metrics.flush()
+
+
+def child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
@@ -0,0 +1,219 @@
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from datetime import date, datetime
+import itertools
+import json
+import os
+import secrets
+import time
+
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import aliased
+from werkzeug.security import generate_password_hash
+
+from app import app, db
+from ledger import BALANCE_COLUMNS
+from models import LeaveBalance, LeaveLedgerEntry, User
+
+ROLES = ('employee', 'manager')
+
+# Optional columns; the balance columns are named by leave type (sick, vacation, personal)
+FIELDS = ('first_name', 'last_name', 'role', 'manager_email', 'region', 'password')
+
+
+def read_rows(handle, fmt):
+    """Yield (line number, dict) from a CSV file with a header row, or from JSONL."""
+    if fmt == 'csv':
+        reader = csv.DictReader(handle)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_number, line in enumerate(handle, 1):
+        if line.strip():
+            yield line_number, json.loads(line)
+
+
+def _text(value):
+    value = str(value).strip() if value is not None else ''
+    return value or None
+
+
+def clean(raw):
+    """Validate one input row; raises ValueError with a readable message."""
+    email = (_text(raw.get('email')) or '').lower()
+    if '@' not in email:
+        raise ValueError(f'invalid email {raw.get("email")!r}')
+    row = {'email': email}
+    for field in FIELDS:
+        row[field] = _text(raw.get(field))
+    row['role'] = (row['role'] or 'employee').lower()
+    if row['role'] not in ROLES:
+        raise ValueError(f'unknown role {row["role"]!r}')
+    if row['manager_email']:
+        row['manager_email'] = row['manager_email'].lower()
+        if row['manager_email'] == email:
+            raise ValueError('an employee cannot be their own manager')
+    for leave_type, column in BALANCE_COLUMNS.items():
+        value = _text(raw.get(leave_type))
+        try:
+            days = int(value) if value is not None else column.default.arg
+        except ValueError:
+            raise ValueError(f'{leave_type} balance {value!r} is not a whole number')
+        if days < 0:
+            raise ValueError(f'{leave_type} balance cannot be negative')
+        row[leave_type] = days
+    return row
+
+
+def _existing_emails(emails):
+    return set(db.session.scalars(select(User.email).where(User.email.in_(emails))))
+
+
+def _hash_passwords(pool, workers, rows):
+    """Start hashing the passwords of ``rows``; returns an iterator of hashes in order.
+
+    ``generate_password_hash`` is sent to the workers by reference, so they
+    never import the application.
+    """
+    passwords = [row['password'] for row in rows if row['password']]
+    method = app.config.get('PASSWORD_HASH_METHOD', 'scrypt')
+    chunksize = max(1, len(passwords) // (workers * 4))
+    return pool.map(generate_password_hash, passwords, itertools.repeat(method), chunksize=chunksize)
+
+
+def _write(rows, password_hashes):
+    """Insert users, balances and opening entries for ``rows`` in the current transaction.
+
+    Returns (email, invite token) for each user created without a password.
+    """
+    now = datetime.now()
+    today = date.today()
+    invites = []
+    users = []
+    for row in rows:
+        if row['password']:
+            password_hash, token = password_hashes[row['email']], None
+        else:
+            password_hash, token = None, secrets.token_urlsafe(24)
+            invites.append((row['email'], token))
+        users.append({
+            'email': row['email'], 'password_hash': password_hash, 'invite_token': token,
+            'first_name': row['first_name'], 'last_name': row['last_name'], 'role': row['role'],
+            'region': row['region'], 'created_at': now, 'updated_at': now,
+        })
+    # One multi-row INSERT per table; ids are read back by email
+    db.session.execute(insert(User), users)
+    ids = dict(db.session.execute(
+        select(User.email, User.id).where(User.email.in_([row['email'] for row in rows]))).all())
+    db.session.execute(insert(LeaveBalance), [{
+        'user_id': ids[row['email']], 'created_at': now, 'updated_at': now,
+        **{column.key: row[leave_type] for leave_type, column in BALANCE_COLUMNS.items()},
+    } for row in rows])
+    db.session.execute(insert(LeaveLedgerEntry), [{
+        'user_id': ids[row['email']], 'leave_type': leave_type, 'amount': row[leave_type], 'kind': 'opening',
+        'effective_date': today, 'note': 'Opening balance', 'created_at': now,
+    } for row in rows for leave_type in BALANCE_COLUMNS])
+    return invites
+
+
+def _commit_chunk(rows, hashes):
+    """Write one chunk in its own transaction; returns (created, invites).
+
+    A user registering one of the emails meanwhile makes the INSERT fail; the
+    chunk is then retried without the emails that now exist.
+    """
+    password_hashes = dict(zip([row['email'] for row in rows if row['password']], hashes))
+    for attempt in range(3):
+        try:
+            invites = _write(rows, password_hashes) if rows else []
+            db.session.commit()
+            return len(rows), invites
+        except IntegrityError:
+            db.session.rollback()
+            if attempt == 2:
+                raise
+            existing = _existing_emails([row['email'] for row in rows])
+            rows = [row for row in rows if row['email'] not in existing]
+
+
+def link_managers(links, batch_size=1000):
+    """Set manager_id from (email, manager email) pairs where it is still empty.
+
+    Returns (linked, missing manager emails).
+    """
+    linked = 0
+    missing = set()
+    manager = aliased(User)
+    users = User.__table__
+    statement = update(users).where(users.c.email == bindparam('employee_email'), users.c.manager_id.is_(None)).values(
+        manager_id=select(manager.id).where(manager.email == bindparam('manager_email')).scalar_subquery())
+    for start in range(0, len(links), batch_size):
+        batch = links[start:start + batch_size]
+        known = _existing_emails({manager_email for _, manager_email in batch})
+        missing.update(manager_email for _, manager_email in batch if manager_email not in known)
+        params = [{'employee_email': email, 'manager_email': manager_email}
+                  for email, manager_email in batch if manager_email in known]
+        if params:
+            linked += db.session.execute(statement, params).rowcount
+        db.session.commit()
+    return linked, missing
+
+
+def import_users(rows, chunk_size=1000, workers=None, on_progress=None):
+    """Create users, balances and opening ledger entries from cleaned ``rows``.
+
+    Rows are written ``chunk_size`` at a time, each chunk in its own
+    transaction, while the next chunk's passwords are hashed on a process
+    pool. Emails that already exist are skipped, so an interrupted import is
+    resumed by running it again. Rows without a password get an invite token
+    instead, for /invite/<token>.
+    Managers are linked once every row is in, since a manager may appear
+    after their reports. ``on_progress(stats)`` is called after each chunk.
+    """
+    workers = workers or os.cpu_count() or 1
+    stats = {'read': 0, 'created': 0, 'skipped': 0, 'linked': 0, 'missing_managers': set(),
+             'invites': [], 'started': time.monotonic()}
+    seen = set()
+    links = []
+
+    def prepare(chunk):
+        # Drop emails already imported (or repeated in the file) and start hashing the rest
+        existing = dict(db.session.execute(select(User.email, User.invite_token).where(
+            User.email.in_([row['email'] for row in chunk]))).all())
+        fresh = []
+        for row in chunk:
+            if row['manager_email']:
+                links.append((row['email'], row['manager_email']))
+            if row['email'] in existing or row['email'] in seen:
+                if existing.get(row['email']) and row['email'] not in seen:
+                    # Invites from an interrupted run are reported again
+                    stats['invites'].append((row['email'], existing[row['email']]))
+                seen.add(row['email'])
+                stats['skipped'] += 1
+                continue
+            seen.add(row['email'])
+            fresh.append(row)
+        stats['read'] += len(chunk)
+        return fresh, _hash_passwords(pool, workers, fresh)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = None
+        rows = iter(rows)
+        while True:
+            chunk = list(itertools.islice(rows, chunk_size))
+            # Hashing of this chunk overlaps the previous chunk's INSERTs
+            prepared = prepare(chunk) if chunk else None
+            if pending is not None:
+                created, invites = _commit_chunk(*pending)
+                stats['created'] += created
+                stats['invites'].extend(invites)
+                if on_progress:
+                    on_progress(stats)
+            if prepared is None:
+                break
+            pending = prepared
+
+    stats['linked'], stats['missing_managers'] = link_managers(links, chunk_size)
+    stats['elapsed'] = time.monotonic() - stats['started']
+    return stats
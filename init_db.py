@@ -14,4 +14,9 @@ with app.app_context():
 
     # Now, this command will find your models and create the tables
     db.create_all()
+
+    # Existing databases also need the columns and indexes added since
+    from migrations import upgrade
+    for change in upgrade():
+        print(f"Applied: {change}")
     print("Database initialized.")
\ No newline at end of file
@@ -0,0 +1,235 @@
+from datetime import datetime, timedelta
+import json
+import logging
+import random
+import secrets
+import time
+
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+
+from app import app, db
+from mailer import mailer
+from models import Job, LeaveRequest, User
+
+logger = logging.getLogger('leaveconnect.jobs')
+
+_HANDLERS = {}
+
+
+def handler(kind, batch=False):
+    """Register the function that runs jobs of ``kind``.
+
+    A plain handler gets one payload. A ``batch`` handler gets the payloads of
+    every claimed job of its kind at once and returns one exception or None
+    per payload, so it can share a connection across them.
+    """
+    def register(fn):
+        _HANDLERS[kind] = (fn, batch)
+        return fn
+    return register
+
+
+def enqueue(kind, payload, key=None, delay=0, max_attempts=None):
+    """Queue a job in the caller's transaction; a repeated ``key`` is ignored.
+
+    Returns True if the job was added.
+    """
+    job = Job(kind=kind, payload=json.dumps(payload), idempotency_key=key,
+              run_at=datetime.now() + timedelta(seconds=delay),
+              max_attempts=max_attempts or app.config.get('JOB_MAX_ATTEMPTS', 5))
+    if key is None:
+        db.session.add(job)
+        return True
+    savepoint = db.session.begin_nested()
+    try:
+        db.session.add(job)
+        db.session.flush([job])
+    except IntegrityError:
+        savepoint.rollback()
+        return False
+    savepoint.commit()
+    return True
+
+
+def backoff(attempts):
+    """Seconds before retry number ``attempts``: doubling, jittered, capped."""
+    base = app.config.get('JOB_RETRY_BASE', 30)
+    delay = min(base * 2 ** (attempts - 1), app.config.get('JOB_RETRY_MAX', 3600))
+    return delay * random.uniform(0.8, 1.2)
+
+
+def release_expired():
+    """Requeue jobs whose worker died mid-run; returns how many."""
+    cutoff = datetime.now() - timedelta(seconds=app.config.get('JOB_LEASE_SECONDS', 300))
+    result = db.session.execute(
+        update(Job).where(Job.status == 'running', Job.locked_at < cutoff)
+        .values(status='queued', claim_token=None, locked_at=None),
+        execution_options={'synchronize_session': False},
+    )
+    db.session.commit()
+    return result.rowcount
+
+
+def claim(limit):
+    """Mark up to ``limit`` due jobs as running for this worker and return them.
+
+    The conditional UPDATE means two workers racing for a job can't both win,
+    on any database.
+    """
+    token = secrets.token_hex(8)
+    due = select(Job.id).where(Job.status == 'queued', Job.run_at <= datetime.now()).order_by(
+        Job.run_at, Job.id).limit(limit)
+    db.session.execute(
+        update(Job).where(Job.id.in_(due.scalar_subquery()), Job.status == 'queued')
+        .values(status='running', claim_token=token, locked_at=datetime.now(), attempts=Job.attempts + 1),
+        execution_options={'synchronize_session': False},
+    )
+    db.session.commit()
+    return Job.query.filter_by(claim_token=token).order_by(Job.run_at, Job.id).all()
+
+
+def _finish(job, error):
+    if error is None:
+        values = {'status': 'done', 'finished_at': datetime.now(), 'last_error': None}
+    elif job.attempts >= job.max_attempts:
+        logger.error('Job %s (%s) failed for good after %d attempts: %s', job.id, job.kind, job.attempts, error)
+        values = {'status': 'failed', 'finished_at': datetime.now(), 'last_error': str(error)}
+    else:
+        delay = backoff(job.attempts)
+        logger.warning('Job %s (%s) attempt %d failed, retrying in %.0fs: %s',
+                       job.id, job.kind, job.attempts, delay, error)
+        values = {'status': 'queued', 'run_at': datetime.now() + timedelta(seconds=delay),
+                  'last_error': str(error)}
+    db.session.execute(update(Job).where(Job.id == job.id).values(claim_token=None, locked_at=None, **values),
+                       execution_options={'synchronize_session': False})
+
+
+def run_batch(limit=None):
+    """Claim and run one batch of due jobs; returns how many ran."""
+    jobs = claim(limit or app.config.get('JOB_BATCH_SIZE', 50))
+    by_kind = {}
+    for job in jobs:
+        by_kind.setdefault(job.kind, []).append(job)
+
+    for kind, group in by_kind.items():
+        fn, batch = _HANDLERS.get(kind, (None, False))
+        if fn is None:
+            for job in group:
+                _finish(job, LookupError(f'No handler for job kind {kind!r}'))
+            db.session.commit()
+            continue
+        if batch:
+            try:
+                errors = fn([json.loads(job.payload) for job in group])
+                db.session.commit()
+            except Exception as error:
+                logger.exception('Batch handler for %s failed', kind)
+                db.session.rollback()
+                errors = [error] * len(group)
+            for job, error in zip(group, errors):
+                _finish(job, error)
+            db.session.commit()
+            continue
+        for job in group:
+            # A handler's writes commit together with its job being marked done
+            try:
+                fn(json.loads(job.payload))
+                error = None
+            except Exception as exc:
+                logger.exception('Job %s (%s) raised', job.id, kind)
+                db.session.rollback()
+                error = exc
+            _finish(job, error)
+            db.session.commit()
+    return len(jobs)
+
+
+def run_worker(batch_size=None, poll_interval=None, once=False, should_stop=lambda: False):
+    """Run jobs until ``should_stop()`` (or, with ``once``, until none are due)."""
+    poll_interval = poll_interval or app.config.get('JOB_POLL_INTERVAL', 2.0)
+    ran = 0
+    last_release = 0.0
+    try:
+        while not should_stop():
+            if time.monotonic() - last_release > 60:
+                release_expired()
+                last_release = time.monotonic()
+            count = run_batch(batch_size)
+            ran += count
+            if count:
+                continue
+            if once:
+                break
+            time.sleep(poll_interval)
+    finally:
+        mailer.close()
+    return ran
+
+
+def purge(older_than):
+    """Delete finished jobs that ended before ``older_than``; returns how many."""
+    result = db.session.execute(
+        Job.__table__.delete().where(Job.status.in_(('done', 'failed')), Job.finished_at < older_than))
+    db.session.commit()
+    return result.rowcount
+
+
+def _display_name(user):
+    return ' '.join(part for part in (user.first_name, user.last_name) if part) or user.email
+
+
+def _email(to, subject, body, key):
+    enqueue('send_email', {'to': to, 'subject': subject, 'body': body}, key=key)
+
+
+@handler('send_email', batch=True)
+def send_emails(payloads):
+    return mailer.send_batch([(payload['to'], payload['subject'], payload['body']) for payload in payloads])
+
+
+@handler('leave_submitted')
+def notify_leave_submitted(payload):
+    leave_request = db.session.get(LeaveRequest, payload['leave_request_id'])
+    if leave_request is None:
+        return
+    employee = leave_request.employee
+    # The employee's own manager, or every manager when none is assigned
+    if employee.manager_id:
+        managers = [employee.manager]
+    else:
+        managers = User.query.filter_by(role='manager').all()
+    summary = (f'{_display_name(employee)} requested {leave_request.days_count} day(s) of {leave_request.leave_type} '
+               f'leave from {leave_request.start_date:%d %b %Y} to {leave_request.end_date:%d %b %Y}.')
+    for manager in managers:
+        if manager.id == employee.id:
+            continue
+        _email(manager.email, f'Leave request from {_display_name(employee)}',
+               f'{summary}\n\nReason: {leave_request.reason}\n\nReview it on the manager dashboard.',
+               key=f'email:leave_submitted:{leave_request.id}:{manager.id}')
+
+
+@handler('leave_decided')
+def notify_leave_decided(payload):
+    leave_request = db.session.get(LeaveRequest, payload['leave_request_id'])
+    if leave_request is None:
+        return
+    status = payload['status']
+    body = (f'Your {leave_request.leave_type} leave from {leave_request.start_date:%d %b %Y} to '
+            f'{leave_request.end_date:%d %b %Y} was {status}.')
+    if leave_request.manager_comments:
+        body += f'\n\nComments: {leave_request.manager_comments}'
+    _email(leave_request.employee.email, f'Your leave request was {status}', body,
+           key=f'email:leave_decided:{leave_request.id}')
+
+
+def leave_submitted(leave_request):
+    """Queue the new-request notification. Runs in the caller's transaction."""
+    enqueue('leave_submitted', {'leave_request_id': leave_request.id}, key=f'leave_submitted:{leave_request.id}')
+
+
+def leave_decided(request_ids, status):
+    """Queue decision notifications. Runs in the caller's transaction."""
+    for request_id in request_ids:
+        enqueue('leave_decided', {'leave_request_id': request_id, 'status': status},
+                key=f'leave_decided:{request_id}')
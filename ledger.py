@@ -0,0 +1,143 @@
+from datetime import date, datetime
+
+from sqlalchemy import bindparam, func, insert, text, update
+
+from app import db
+import app_cache
+from models import LeaveBalance, LeaveBalanceSnapshot, LeaveLedgerEntry
+
+BALANCE_COLUMNS = {
+    'sick': LeaveBalance.sick_leave,
+    'vacation': LeaveBalance.vacation_leave,
+    'personal': LeaveBalance.personal_leave,
+}
+
+_EPOCH = date(1, 1, 1)
+
+# One row per (user, leave type) account, derived from the balance cache
+_ACCOUNTS = ' UNION ALL '.join(
+    f"SELECT user_id, '{leave_type}' AS leave_type FROM leave_balances" for leave_type in BALANCE_COLUMNS
+)
+
+_TAKE_SNAPSHOTS = text(f'''
+    INSERT INTO leave_balance_snapshots (user_id, leave_type, as_of, balance, created_at)
+    SELECT accounts.user_id, accounts.leave_type, :as_of,
+           COALESCE(prev.balance, 0) + COALESCE((
+               SELECT SUM(entry.amount) FROM leave_ledger AS entry
+               WHERE entry.user_id = accounts.user_id AND entry.leave_type = accounts.leave_type
+                 AND entry.effective_date <= :as_of
+                 AND entry.effective_date > COALESCE(prev.as_of, :epoch)), 0),
+           :now
+    FROM ({_ACCOUNTS}) AS accounts
+    LEFT JOIN leave_balance_snapshots AS prev
+      ON prev.user_id = accounts.user_id AND prev.leave_type = accounts.leave_type
+     AND prev.as_of = (SELECT MAX(earlier.as_of) FROM leave_balance_snapshots AS earlier
+                       WHERE earlier.user_id = accounts.user_id AND earlier.leave_type = accounts.leave_type
+                         AND earlier.as_of < :as_of)
+    WHERE NOT EXISTS (SELECT 1 FROM leave_balance_snapshots AS done
+                      WHERE done.user_id = accounts.user_id AND done.leave_type = accounts.leave_type
+                        AND done.as_of = :as_of)
+''').bindparams(bindparam('as_of', type_=db.Date), bindparam('epoch', type_=db.Date),
+                bindparam('now', type_=db.DateTime))
+
+
+def _rebuild_column_sql(column_name):
+    latest = ('SELECT {field} FROM leave_balance_snapshots AS snap '
+              'WHERE snap.user_id = leave_balances.user_id AND snap.leave_type = :leave_type '
+              'ORDER BY snap.as_of DESC LIMIT 1')
+    return text(f'''
+        UPDATE leave_balances SET {column_name} =
+            COALESCE(({latest.format(field='snap.balance')}), 0) + COALESCE((
+                SELECT SUM(entry.amount) FROM leave_ledger AS entry
+                WHERE entry.user_id = leave_balances.user_id AND entry.leave_type = :leave_type
+                  AND entry.effective_date > COALESCE(({latest.format(field='snap.as_of')}), :epoch)), 0)
+    ''').bindparams(bindparam('epoch', type_=db.Date))
+
+
+def open_account(user):
+    """Give a new user their starting balance, pro-rated by joining month, and the matching opening entries."""
+    from accrual import opening_balances  # accrual builds on this module
+    opening = opening_balances((user.created_at or datetime.now()).date())
+    user.leave_balance = LeaveBalance(**{column.key: opening[leave_type]
+                                         for leave_type, column in BALANCE_COLUMNS.items()})
+    for leave_type, days in opening.items():
+        user.ledger_entries.append(LeaveLedgerEntry(
+            leave_type=leave_type, amount=days, kind='opening', note='Opening balance'))
+
+
+def record_debits(leave_requests, manager_id):
+    """Ledger debits for approved requests; the caller has already debited the cache."""
+    today = date.today()
+    db.session.execute(insert(LeaveLedgerEntry), [{
+        'user_id': leave_request.employee_id,
+        'leave_type': leave_request.leave_type,
+        'amount': -leave_request.days_count,
+        'kind': 'debit',
+        'effective_date': today,
+        'leave_request_id': leave_request.id,
+        'created_by_id': manager_id,
+        'created_at': datetime.now(),
+    } for leave_request in leave_requests])
+
+
+def latest_snapshot_date(user_id, leave_type):
+    return db.session.query(func.max(LeaveBalanceSnapshot.as_of)).filter_by(
+        user_id=user_id, leave_type=leave_type).scalar()
+
+
+def adjust(user_id, leave_type, amount, note, created_by_id=None, effective_date=None, kind='adjustment'):
+    """Credit (positive) or debit (negative) an account outside a leave request.
+
+    Entries can't be dated on or before the account's latest snapshot, since
+    that snapshot would no longer include them. The caller commits.
+    """
+    if leave_type not in BALANCE_COLUMNS:
+        raise ValueError(f'Unknown leave type: {leave_type}')
+    effective_date = effective_date or date.today()
+    snapshot_date = latest_snapshot_date(user_id, leave_type)
+    if snapshot_date and effective_date <= snapshot_date:
+        raise ValueError(f'Balance already snapshotted through {snapshot_date}; date the entry later.')
+
+    column = BALANCE_COLUMNS[leave_type]
+    db.session.add(LeaveLedgerEntry(user_id=user_id, leave_type=leave_type, amount=amount, kind=kind,
+                                    effective_date=effective_date, created_by_id=created_by_id, note=note))
+    db.session.execute(
+        update(LeaveBalance).where(LeaveBalance.user_id == user_id).values({column: column + amount}),
+        execution_options={'synchronize_session': False, 'invalidates': app_cache.touched_balances([user_id])},
+    )
+
+
+def take_snapshots(as_of):
+    """Snapshot every account as of the end of ``as_of``; returns rows written.
+
+    Each balance is the previous snapshot plus the entries since, so the cost
+    is the delta rather than the full history. Days already snapshotted are
+    skipped, so rerunning is harmless. The caller commits.
+    """
+    if as_of >= date.today():
+        raise ValueError('Snapshots can only be taken for days that have ended.')
+    result = db.session.execute(_TAKE_SNAPSHOTS, {'as_of': as_of, 'epoch': _EPOCH, 'now': datetime.now()})
+    return result.rowcount
+
+
+def balance_as_of(user_id, leave_type, day):
+    """Balance of one account at the end of ``day``: a snapshot plus the delta since."""
+    snapshot = LeaveBalanceSnapshot.query.filter(
+        LeaveBalanceSnapshot.user_id == user_id,
+        LeaveBalanceSnapshot.leave_type == leave_type,
+        LeaveBalanceSnapshot.as_of <= day,
+    ).order_by(LeaveBalanceSnapshot.as_of.desc()).first()
+    since = snapshot.as_of if snapshot else _EPOCH
+    delta = db.session.query(func.coalesce(func.sum(LeaveLedgerEntry.amount), 0)).filter(
+        LeaveLedgerEntry.user_id == user_id,
+        LeaveLedgerEntry.leave_type == leave_type,
+        LeaveLedgerEntry.effective_date > since,
+        LeaveLedgerEntry.effective_date <= day,
+    ).scalar()
+    return (snapshot.balance if snapshot else 0) + delta
+
+
+def rebuild_balance_cache():
+    """Recompute every LeaveBalance column from snapshots and the ledger. The caller commits."""
+    for leave_type, column in BALANCE_COLUMNS.items():
+        db.session.execute(_rebuild_column_sql(column.key), {'leave_type': leave_type, 'epoch': _EPOCH})
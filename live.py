@@ -0,0 +1,228 @@
+from collections import deque
+import contextlib
+import json
+import logging
+import os
+import queue
+import secrets
+import socket
+import stat
+import threading
+import time
+
+from app import app
+
+logger = logging.getLogger('leaveconnect.live')
+
+EVENT_TYPES = ('submitted', 'approved', 'rejected')
+
+# Largest event a socket receives; rendered table rows are a few kilobytes
+_MAX_DATAGRAM = 64 * 1024
+
+
+def _private_directory(directory):
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) != 0o700:
+        raise RuntimeError(f'{directory} must be a directory owned by uid {os.getuid()} with mode 0700')
+
+
+class SocketBroker:
+    """Local stand-in for a pub/sub service such as Redis.
+
+    Every process listening binds a Unix datagram socket in ``directory``,
+    and publishing sends the message to each socket there, so events reach
+    every worker on this host. A socket whose process has exited is removed
+    by the first publisher to find it dead. Any local user who could write
+    to ``directory`` could read or forge events, so it must be a directory
+    owned by this user with mode 0700; RuntimeError is raised otherwise.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._sender = None
+        _private_directory(directory)
+
+    def publish(self, message):
+        if self._sender is None:
+            self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            # A listener that has fallen behind misses the event rather than stalling the request
+            self._sender.setblocking(False)
+        data = message.encode()
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                self._sender.sendto(data, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                with contextlib.suppress(FileNotFoundError):
+                    os.unlink(path)
+            except BlockingIOError:
+                logger.warning('Live event listener %s is full; dropping an event for it', name)
+
+    def listen(self, deliver):
+        """Pass every message published from now on to ``deliver``, on a daemon thread."""
+        path = os.path.join(self.directory, f'{os.getpid()}-{secrets.token_hex(4)}.sock')
+        receiver = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        receiver.bind(path)
+
+        def run():
+            while True:
+                deliver(receiver.recv(_MAX_DATAGRAM).decode())
+
+        threading.Thread(target=run, name='live-events', daemon=True).start()
+
+
+class RedisBroker:
+    """Adapts a redis-py client's pub/sub to the broker interface."""
+
+    def __init__(self, client, channel='leaveconnect:live'):
+        self.client = client
+        self.channel = channel
+
+    def publish(self, message):
+        self.client.publish(self.channel, message)
+
+    def listen(self, deliver):
+        def run():
+            while True:
+                try:
+                    pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                    pubsub.subscribe(self.channel)
+                    for message in pubsub.listen():
+                        deliver(message['data'].decode())
+                except Exception:
+                    logger.warning('Lost the live event subscription; reconnecting', exc_info=True)
+                    time.sleep(1)
+
+        threading.Thread(target=run, name='live-events', daemon=True).start()
+
+
+class LocalBroker:
+    """Delivers messages within this process, where Unix sockets are unavailable.
+
+    Only used on Windows, which runs the app in a single process.
+    """
+
+    def __init__(self):
+        self._listeners = []
+
+    def publish(self, message):
+        for deliver in list(self._listeners):
+            deliver(message)
+
+    def listen(self, deliver):
+        self._listeners.append(deliver)
+
+
+class Hub:
+    """Fans published events out to the event streams open in this process.
+
+    The broker carries events between processes; this process starts
+    listening when its first stream opens. The latest ``LIVE_REPLAY_SIZE``
+    events received since then are kept so a browser reconnecting to this
+    process gets what it missed; events from before this process started
+    listening, or already pushed out of the buffer, are not replayed.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self._streams = set()
+        self._recent = deque(maxlen=app.config.get('LIVE_REPLAY_SIZE', 200))
+        self._lock = threading.Lock()
+        self._listening_pid = None
+
+    def publish(self, event_type, data):
+        if event_type not in EVENT_TYPES:
+            raise ValueError(f'Unknown live event: {event_type}')
+        try:
+            self.broker.publish(json.dumps({'id': time.time_ns(), 'type': event_type, 'data': data}))
+        except Exception:
+            # The change is committed either way; open pages catch up on reload
+            logger.warning('Could not publish a %s event', event_type, exc_info=True)
+
+    def _deliver(self, message):
+        event = json.loads(message)
+        with self._lock:
+            self._recent.append(event)
+            streams = list(self._streams)
+        for stream in streams:
+            try:
+                stream.put_nowait(event)
+            except queue.Full:
+                # A stream this far behind ends; its browser reconnects and replays
+                stream.overflowed = True
+
+    def open(self, last_event_id=None):
+        """A new stream's queue and the recent events after ``last_event_id``, or None when at capacity."""
+        with self._lock:
+            if self._listening_pid != os.getpid():
+                # First stream in this process (or a forked copy of one)
+                self._streams.clear()
+                self._recent.clear()
+                self.broker.listen(self._deliver)
+                self._listening_pid = os.getpid()
+            if len(self._streams) >= app.config.get('LIVE_MAX_STREAMS', 2):
+                return None
+            stream = queue.Queue(maxsize=app.config.get('LIVE_STREAM_BACKLOG', 100))
+            stream.overflowed = False
+            self._streams.add(stream)
+            missed = [event for event in self._recent if last_event_id is not None and event['id'] > last_event_id]
+        return stream, missed
+
+    def close(self, stream):
+        with self._lock:
+            self._streams.discard(stream)
+
+    def open_streams(self):
+        return len(self._streams)
+
+
+def _format(event):
+    return f'id: {event["id"]}\nevent: {event["type"]}\ndata: {json.dumps(event["data"])}\n\n'
+
+
+def events(stream, missed):
+    """Server-Sent Events text for an opened stream.
+
+    Ends after ``LIVE_STREAM_SECONDS`` so long-lived connections don't pin a
+    worker thread forever; the browser reconnects on its own.
+    """
+    try:
+        yield f'retry: {app.config.get("LIVE_RETRY_MS", 3000)}\n\n'
+        for event in missed:
+            yield _format(event)
+        deadline = time.monotonic() + app.config.get('LIVE_STREAM_SECONDS', 300)
+        heartbeat = app.config.get('LIVE_HEARTBEAT_SECONDS', 15)
+        while not stream.overflowed:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                event = stream.get(timeout=min(heartbeat, remaining))
+            except queue.Empty:
+                # Keeps proxies from closing an idle connection, and finds closed ones
+                yield ': keepalive\n\n'
+                continue
+            yield _format(event)
+    finally:
+        hub.close(stream)
+
+
+def configured_broker(channel):
+    """Broker carrying ``channel`` between this host's workers, or every host's with Redis."""
+    url = app.config.get('CACHE_REDIS_URL')
+    if url:
+        import redis
+        return RedisBroker(redis.Redis.from_url(url), channel=f'leaveconnect:{channel}')
+    if not hasattr(socket, 'AF_UNIX'):
+        return LocalBroker()
+    root = app.config.get('LIVE_EVENTS_DIR') or os.path.join(app.instance_path, 'live')
+    _private_directory(root)
+    return SocketBroker(os.path.join(root, channel))
+
+
+hub = Hub(configured_broker('live'))
@@ -0,0 +1,101 @@
+import atexit
+import copy
+from datetime import datetime, timezone
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+# LogRecord attributes that are not caller-supplied ``extra`` fields
+_RECORD_FIELDS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_handler = None
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message, plus any ``extra`` fields."""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+            'thread': record.threadName,
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_FIELDS and not key.startswith('_'):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=str)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        # The stock handler folds the traceback into the message text; keep it apart
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def _start_listener():
+    global _listener
+    output = logging.StreamHandler(sys.stderr)
+    output.setFormatter(JsonFormatter())
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_listener():
+    """Flush queued records and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+def configure_logging():
+    """Route all logging through a queue drained by a background writer thread.
+
+    Request threads only enqueue records; formatting as JSON and writing to
+    stderr happen on the listener thread. ``LOG_LEVEL`` sets the root level
+    (default INFO) and ``SQLALCHEMY_LOG_LEVEL`` the SQLAlchemy loggers
+    (default WARNING).
+    """
+    global _handler
+    if _handler is not None:
+        return
+    _handler = _QueueHandler(queue.SimpleQueue())
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(_handler)
+    root.setLevel(os.environ.get('LOG_LEVEL', 'INFO').upper())
+    logging.getLogger('sqlalchemy').setLevel(os.environ.get('SQLALCHEMY_LOG_LEVEL', 'WARNING').upper())
+    _start_listener()
+    atexit.register(stop_listener)
+
+
+def after_fork():
+    """Give a forked worker its own queue and writer thread.
+
+    Threads don't survive fork, and the parent's queue may have been mid-put
+    when the child was created, so neither can be reused.
+    """
+    global _listener
+    if _handler is None:
+        return
+    _listener = None
+    _handler.queue = queue.SimpleQueue()
+    _start_listener()
@@ -0,0 +1,92 @@
+from email.message import EmailMessage
+import logging
+import smtplib
+
+from app import app
+
+logger = logging.getLogger('leaveconnect.mail')
+
+
+class Mailer:
+    """Sends mail over one reused SMTP connection.
+
+    The connection is opened on first use and kept between batches; a
+    connection the server has dropped is replaced transparently. Without
+    ``MAIL_SERVER`` messages are logged instead of sent. For local testing,
+    run a debugging server (``python -m aiosmtpd -n -l localhost:1025``) and
+    set ``MAIL_SERVER=localhost``, ``MAIL_PORT=1025``.
+    """
+
+    def __init__(self):
+        self._connection = None
+
+    def _connect(self):
+        server = app.config['MAIL_SERVER']
+        port = app.config.get('MAIL_PORT', 25)
+        timeout = app.config.get('MAIL_TIMEOUT', 30)
+        if app.config.get('MAIL_USE_SSL'):
+            connection = smtplib.SMTP_SSL(server, port, timeout=timeout)
+        else:
+            connection = smtplib.SMTP(server, port, timeout=timeout)
+            if app.config.get('MAIL_USE_TLS'):
+                connection.starttls()
+        if app.config.get('MAIL_USERNAME'):
+            connection.login(app.config['MAIL_USERNAME'], app.config.get('MAIL_PASSWORD', ''))
+        return connection
+
+    def _live_connection(self):
+        if self._connection is not None:
+            try:
+                if self._connection.noop()[0] == 250:
+                    return self._connection
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.close()
+        self._connection = self._connect()
+        return self._connection
+
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._connection = None
+
+    @staticmethod
+    def build(to, subject, body):
+        message = EmailMessage()
+        message['From'] = app.config.get('MAIL_SENDER', 'LeaveConnect <no-reply@leaveconnect.local>')
+        message['To'] = to
+        message['Subject'] = subject
+        message.set_content(body)
+        return message
+
+    def send_batch(self, messages):
+        """Send each (to, subject, body); returns one exception or None per message."""
+        if not app.config.get('MAIL_SERVER'):
+            for to, subject, _ in messages:
+                logger.info('Mail to %s: %s (MAIL_SERVER not set, not sent)', to, subject)
+            return [None] * len(messages)
+
+        results = []
+        for to, subject, body in messages:
+            try:
+                message = self.build(to, subject, body)
+            except ValueError as error:
+                # A malformed header (e.g. a newline in a name) fails this message only
+                results.append(error)
+                continue
+            try:
+                self._live_connection().send_message(message)
+                results.append(None)
+            except smtplib.SMTPRecipientsRefused as error:
+                results.append(error)
+            except (smtplib.SMTPException, OSError) as error:
+                # The connection may be unusable now; the next message reconnects
+                self.close()
+                results.append(error)
+        return results
+
+
+mailer = Mailer()
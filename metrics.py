@@ -0,0 +1,337 @@
+import contextlib
+import hmac
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows, where the app runs in a single process
+    fcntl = None
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from app import app, db
+import live
+import replicas
+
+logger = logging.getLogger('leaveconnect.queries')
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    pairs = ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                     for name, value in zip(names, values))
+    return '{' + pairs + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name, self.documentation, self.labels = name, documentation, tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+    def state(self):
+        with self._lock:
+            return [[list(label_values), value] for label_values, value in self._values.items()]
+
+    @staticmethod
+    def combine(value, other):
+        return value + other
+
+    def expose(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label_values, value in sorted(values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.documentation, self.labels = name, documentation, tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def totals(self, *label_values):
+        """(observations, sum of observed values) for one label set."""
+        with self._lock:
+            series = self._series.get(label_values)
+            return (series[2], series[1]) if series else (0, 0.0)
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+
+    def state(self):
+        with self._lock:
+            return [[list(label_values), [list(counts), total, count]]
+                    for label_values, (counts, total, count) in self._series.items()]
+
+    @staticmethod
+    def combine(series, other):
+        return [[a + b for a, b in zip(series[0], other[0])], series[1] + other[1], series[2] + other[2]]
+
+    def expose(self, values):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, (counts, total, count) in sorted(values.items()):
+            # Buckets are cumulative; the implicit +Inf bucket is the observation count
+            for bound, bucket_count in zip(self.buckets, counts):
+                labels = _format_labels(self.labels + ('le',), label_values + (repr(float(bound)),))
+                lines.append(f'{self.name}_bucket{labels} {bucket_count}')
+            labels = _format_labels(self.labels + ('le',), label_values + ('+Inf',))
+            lines.append(f'{self.name}_bucket{labels} {count}')
+            plain = _format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{plain} {total}')
+            lines.append(f'{self.name}_count{plain} {count}')
+        return lines
+
+
+REQUESTS = Counter('leaveconnect_http_requests_total', 'HTTP requests served.', ('endpoint', 'method', 'status'))
+LATENCY = Histogram('leaveconnect_http_request_duration_seconds', 'Time to serve a request.', ('endpoint',))
+QUERIES = Histogram('leaveconnect_db_queries_per_request', 'SQL statements issued per request.', ('endpoint',),
+                    buckets=QUERY_COUNT_BUCKETS)
+DB_TIME = Histogram('leaveconnect_db_time_per_request_seconds', 'Time spent in SQL per request.', ('endpoint',))
+SLOW_QUERIES = Counter('leaveconnect_db_slow_queries_total', 'Statements slower than SLOW_QUERY_MS.', ('endpoint',))
+
+METRICS = (REQUESTS, LATENCY, QUERIES, DB_TIME, SLOW_QUERIES)
+
+# Each worker process writes its counters and histograms to {pid}.json in the
+# metrics directory; a scrape adds up every file so the totals don't depend on
+# which worker answers. When a worker exits the master folds its file into
+# dead.json, and the directory is emptied when the server starts.
+_DEAD = 'dead.json'
+_flusher_pid = None
+_flusher_lock = threading.Lock()
+_directory_lock = threading.Lock()
+
+
+def _directory():
+    return app.config.get('METRICS_DIR') or os.path.join(app.instance_path, 'metrics')
+
+
+@contextlib.contextmanager
+def _locked(exclusive):
+    directory = _directory()
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if fcntl is None:
+        with _directory_lock:
+            yield directory
+        return
+    with open(os.path.join(directory, '.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield directory
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write(path, state):
+    partial = f'{path}.{os.getpid()}.tmp'
+    with open(partial, 'w') as f:
+        json.dump(state, f)
+    os.replace(partial, path)
+
+
+def _merge(totals, state):
+    for metric in METRICS:
+        series = totals.setdefault(metric.name, {})
+        for label_values, value in state.get(metric.name, []):
+            key = tuple(label_values)
+            series[key] = metric.combine(series[key], value) if key in series else value
+    return totals
+
+
+def flush():
+    """Write this process's counters and histograms to its file in the metrics directory."""
+    state = {metric.name: metric.state() for metric in METRICS}
+    with _locked(exclusive=False) as directory:
+        _write(os.path.join(directory, f'{os.getpid()}.json'), state)
+
+
+def collect():
+    """{metric name: {label values: value}} summed over every worker, live or exited."""
+    flush()
+    totals = {}
+    with _locked(exclusive=False) as directory:
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                _merge(totals, _read(os.path.join(directory, name)))
+    return totals
+
+
+def mark_process_dead(pid):
+    """Fold an exited worker's file into the dead workers' totals; run by the master."""
+    with _locked(exclusive=True) as directory:
+        path = os.path.join(directory, f'{pid}.json')
+        if not os.path.exists(path):
+            return
+        merged = _merge(_merge({}, _read(os.path.join(directory, _DEAD))), _read(path))
+        _write(os.path.join(directory, _DEAD), {
+            name: [[list(label_values), value] for label_values, value in series.items()]
+            for name, series in merged.items()})
+        os.unlink(path)
+
+
+def clear():
+    """Forget every process's metrics; worker pids are reused across server restarts."""
+    with _locked(exclusive=True) as directory:
+        for name in os.listdir(directory):
+            if name.endswith(('.json', '.tmp')):
+                os.unlink(os.path.join(directory, name))
+
+
+def after_fork():
+    """Drop counts inherited from the parent; they are already in its own file."""
+    for metric in METRICS:
+        metric.reset()
+
+
+def _start_flusher():
+    global _flusher_pid
+    with _flusher_lock:
+        if _flusher_pid == os.getpid():
+            return
+        _flusher_pid = os.getpid()
+
+    def run():
+        while True:
+            time.sleep(app.config.get('METRICS_FLUSH_SECONDS', 5))
+            try:
+                flush()
+            except OSError:
+                logger.warning('Could not write this process\'s metrics', exc_info=True)
+
+    threading.Thread(target=run, name='metrics-flush', daemon=True).start()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_query(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's own context, so one that raises leaves nothing behind
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _finish_query(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'query_started', None)
+    if started is None or not has_request_context() or 'query_count' not in g:
+        return
+    elapsed = time.perf_counter() - started
+    g.query_count += 1
+    g.query_time += elapsed
+    if len(g.statements) < app.config.get('QUERY_LOG_LIMIT', 50):
+        g.statements.append((elapsed, statement))
+    if elapsed * 1000 >= app.config.get('SLOW_QUERY_MS', 200):
+        SLOW_QUERIES.inc(request.endpoint or 'unknown')
+        logger.warning('Slow query (%.1f ms) in %s: %s', elapsed * 1000, request.endpoint, ' '.join(statement.split()))
+
+
+@app.before_request
+def _start_request():
+    g.request_started = time.perf_counter()
+    g.query_count = 0
+    g.query_time = 0.0
+    g.statements = []
+
+
+@app.after_request
+def _record_request(response):
+    if 'request_started' not in g:
+        return response
+    endpoint = request.endpoint or 'unknown'
+    elapsed = time.perf_counter() - g.request_started
+    REQUESTS.inc(endpoint, request.method, response.status_code)
+    LATENCY.observe(elapsed, endpoint)
+    QUERIES.observe(g.query_count, endpoint)
+    DB_TIME.observe(g.query_time, endpoint)
+    if _flusher_pid != os.getpid():
+        # First request in this process (or a forked copy of one)
+        _start_flusher()
+
+    if g.query_count > app.config.get('MAX_QUERIES_PER_REQUEST', 20):
+        logger.warning('%s issued %d queries (%.1f ms in SQL):\n%s', endpoint, g.query_count, g.query_time * 1000,
+                       '\n'.join(f'  {ms * 1000:7.1f} ms  {" ".join(sql.split())[:300]}' for ms, sql in g.statements))
+    return response
+
+
+def _pool_lines():
+    pool = db.engine.pool
+    lines = []
+    for name, attribute, documentation in (
+        ('leaveconnect_db_pool_size', 'size', 'Configured connection pool size.'),
+        ('leaveconnect_db_pool_checked_out', 'checkedout', 'Connections currently in use.'),
+        ('leaveconnect_db_pool_checked_in', 'checkedin', 'Idle connections in the pool.'),
+        ('leaveconnect_db_pool_overflow', 'overflow', 'Connections opened beyond the pool size.'),
+    ):
+        # Not every pool class (e.g. SQLite's in-memory pools) tracks these
+        reader = getattr(pool, attribute, None)
+        if reader is None:
+            continue
+        lines.extend([f'# HELP {name} {documentation}', f'# TYPE {name} gauge', f'{name} {reader()}'])
+    return lines
+
+
+def _replica_lines():
+    if not replicas.REPLICA_KEYS:
+        return []
+    name = 'leaveconnect_db_replica_lag_seconds'
+    lines = [f'# HELP {name} Seconds the replica trailed the primary at the last health check.',
+             f'# TYPE {name} gauge']
+    for key, lag in sorted(replicas.monitor.lag.items()):
+        lines.append(f'{name}{{replica="{key}"}} {lag if lag != float("inf") else "+Inf"}')
+    return lines
+
+
+def _live_lines():
+    name = 'leaveconnect_live_streams'
+    return [f'# HELP {name} Live event streams open in this process.', f'# TYPE {name} gauge',
+            f'{name} {live.hub.open_streams()}']
+
+
+@app.route('/metrics')
+def metrics():
+    token = app.config.get('METRICS_TOKEN')
+    if not token:
+        return 'Metrics are disabled; set METRICS_TOKEN to enable them.\n', 403
+    if not hmac.compare_digest(request.headers.get('Authorization', '').encode(), f'Bearer {token}'.encode()):
+        return 'Unauthorized\n', 401
+    totals = collect()
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose(totals.get(metric.name, {})))
+    lines.extend(_pool_lines())
+    lines.extend(_replica_lines())
+    lines.extend(_live_lines())
+    return app.response_class('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
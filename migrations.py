@@ -0,0 +1,165 @@
+from datetime import date, datetime
+
+from sqlalchemy import bindparam, inspect, text
+
+from app import db
+
+import models  # noqa: F401  (registers the tables on db.metadata)
+from ledger import BALANCE_COLUMNS
+import search
+
+
+def _add_missing_columns(connection, inspector, table):
+    existing = {column['name'] for column in inspector.get_columns(table.name)}
+    added = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        column_type = column.type.compile(dialect=connection.dialect)
+        connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+        added.append(f'{table.name}.{column.name}')
+    return added
+
+
+def _dedupe_leave_balances(connection):
+    # The unique index can't be built while a user still has several rows
+    result = connection.execute(text(
+        'DELETE FROM leave_balances WHERE id NOT IN '
+        '(SELECT keep_id FROM (SELECT MIN(id) AS keep_id FROM leave_balances GROUP BY user_id) AS keepers)'
+    ))
+    return result.rowcount
+
+
+def _backfill_leave_balances(connection):
+    # Users created before balances were provisioned at registration
+    result = connection.execute(text(
+        'INSERT INTO leave_balances (user_id, sick_leave, vacation_leave, personal_leave, created_at, updated_at) '
+        'SELECT users.id, :sick, :vacation, :personal, :now, :now FROM users '
+        'WHERE NOT EXISTS (SELECT 1 FROM leave_balances WHERE leave_balances.user_id = users.id)'
+    ), {
+        'sick': models.LeaveBalance.sick_leave.default.arg,
+        'vacation': models.LeaveBalance.vacation_leave.default.arg,
+        'personal': models.LeaveBalance.personal_leave.default.arg,
+        'now': datetime.now(),
+    })
+    return result.rowcount
+
+
+def _backfill_ledger_openings(connection):
+    # Accounts that predate the ledger open at their current cached balance
+    created = 0
+    for leave_type, column in BALANCE_COLUMNS.items():
+        result = connection.execute(text(
+            f'INSERT INTO leave_ledger (user_id, leave_type, amount, kind, effective_date, note, created_at) '
+            f"SELECT user_id, :leave_type, {column.key}, 'opening', :today, 'Opening balance', :now "
+            f'FROM leave_balances WHERE NOT EXISTS (SELECT 1 FROM leave_ledger '
+            f'WHERE leave_ledger.user_id = leave_balances.user_id AND leave_ledger.leave_type = :leave_type)'
+        ).bindparams(bindparam('today', type_=db.Date), bindparam('now', type_=db.DateTime)),
+            {'leave_type': leave_type, 'today': date.today(), 'now': datetime.now()})
+        created += result.rowcount
+    return created
+
+
+def _backfill_month_days(batch_size=5000):
+    # Requests made before their per-month split was stored
+    import analytics
+    import workdays
+    filled = 0
+    while True:
+        rows = db.session.query(
+            models.LeaveRequest.id, models.LeaveRequest.start_date, models.LeaveRequest.end_date, models.User.region,
+        ).join(models.User, models.LeaveRequest.employee_id == models.User.id).filter(
+            models.LeaveRequest.month_days.is_(None)).order_by(models.LeaveRequest.id).limit(batch_size).all()
+        if not rows:
+            return filled
+        db.session.execute(
+            models.LeaveRequest.__table__.update().where(models.LeaveRequest.id == bindparam('leave_id'))
+            .values(month_days=bindparam('split')),
+            [{'leave_id': leave_id, 'split': analytics.month_days(start, end, region or workdays.default_region())}
+             for leave_id, start, end, region in rows],
+        )
+        db.session.commit()
+        filled += len(rows)
+
+
+def _drop_ledger_request_fk(connection, inspector):
+    # Ledger entries outlive their request's move to the archive. SQLite doesn't
+    # enforce the old constraint (foreign keys are off) and can't drop it.
+    if connection.dialect.name == 'sqlite':
+        return []
+    dropped = []
+    for foreign_key in inspector.get_foreign_keys('leave_ledger'):
+        if foreign_key['constrained_columns'] == ['leave_request_id'] and foreign_key['name']:
+            connection.execute(text(f'ALTER TABLE leave_ledger DROP CONSTRAINT {foreign_key["name"]}'))
+            dropped.append(f'dropped foreign key {foreign_key["name"]}')
+    return dropped
+
+
+def _backfill_working_days(batch_size=5000):
+    # Requests made before durations were stored in working days
+    import workdays
+    filled = 0
+    while True:
+        rows = db.session.query(
+            models.LeaveRequest.id, models.LeaveRequest.start_date, models.LeaveRequest.end_date, models.User.region,
+        ).join(models.User, models.LeaveRequest.employee_id == models.User.id).filter(
+            models.LeaveRequest.working_days.is_(None)).order_by(models.LeaveRequest.id).limit(batch_size).all()
+        if not rows:
+            return filled
+        db.session.execute(
+            models.LeaveRequest.__table__.update().where(models.LeaveRequest.id == bindparam('leave_id'))
+            .values(working_days=bindparam('days')),
+            [{'leave_id': leave_id, 'days': workdays.duration(start, end, region or workdays.default_region())}
+             for leave_id, start, end, region in rows],
+        )
+        db.session.commit()
+        filled += len(rows)
+
+
+def upgrade():
+    """Bring an existing database up to the current models.
+
+    ``create_all`` only creates missing tables, so this also adds columns and
+    indexes introduced since the database was first initialised. Safe to run
+    repeatedly. Returns a list of the changes made.
+    """
+    changes = []
+    db.create_all()
+    with db.engine.begin() as connection:
+        inspector = inspect(connection)
+        for table in db.metadata.sorted_tables:
+            changes.extend(_add_missing_columns(connection, inspector, table))
+            existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name in existing_indexes:
+                    continue
+                if index.name == 'uq_leave_balances_user_id':
+                    removed = _dedupe_leave_balances(connection)
+                    if removed:
+                        changes.append(f'removed {removed} duplicate leave_balances rows')
+                index.create(connection)
+                changes.append(f'index {index.name}')
+        changes.extend(_drop_ledger_request_fk(connection, inspector))
+        created = _backfill_leave_balances(connection)
+        if created:
+            changes.append(f'created {created} missing leave_balances rows')
+        opened = _backfill_ledger_openings(connection)
+        if opened:
+            changes.append(f'created {opened} opening leave_ledger entries')
+        indexed = search.install(connection)
+        if indexed:
+            changes.append(f'indexed {indexed} leave requests for search')
+
+    filled = _backfill_working_days()
+    if filled:
+        changes.append(f'stored working days on {filled} leave requests')
+    split = _backfill_month_days()
+    if split:
+        changes.append(f'stored the monthly split of {split} leave requests')
+
+    # Summaries start empty; fill them once for databases that already have requests
+    if not db.session.query(models.LeaveUsageSummary.id).first() and db.session.query(models.LeaveRequest.id).first():
+        import analytics
+        changes.append(f'built {analytics.rebuild()} leave usage summary rows')
+        db.session.commit()
+    return changes
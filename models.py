@@ -1,10 +1,14 @@
-from datetime import datetime
+from datetime import date, datetime
 from app import db
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from passwords import hasher
 
 class User(UserMixin, db.Model):
     __tablename__ = 'users'
+    __table_args__ = (
+        db.Index('uq_users_calendar_token', 'calendar_token', unique=True),
+        db.Index('uq_users_invite_token', 'invite_token', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String, unique=True, nullable=False)
     password_hash = db.Column(db.String(256))
@@ -12,21 +16,33 @@ class User(UserMixin, db.Model):
     last_name = db.Column(db.String, nullable=True)
     profile_image_url = db.Column(db.String, nullable=True)
     role = db.Column(db.String, default='employee')
+    manager_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True, index=True)
+    calendar_token = db.Column(db.String, nullable=True)
+    invite_token = db.Column(db.String, nullable=True)  # set by bulk import until the user picks a password
+    region = db.Column(db.String, nullable=True)  # weekend and holiday rules; None uses WORKDAY_REGION
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
 
     # --- Add these relationships ---
     leave_requests = db.relationship('LeaveRequest', backref='employee', lazy=True, foreign_keys='LeaveRequest.employee_id')
+    manager = db.relationship('User', remote_side=[id], backref='reports', foreign_keys=[manager_id])
     leave_balance = db.relationship('LeaveBalance', backref='user', uselist=False, lazy=True)
+    ledger_entries = db.relationship('LeaveLedgerEntry', backref='user', lazy='dynamic', foreign_keys='LeaveLedgerEntry.user_id')
     # -----------------------------
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hasher.hash(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        return hasher.verify(self.password_hash, password)
+
+    def password_needs_rehash(self):
+        return hasher.needs_rehash(self.password_hash)
 class LeaveBalance(db.Model):
     __tablename__ = 'leave_balances'
+    __table_args__ = (
+        db.Index('uq_leave_balances_user_id', 'user_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     sick_leave = db.Column(db.Integer, default=10)
@@ -38,6 +54,18 @@ class LeaveBalance(db.Model):
 
 class LeaveRequest(db.Model):
     __tablename__ = 'leave_requests'
+    __table_args__ = (
+        # employee dashboard: own requests, newest first
+        db.Index('ix_leave_requests_employee_created', 'employee_id', 'created_at'),
+        # employee dashboard: per-status counts of own requests
+        db.Index('ix_leave_requests_employee_status', 'employee_id', 'status'),
+        # manager queue: pending requests paged on (created_at, id)
+        db.Index('ix_leave_requests_status_created', 'status', 'created_at', 'id'),
+        # manager history: all requests paged on (created_at, id)
+        db.Index('ix_leave_requests_created', 'created_at', 'id'),
+        # calendar: approved leave overlapping a date window
+        db.Index('ix_leave_requests_status_dates', 'status', 'end_date', 'start_date'),
+    )
     id = db.Column(db.Integer, primary_key=True)
     employee_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
     manager_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
@@ -46,6 +74,9 @@ class LeaveRequest(db.Model):
     end_date = db.Column(db.Date, nullable=False)
     reason = db.Column(db.Text, nullable=False)
     status = db.Column(db.String, default='pending')
+    manager_comments = db.Column(db.Text, nullable=True)
+    working_days = db.Column(db.Integer, nullable=True)  # leave the request costs, fixed when it is made
+    month_days = db.Column(db.Text, nullable=True)  # JSON {first of month: working days}, fixed with working_days
     
     created_at = db.Column(db.DateTime, default=datetime.now)
     updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
@@ -54,4 +85,184 @@ class LeaveRequest(db.Model):
     
     @property
     def days_count(self):
-        return (self.end_date - self.start_date).days + 1
+        if self.working_days is not None:
+            return self.working_days
+        import workdays
+        return workdays.duration(self.start_date, self.end_date, workdays.region_of(self.employee))
+
+
+class ArchivedLeaveRequest(db.Model):
+    """A leave request decided long ago, moved out of ``leave_requests`` by
+    ``flask archive-leave``. Same columns and id; read-only from then on."""
+    __tablename__ = 'leave_requests_archive'
+    __table_args__ = (
+        # employee dashboard and manager history, continued past the live rows
+        db.Index('ix_leave_requests_archive_employee_created', 'employee_id', 'created_at', 'id'),
+        db.Index('ix_leave_requests_archive_created', 'created_at', 'id'),
+        db.Index('ix_leave_requests_archive_employee_status', 'employee_id', 'status'),
+        # exports by date range, and how far back the archive reaches
+        db.Index('ix_leave_requests_archive_dates', 'end_date', 'start_date'),
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    employee_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    manager_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    leave_type = db.Column(db.String, nullable=False)
+    start_date = db.Column(db.Date, nullable=False)
+    end_date = db.Column(db.Date, nullable=False)
+    reason = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String, nullable=False)
+    manager_comments = db.Column(db.Text, nullable=True)
+    working_days = db.Column(db.Integer, nullable=True)
+    month_days = db.Column(db.Text, nullable=True)
+
+    created_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.now)
+
+    employee = db.relationship('User', foreign_keys=[employee_id])
+    manager = db.relationship('User', foreign_keys=[manager_id])
+
+    days_count = LeaveRequest.days_count
+
+
+class LeaveLedgerEntry(db.Model):
+    """Append-only credit (+) or debit (-) of leave days.
+
+    Rows are never updated or deleted; corrections are new ``adjustment`` or
+    ``reversal`` entries. ``LeaveBalance`` is a cache of the running totals.
+    """
+    __tablename__ = 'leave_ledger'
+    __table_args__ = (
+        # balance as of a date: entries since the last snapshot
+        db.Index('ix_leave_ledger_account_date', 'user_id', 'leave_type', 'effective_date'),
+        db.Index('ix_leave_ledger_leave_request', 'leave_request_id'),
+        # accrual runs: at most one entry of each kind per account and period
+        db.Index('uq_leave_ledger_period', 'user_id', 'leave_type', 'kind', 'period', unique=True,
+                 sqlite_where=db.text('period IS NOT NULL'), postgresql_where=db.text('period IS NOT NULL')),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    leave_type = db.Column(db.String, nullable=False)
+    amount = db.Column(db.Integer, nullable=False)
+    kind = db.Column(db.String, nullable=False)  # opening, debit, credit, adjustment, reversal, accrual, forfeit, expiry
+    effective_date = db.Column(db.Date, nullable=False, default=date.today)
+    # No foreign key: the request may since have moved to leave_requests_archive
+    leave_request_id = db.Column(db.Integer, nullable=True)
+    created_by_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    note = db.Column(db.Text, nullable=True)
+    # Accrual period ('2026' or '2026-03') of entries written by the accrual engine
+    period = db.Column(db.String, nullable=True)
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    leave_request = db.relationship(
+        'LeaveRequest', primaryjoin='foreign(LeaveLedgerEntry.leave_request_id) == LeaveRequest.id', viewonly=True)
+
+
+class LeaveBalanceSnapshot(db.Model):
+    """Balance of one account at the end of ``as_of``, covering every ledger
+    entry effective on or before that day."""
+    __tablename__ = 'leave_balance_snapshots'
+    __table_args__ = (
+        db.UniqueConstraint('user_id', 'leave_type', 'as_of', name='uq_leave_balance_snapshots_account_date'),
+        # latest snapshot taken, which later ledger entries must be dated after
+        db.Index('ix_leave_balance_snapshots_as_of', 'as_of'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    leave_type = db.Column(db.String, nullable=False)
+    as_of = db.Column(db.Date, nullable=False)
+    balance = db.Column(db.Integer, nullable=False)
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+
+class LeaveUsageSummary(db.Model):
+    """Days of leave per calendar month, leave type, employee and status.
+
+    Maintained incrementally as requests are created and decided. Requests
+    spanning several months contribute their days to each month but count as
+    one request, in the month they start.
+    """
+    __tablename__ = 'leave_usage_summary'
+    __table_args__ = (
+        db.UniqueConstraint('month', 'leave_type', 'employee_id', 'status', name='uq_leave_usage_summary_bucket'),
+        db.Index('ix_leave_usage_summary_status_month', 'status', 'month'),
+        db.Index('ix_leave_usage_summary_employee_month', 'employee_id', 'month'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    month = db.Column(db.Date, nullable=False)  # first day of the month
+    leave_type = db.Column(db.String, nullable=False)
+    employee_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    status = db.Column(db.String, nullable=False)
+    days = db.Column(db.Integer, nullable=False, default=0)
+    requests = db.Column(db.Integer, nullable=False, default=0)
+
+
+class FeedVersion(db.Model):
+    """Change counter for one calendar feed, bumped when its events change."""
+    __tablename__ = 'feed_versions'
+    feed_key = db.Column(db.String, primary_key=True)  # company, user:<id> or team:<manager id>
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+
+class CacheVersion(db.Model):
+    """Current version token of one app_cache scope, shared by every worker
+    process when no shared cache (CACHE_REDIS_URL) is configured."""
+    __tablename__ = 'cache_versions'
+    scope = db.Column(db.String, primary_key=True)  # version:<scope>, e.g. version:balance:12
+    token = db.Column(db.String, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.now, onupdate=datetime.now)
+
+
+class Job(db.Model):
+    """A unit of background work, run by ``flask run-jobs``.
+
+    Jobs are written in the same transaction as the change that causes them,
+    so they exist exactly when that change commits. ``idempotency_key``
+    stops the same job being queued twice.
+    """
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('uq_jobs_idempotency_key', 'idempotency_key', unique=True),
+        # worker poll: due jobs in order
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+        db.Index('ix_jobs_claim_token', 'claim_token'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String, nullable=False)
+    payload = db.Column(db.Text, nullable=False, default='{}')  # JSON
+    status = db.Column(db.String, nullable=False, default='queued')  # queued, running, done, failed
+    idempotency_key = db.Column(db.String, nullable=True)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.now)
+    claim_token = db.Column(db.String, nullable=True)
+    locked_at = db.Column(db.DateTime, nullable=True)
+    last_error = db.Column(db.Text, nullable=True)
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+
+class Holiday(db.Model):
+    """A public holiday in one region; it costs no leave."""
+    __tablename__ = 'holidays'
+    __table_args__ = (
+        db.UniqueConstraint('region', 'day', name='uq_holidays_region_day'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    region = db.Column(db.String, nullable=False)
+    day = db.Column(db.Date, nullable=False)
+    name = db.Column(db.String, nullable=False)
+
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+
+class ReplicaHeartbeat(db.Model):
+    """One row, touched on the primary every few seconds; a replica's copy
+    shows how far behind it is."""
+    __tablename__ = 'replica_heartbeat'
+    id = db.Column(db.Integer, primary_key=True)
+    beat_at = db.Column(db.DateTime, nullable=False)
@@ -0,0 +1,194 @@
+from bisect import bisect_left, bisect_right, insort
+from datetime import date, timedelta
+import threading
+import time
+
+from app import app, db
+from models import LeaveBalance, LeaveRequest, User
+
+# Statuses that occupy a day on the calendar
+ACTIVE_STATUSES = ('pending', 'approved')
+
+
+class IntervalIndex:
+    """Sorted start/end arrays over inclusive date intervals.
+
+    Intervals are short (days to weeks), so the longest span seen bounds how
+    far back from a date a covering interval can start.
+    """
+
+    def __init__(self):
+        self._starts = []
+        self._ends = []
+        self._intervals = {}
+        self._max_span = 0
+
+    def __len__(self):
+        return len(self._intervals)
+
+    def add(self, key, start, end, payload=None):
+        if key in self._intervals:
+            self.remove(key)
+        s, e = start.toordinal(), end.toordinal()
+        self._intervals[key] = (s, e, payload)
+        insort(self._starts, (s, key))
+        insort(self._ends, e)
+        self._max_span = max(self._max_span, e - s)
+
+    def remove(self, key):
+        interval = self._intervals.pop(key, None)
+        if interval is None:
+            return
+        s, e, _ = interval
+        del self._starts[bisect_left(self._starts, (s, key))]
+        del self._ends[bisect_left(self._ends, e)]
+
+    def overlapping(self, start, end):
+        """Keys of intervals sharing at least one day with [start, end]."""
+        s, e = start.toordinal(), end.toordinal()
+        lo = bisect_left(self._starts, (s - self._max_span,))
+        hi = bisect_right(self._starts, (e, float('inf')))
+        return [key for _, key in self._starts[lo:hi] if self._intervals[key][1] >= s]
+
+    def covering(self, day):
+        return self.overlapping(day, day)
+
+    def count_on(self, day):
+        d = day.toordinal()
+        return bisect_right(self._starts, (d, float('inf'))) - bisect_left(self._ends, d)
+
+    def peak_concurrent(self, start, end):
+        """Largest number of intervals covering any single day in [start, end]."""
+        s, e = start.toordinal(), end.toordinal()
+        peak = current = self.count_on(start)
+        lo = bisect_right(self._starts, (s, float('inf')))
+        hi = bisect_right(self._starts, (e, float('inf')))
+        # Interval ends are inclusive, so a departure frees the following day
+        ends = self._ends[bisect_left(self._ends, s):bisect_left(self._ends, e)]
+        arrivals = [start_ord for start_ord, _ in self._starts[lo:hi]]
+        i = j = 0
+        while i < len(arrivals):
+            if j < len(ends) and ends[j] < arrivals[i]:
+                current -= 1
+                j += 1
+            else:
+                current += 1
+                peak = max(peak, current)
+                i += 1
+        return peak
+
+    def payload(self, key):
+        return self._intervals[key][2]
+
+
+def horizon_start():
+    """Earliest day the occupancy index covers: ``OCCUPANCY_HORIZON_DAYS`` (92) before today."""
+    return date.today() - timedelta(days=app.config.get('OCCUPANCY_HORIZON_DAYS', 92))
+
+
+def employee_overlaps(employee_id, start, end):
+    """Ids of the employee's pending/approved leave intersecting [start, end].
+
+    Reads the database rather than a worker's index, so requests submitted
+    through other workers count. The employee's balance row is locked first,
+    so two concurrent submissions by the same employee can't both pass.
+    """
+    db.session.query(LeaveBalance.id).filter(LeaveBalance.user_id == employee_id).with_for_update().first()
+    return [leave_id for (leave_id,) in db.session.query(LeaveRequest.id).filter(
+        LeaveRequest.employee_id == employee_id, LeaveRequest.status.in_(ACTIVE_STATUSES),
+        LeaveRequest.end_date >= start, LeaveRequest.start_date <= end)]
+
+
+def team_peak_absences(employee_id, start, end):
+    """Most of the employee's team (colleagues sharing their manager) out on any day of [start, end].
+
+    Read from the database, for the same reason as ``employee_overlaps``.
+    Employees without a manager are counted against the whole company.
+    """
+    manager_id = db.session.query(User.manager_id).filter(User.id == employee_id).scalar()
+    rows = db.session.query(LeaveRequest.id, LeaveRequest.start_date, LeaveRequest.end_date).filter(
+        LeaveRequest.status.in_(ACTIVE_STATUSES), LeaveRequest.end_date >= start, LeaveRequest.start_date <= end)
+    if manager_id is not None:
+        rows = rows.join(User, User.id == LeaveRequest.employee_id).filter(User.manager_id == manager_id)
+    team = IntervalIndex()
+    for leave_id, start_date, end_date in rows:
+        team.add(leave_id, start_date, end_date)
+    return team.peak_concurrent(start, end)
+
+
+class LeaveOccupancy:
+    """Process-local index of pending and approved leave ending on or after
+    ``horizon_start()``, for the company-wide staffing view.
+
+    Built lazily from the database on first use and kept current by the
+    create/approve/reject routes. Other worker processes cannot update it, so
+    it is rebuilt once it is older than ``OCCUPANCY_MAX_AGE`` seconds; checks
+    that must not miss another worker's writes use the database instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._company = None
+        self._built_at = 0
+
+    def _ensure_built(self):
+        max_age = app.config.get('OCCUPANCY_MAX_AGE', 300)
+        if self._company is not None and time.monotonic() - self._built_at < max_age:
+            return
+        company = IntervalIndex()
+        rows = db.session.query(
+            LeaveRequest.id,
+            LeaveRequest.employee_id,
+            LeaveRequest.start_date,
+            LeaveRequest.end_date,
+        ).filter(LeaveRequest.status.in_(ACTIVE_STATUSES), LeaveRequest.end_date >= horizon_start())
+        for leave_id, employee_id, start_date, end_date in rows:
+            company.add(leave_id, start_date, end_date, employee_id)
+        self._company = company
+        self._built_at = time.monotonic()
+
+    def invalidate(self):
+        with self._lock:
+            self._company = None
+
+    def track(self, leave_request):
+        """Reflect a committed LeaveRequest's current status in the index."""
+        with self._lock:
+            if self._company is None:
+                return
+            if leave_request.status not in ACTIVE_STATUSES:
+                self._company.remove(leave_request.id)
+                return
+            self._company.add(leave_request.id, leave_request.start_date,
+                              leave_request.end_date, leave_request.employee_id)
+
+    def forget(self, leave_id):
+        with self._lock:
+            if self._company is not None:
+                self._company.remove(leave_id)
+
+    def who_is_out(self, day):
+        """Employee ids with pending or approved leave covering ``day``."""
+        with self._lock:
+            self._ensure_built()
+            return sorted({self._company.payload(key) for key in self._company.covering(day)})
+
+    def out_count(self, day):
+        with self._lock:
+            self._ensure_built()
+            return self._company.count_on(day)
+
+    def peak_absences(self, start, end):
+        with self._lock:
+            self._ensure_built()
+            return self._company.peak_concurrent(start, end)
+
+    def daily_counts(self, start, end):
+        with self._lock:
+            self._ensure_built()
+            days = (end - start).days + 1
+            return [(start + timedelta(days=i), self._company.count_on(start + timedelta(days=i)))
+                    for i in range(days)]
+
+
+occupancy = LeaveOccupancy()
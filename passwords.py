@@ -0,0 +1,67 @@
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+import os
+import threading
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from app import app
+
+
+class HashingBusy(Exception):
+    """Raised when the hashing queue is full or a hash timed out; callers should answer 503."""
+
+
+class PasswordHasher:
+    """Runs password hashing on a bounded pool off the request thread.
+
+    Werkzeug's scrypt and pbkdf2 release the GIL, so ``PASSWORD_HASH_WORKERS``
+    threads use that many cores. At most ``PASSWORD_HASH_QUEUE`` further calls
+    may wait; beyond that :class:`HashingBusy` is raised immediately instead of
+    letting a login burst tie up every request worker. It is also raised when
+    a call waits longer than ``PASSWORD_HASH_TIMEOUT`` seconds for its result.
+    """
+
+    def __init__(self, workers=None, queue_size=None):
+        self.workers = workers or app.config.get('PASSWORD_HASH_WORKERS') or os.cpu_count() or 1
+        queue_size = queue_size if queue_size is not None else app.config.get('PASSWORD_HASH_QUEUE', self.workers * 4)
+        self._slots = threading.BoundedSemaphore(self.workers + queue_size)
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='password-hash')
+        self._method_prefix = {}
+
+    @property
+    def method(self):
+        return app.config.get('PASSWORD_HASH_METHOD', 'scrypt')
+
+    def _run(self, fn, *args):
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        try:
+            return future.result(timeout=app.config.get('PASSWORD_HASH_TIMEOUT', 30))
+        except FutureTimeout:
+            # The hash finishes in the background and frees its slot then
+            raise HashingBusy() from None
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, password_hash, password):
+        if not password_hash:
+            return False
+        return self._run(check_password_hash, password_hash, password)
+
+    def needs_rehash(self, password_hash):
+        """True when ``password_hash`` was made with other parameters than the configured method."""
+        method = self.method
+        if method not in self._method_prefix:
+            # Werkzeug fills in default parameters, so read the canonical form off a real hash
+            self._method_prefix[method] = self.hash('').split('$', 1)[0]
+        return password_hash.split('$', 1)[0] != self._method_prefix[method]
+
+
+hasher = PasswordHasher()
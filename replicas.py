@@ -0,0 +1,144 @@
+from datetime import datetime, timedelta
+import logging
+import random
+import threading
+import time
+
+from flask import g, request, session
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import app, db
+from models import ReplicaHeartbeat
+
+logger = logging.getLogger('leaveconnect.replicas')
+
+# Set up from DATABASE_REPLICA_URLS in app.py
+REPLICA_KEYS = sorted(key for key in app.config.get('SQLALCHEMY_BINDS', {}) if key.startswith('replica_'))
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_PIN_KEY = '_primary_until'
+
+_heartbeat = ReplicaHeartbeat.__table__
+
+
+def read_only(view):
+    """Let ``view`` read from a replica. Put it below ``@app.route``."""
+    view.replica_reads = True
+    return view
+
+
+def primary_only(view):
+    """Keep ``view`` on the primary even when ``REPLICA_READ_METHODS`` would route it."""
+    view.replica_reads = False
+    return view
+
+
+class ReplicaMonitor:
+    """Tracks which replicas are close enough to the primary to read from.
+
+    At most every ``REPLICA_CHECK_INTERVAL`` seconds one request per process
+    runs a check while the others keep the last result. The check compares
+    each replica's copy of the primary's heartbeat row with the primary's,
+    then advances the primary's. A replica that lacks the primary's beat is
+    counted as old as the beat it has; more than ``REPLICA_MAX_LAG`` seconds
+    behind, or unreachable, it is skipped until a later check finds it
+    caught up.
+    """
+
+    def __init__(self):
+        self.lag = {}
+        self._healthy = []
+        self._checked = float('-inf')
+        self._lock = threading.Lock()
+
+    def healthy(self):
+        """Engines of the replicas currently fit to read from."""
+        if (time.monotonic() - self._checked >= app.config.get('REPLICA_CHECK_INTERVAL', 2)
+                and self._lock.acquire(blocking=False)):
+            try:
+                self.check()
+            finally:
+                self._lock.release()
+        return self._healthy
+
+    def _beat(self):
+        """Advance the primary's heartbeat; returns its previous value."""
+        now = datetime.now()
+        stale = now - timedelta(seconds=app.config.get('REPLICA_CHECK_INTERVAL', 2))
+        with db.engine.begin() as connection:
+            beat = connection.execute(select(_heartbeat.c.beat_at).where(_heartbeat.c.id == 1)).scalar()
+            if beat is None:
+                connection.execute(insert(_heartbeat).values(id=1, beat_at=now))
+            elif beat < stale:
+                # Conditional, so many processes checking still write about once per interval
+                connection.execute(update(_heartbeat).where(_heartbeat.c.id == 1, _heartbeat.c.beat_at < stale)
+                                   .values(beat_at=now))
+        return beat
+
+    def check(self):
+        self._checked = time.monotonic()
+        try:
+            primary_beat = self._beat()
+        except SQLAlchemyError:
+            # Another process may have created the row first; keep the last result
+            logger.warning('Could not update the replica heartbeat', exc_info=True)
+            return
+        if primary_beat is None:
+            return
+
+        max_lag = app.config.get('REPLICA_MAX_LAG', 5)
+        healthy, lag = [], {}
+        for key in REPLICA_KEYS:
+            engine = db.engines[key]
+            try:
+                with engine.connect() as connection:
+                    beat = connection.execute(select(_heartbeat.c.beat_at).where(_heartbeat.c.id == 1)).scalar()
+            except SQLAlchemyError as error:
+                logger.warning('Replica %s is unreachable: %s', key, error)
+                beat = None
+            if beat is None:
+                lag[key] = float('inf')
+            elif beat >= primary_beat:
+                lag[key] = 0.0
+            else:
+                # Missing a beat the primary has: at most as fresh as the last beat it has
+                lag[key] = (datetime.now() - beat).total_seconds()
+            if lag[key] <= max_lag:
+                healthy.append(engine)
+            elif self.lag.get(key, 0.0) <= max_lag:
+                logger.warning('Replica %s is %.1fs behind; reading from the primary instead', key, lag[key])
+        self.lag, self._healthy = lag, healthy
+
+
+monitor = ReplicaMonitor()
+
+
+def pinned():
+    """True while this browser session must read its own recent writes."""
+    return session.get(_PIN_KEY, 0) > time.time()
+
+
+@app.before_request
+def route_reads():
+    """Choose a replica for the reads of this request, if it may use one."""
+    g.db_replica = None
+    if not REPLICA_KEYS or request.endpoint in ('asset', 'static'):
+        return
+    reads = getattr(app.view_functions.get(request.endpoint), 'replica_reads', None)
+    if reads is None:
+        reads = request.method in app.config.get('REPLICA_READ_METHODS', ())
+    if not reads or pinned():
+        return
+    healthy = monitor.healthy()
+    if healthy:
+        g.db_replica = random.choice(healthy)
+
+
+@app.after_request
+def pin_writers(response):
+    # Replicas may not have this request's writes yet; read from the primary for a while
+    if REPLICA_KEYS and (g.get('db_wrote') or request.method not in SAFE_METHODS):
+        session[_PIN_KEY] = time.time() + app.config.get('REPLICA_PIN_SECONDS', 10)
+    return response
@@ -1,11 +1,34 @@
-from flask import render_template, request, redirect, url_for, flash, jsonify, session
+from flask import render_template, request, redirect, url_for, flash, jsonify, session, abort, stream_with_context
 from app import app, db
 from flask_login import current_user, login_required, login_user, logout_user
-from models import LeaveRequest, LeaveBalance, User
-from datetime import datetime
+from models import ArchivedLeaveRequest, LeaveRequest, LeaveBalance, User
+from occupancy import employee_overlaps, horizon_start, occupancy, team_peak_absences
+from decisions import decide, DECISION_STATUSES
+from ledger import BALANCE_COLUMNS, open_account
+import analytics
+import app_cache
+import archive
+import assets  # registers asset_url and /assets
+import exports
+import feeds
+import jobs
+import live
+from replicas import primary_only, read_only
+import search
+import workdays
+from user_cache import user_cache
+from passwords import HashingBusy
+from datetime import datetime, date, timedelta
+from sqlalchemy import func, select, true, tuple_
+from sqlalchemy.orm import aliased, joinedload
+import hashlib
+import json
 
 @app.before_request
 def make_session_permanent():
+    # Touching the session would add Set-Cookie and Vary: Cookie to shared, cacheable assets
+    if request.endpoint in ('asset', 'static'):
+        return
     session.permanent = True
 
 @app.route('/')
@@ -26,13 +49,35 @@ def register():
             flash('Email address already exists.', 'error')
             return redirect(url_for('register'))
         new_user = User(email=email)
-        new_user.set_password(password)
+        open_account(new_user)
+        try:
+            new_user.set_password(password)
+        except HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('register.html'), 503
         db.session.add(new_user)
         db.session.commit()
         flash('Registration successful! Please log in.', 'success')
         return redirect(url_for('login'))
     return render_template('register.html')
 
+@app.route('/invite/<token>', methods=['GET', 'POST'])
+def accept_invite(token):
+    user = User.query.filter_by(invite_token=token).first()
+    if user is None:
+        abort(404)
+    if request.method == 'POST':
+        try:
+            user.set_password(request.form.get('password'))
+        except HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('accept_invite.html', email=user.email), 503
+        user.invite_token = None
+        db.session.commit()
+        login_user(user, remember=True)
+        return redirect(url_for('dashboard'))
+    return render_template('accept_invite.html', email=user.email)
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
@@ -41,7 +86,16 @@ def login():
         email = request.form.get('email')
         password = request.form.get('password')
         user = User.query.filter_by(email=email).first()
-        if user and user.check_password(password):
+        try:
+            authenticated = user is not None and user.check_password(password)
+            if authenticated and user.password_needs_rehash():
+                # Upgrade hashes made under an older PASSWORD_HASH_METHOD
+                user.set_password(password)
+                db.session.commit()
+        except HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('login.html'), 503
+        if authenticated:
             login_user(user, remember=True)
             return redirect(url_for('dashboard'))
         flash('Invalid email or password.', 'error')
@@ -52,18 +106,67 @@ def logout():
     logout_user()
     return redirect(url_for('index'))
 
+def _dashboard_snapshot(user_id, cursor, page_size):
+    """Balance, per-status counts and one history page in a single statement."""
+    page = LeaveRequest.query.filter(LeaveRequest.employee_id == user_id)
+    position = _decode_cursor(cursor)
+    if position and not _is_archive_cursor(cursor):
+        page = page.filter(tuple_(LeaveRequest.created_at, LeaveRequest.id) < position)
+    # Past the live rows, _with_archived pages the rest
+    limit = 0 if _is_archive_cursor(cursor) else page_size + 1
+    page = page.order_by(LeaveRequest.created_at.desc(), LeaveRequest.id.desc()).limit(limit).subquery()
+    page_request = aliased(LeaveRequest, page)
+
+    def status_count(status):
+        live = select(func.count(LeaveRequest.id)).where(
+            LeaveRequest.employee_id == user_id, LeaveRequest.status == status).scalar_subquery()
+        archived = select(func.count(ArchivedLeaveRequest.id)).where(
+            ArchivedLeaveRequest.employee_id == user_id, ArchivedLeaveRequest.status == status).scalar_subquery()
+        return live + archived
+
+    rows = db.session.execute(
+        select(LeaveBalance, status_count('pending'), status_count('approved'), status_count('rejected'), page_request)
+        .select_from(User)
+        .outerjoin(LeaveBalance, LeaveBalance.user_id == User.id)
+        .outerjoin(page_request, true())
+        .where(User.id == user_id)
+        .order_by(page_request.created_at.desc(), page_request.id.desc())
+    ).all()
+
+    balance = rows[0][0] if rows else None
+    counts = dict(zip(('pending', 'approved', 'rejected'), rows[0][1:4])) if rows else {}
+    leave_requests = [row[4] for row in rows if row[4] is not None]
+    next_cursor = _encode_cursor(leave_requests[page_size - 1]) if len(leave_requests) > page_size else None
+    return balance, counts, leave_requests[:page_size], next_cursor
+
+def _dashboard_view(user_id, cursor, page_size):
+    """The dashboard snapshot as plain values, cached until the user's balance or requests change."""
+    def load():
+        balance, counts, leave_requests, next_cursor = _dashboard_snapshot(user_id, cursor, page_size)
+        leave_requests, next_cursor = _with_archived(
+            leave_requests, next_cursor, cursor, page_size, [ArchivedLeaveRequest.employee_id == user_id])
+        balance = {column.key: getattr(balance, column.key) for column in BALANCE_COLUMNS.values()} if balance else None
+        rows = [{name: getattr(leave_request, name) for name in (
+            'id', 'leave_type', 'start_date', 'end_date', 'days_count', 'reason', 'status', 'manager_comments',
+            'created_at')} for leave_request in leave_requests]
+        return balance, counts, rows, next_cursor
+
+    return app_cache.app_cache.get_or_load(
+        f'dashboard:{user_id}:{cursor}:{page_size}',
+        [app_cache.table_scope('leave_balances'), app_cache.table_scope('leave_requests'),
+         app_cache.balance_scope(user_id), app_cache.requests_scope(user_id)],
+        load)
+
 @app.route('/dashboard')
+@read_only
 @login_required
 def dashboard():
-    balance = LeaveBalance.query.filter_by(user_id=current_user.id).first()
-    if not balance:
-        balance = LeaveBalance(user_id=current_user.id)
-        db.session.add(balance)
-        db.session.commit()
-    
-    leave_requests = LeaveRequest.query.filter_by(employee_id=current_user.id).order_by(LeaveRequest.created_at.desc()).all()
+    cursor = request.args.get('cursor')
+    balance, counts, leave_requests, next_cursor = _dashboard_view(
+        current_user.id, cursor, app.config.get('DASHBOARD_PAGE_SIZE', 20))
     
-    return render_template('dashboard.html', user=current_user, balance=balance, leave_requests=leave_requests)
+    return render_template('dashboard.html', user=current_user, balance=balance, leave_requests=leave_requests,
+                           counts=counts, cursor=cursor, next_cursor=next_cursor)
 
 @app.route('/request-leave', methods=['GET', 'POST'])
 @login_required
@@ -78,48 +181,192 @@ def request_leave():
             flash('End date must be after start date', 'error')
             return redirect(url_for('request_leave'))
         
-        days_count = (end_date - start_date).days + 1
-        balance = LeaveBalance.query.filter_by(user_id=current_user.id).first()
-        
-        available_balance = 0
-        if leave_type == 'sick':
-            available_balance = balance.sick_leave
-        elif leave_type == 'vacation':
-            available_balance = balance.vacation_leave
-        elif leave_type == 'personal':
-            available_balance = balance.personal_leave
+        if leave_type not in BALANCE_COLUMNS:
+            flash('Please choose a valid leave type.', 'error')
+            return redirect(url_for('request_leave'))
+
+        region = workdays.region_of(current_user)
+        days_count = workdays.duration(start_date, end_date, region)
+        if days_count == 0:
+            flash('The selected dates are all weekends or holidays; no leave is needed.', 'error')
+            return redirect(url_for('request_leave'))
+        balance = app_cache.balance(current_user.id)
+        available_balance = (balance or {}).get(BALANCE_COLUMNS[leave_type].key) or 0
         
         if days_count > available_balance:
             flash(f'Insufficient {leave_type} leave balance. You have {available_balance} days available.', 'error')
             return redirect(url_for('request_leave'))
+
+        if employee_overlaps(current_user.id, start_date, end_date):
+            flash('You already have pending or approved leave during these dates.', 'error')
+            return redirect(url_for('request_leave'))
+
+        max_absences = app.config.get('MAX_CONCURRENT_ABSENCES')
+        if max_absences and team_peak_absences(current_user.id, start_date, end_date) >= max_absences:
+            flash(f'Too many of your team are already out during these dates (limit {max_absences}).', 'error')
+            return redirect(url_for('request_leave'))
         
         leave_request = LeaveRequest(
             employee_id=current_user.id,
             leave_type=leave_type,
             start_date=start_date,
             end_date=end_date,
-            reason=reason
+            reason=reason,
+            working_days=days_count,
+            month_days=analytics.month_days(start_date, end_date, region)
         )
         db.session.add(leave_request)
+        db.session.flush()
+        analytics.record_created(leave_request)
+        jobs.leave_submitted(leave_request)
         db.session.commit()
+        occupancy.track(leave_request)
+        _publish_changes([leave_request], 'submitted')
         
         flash('Leave request submitted successfully!', 'success')
         return redirect(url_for('dashboard'))
     
-    balance = LeaveBalance.query.filter_by(user_id=current_user.id).first()
-    return render_template('request_leave.html', balance=balance)
+    return render_template('request_leave.html', balance=app_cache.balance(current_user.id))
+
+def _encode_cursor(leave_request):
+    return f"{leave_request.created_at.isoformat()}_{leave_request.id}"
+
+def _decode_cursor(value):
+    if not value:
+        return None
+    if value.startswith(archive.CURSOR_PREFIX):
+        value = value[len(archive.CURSOR_PREFIX):]
+    try:
+        created_at, leave_id = value.rsplit('_', 1)
+        return datetime.fromisoformat(created_at), int(leave_id)
+    except ValueError:
+        return None
+
+def _is_archive_cursor(value):
+    return bool(value) and value.startswith(archive.CURSOR_PREFIX)
+
+def _with_archived(rows, next_cursor, cursor, page_size, criteria):
+    """Continue a newest-first history page into the archive once the live rows run out.
+
+    ``rows`` and ``next_cursor`` are the live page; ``criteria`` filter the
+    archived requests the same way.
+    """
+    if _is_archive_cursor(cursor):
+        rows = archive.page(criteria, _decode_cursor(cursor), page_size + 1)
+    elif next_cursor is None:
+        rows = rows + archive.page(criteria, None, page_size - len(rows) + 1)
+    else:
+        return rows, next_cursor
+    if len(rows) <= page_size:
+        return rows, None
+    last = rows[page_size - 1]
+    if isinstance(last, ArchivedLeaveRequest):
+        return rows[:page_size], archive.CURSOR_PREFIX + _encode_cursor(last)
+    return rows[:page_size], _encode_cursor(last)
+
+def _keyset_page(query, cursor, page_size, archived=None):
+    """Newest-first page of LeaveRequests strictly after ``cursor``.
+
+    With ``archived`` (criteria on ArchivedLeaveRequest), paging carries on
+    into the archive after the last live row. Returns the rows and the
+    cursor for the following page (None when done).
+    """
+    if archived is not None and _is_archive_cursor(cursor):
+        return _with_archived([], None, cursor, page_size, archived)
+    position = _decode_cursor(cursor)
+    if position:
+        query = query.filter(tuple_(LeaveRequest.created_at, LeaveRequest.id) < position)
+    rows = query.order_by(LeaveRequest.created_at.desc(), LeaveRequest.id.desc()).limit(page_size + 1).all()
+    next_cursor = _encode_cursor(rows[page_size - 1]) if len(rows) > page_size else None
+    rows = rows[:page_size]
+    if archived is not None:
+        return _with_archived(rows, next_cursor, cursor, page_size, archived)
+    return rows, next_cursor
 
 @app.route('/manager')
+@read_only
 @login_required
 def manager_dashboard():
     if current_user.role != 'manager':
         flash('Access denied. Manager privileges required.', 'error')
         return redirect(url_for('dashboard'))
-    
-    pending_requests = LeaveRequest.query.filter_by(status='pending').order_by(LeaveRequest.created_at.desc()).all()
-    all_requests = LeaveRequest.query.order_by(LeaveRequest.created_at.desc()).limit(50).all()
-    
-    return render_template('manager_dashboard.html', pending_requests=pending_requests, all_requests=all_requests)
+
+    page_size = app.config.get('MANAGER_PAGE_SIZE', 25)
+    pending_cursor = request.args.get('pending_cursor')
+    history_cursor = request.args.get('history_cursor')
+
+    pending_requests, next_pending_cursor = _keyset_page(
+        LeaveRequest.query.filter_by(status='pending').options(joinedload(LeaveRequest.employee)),
+        pending_cursor, page_size)
+    all_requests, next_history_cursor = _keyset_page(
+        LeaveRequest.query.options(joinedload(LeaveRequest.employee), joinedload(LeaveRequest.manager)),
+        history_cursor, page_size, archived=[])
+    pending_total = app_cache.pending_total()
+
+    return render_template('manager_dashboard.html', pending_requests=pending_requests, all_requests=all_requests,
+                           pending_total=pending_total, pending_cursor=pending_cursor, history_cursor=history_cursor,
+                           next_pending_cursor=next_pending_cursor, next_history_cursor=next_history_cursor)
+
+@app.route('/manager/requests/<int:request_id>/<decision>-form')
+@read_only
+@login_required
+def decision_form(request_id, decision):
+    if current_user.role != 'manager':
+        return jsonify({'error': 'Unauthorized'}), 403
+    if decision not in ('approve', 'reject'):
+        abort(404)
+
+    leave_request = LeaveRequest.query.options(joinedload(LeaveRequest.employee)).filter_by(id=request_id).first_or_404()
+    return render_template('_decision_form.html', leave_request=leave_request, decision=decision)
+
+DECISION_MESSAGES = {
+    'approved': ('Leave request approved successfully!', 'success'),
+    'rejected': ('Leave request rejected.', 'success'),
+    'already_decided': ('This leave request has already been decided.', 'error'),
+    'insufficient_balance': ('The employee no longer has enough leave balance for this request.', 'error'),
+}
+
+def _publish_changes(leave_requests, event_type):
+    """Tell open manager dashboards about committed changes, with their table rows."""
+    pending_total = app_cache.pending_total()
+    for leave_request in leave_requests:
+        data = {'id': leave_request.id, 'status': leave_request.status, 'pending_total': pending_total,
+                'history_row': render_template('_history_row.html', leave_request=leave_request)}
+        if event_type == 'submitted':
+            data['pending_row'] = render_template('_pending_row.html', leave_request=leave_request)
+        live.hub.publish(event_type, data)
+
+def _apply_decisions(request_ids, decision, comments):
+    results = decide(request_ids, decision, current_user.id, comments)
+    status = DECISION_STATUSES[decision]
+    decided = [request_id for request_id, outcome in results.items() if outcome == status]
+    if not decided:
+        return results
+    leave_requests = LeaveRequest.query.options(joinedload(LeaveRequest.employee), joinedload(LeaveRequest.manager)) \
+        .filter(LeaveRequest.id.in_(decided)).order_by(LeaveRequest.created_at, LeaveRequest.id).all()
+    if status == 'rejected':
+        # Rejected leave no longer occupies the calendar
+        for leave_request in leave_requests:
+            occupancy.forget(leave_request.id)
+    _publish_changes(leave_requests, status)
+    return results
+
+def _decision_response(request_id, outcome):
+    """Redirect a form post to the dashboard; answer XHR with the request's new history row or JSON."""
+    if outcome == 'not_found':
+        abort(404)
+    message, category = DECISION_MESSAGES[outcome]
+    decided = outcome in DECISION_STATUSES.values()
+    if request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json':
+        return jsonify({'id': request_id, 'outcome': outcome, 'message': message}), 200 if decided else 409
+    if request.headers.get('X-Requested-With') != 'XMLHttpRequest':
+        flash(message, category)
+        return redirect(url_for('manager_dashboard'))
+    if not decided:
+        return app.response_class(message, status=409, mimetype='text/plain')
+    leave_request = LeaveRequest.query.options(joinedload(LeaveRequest.employee), joinedload(LeaveRequest.manager)) \
+        .filter_by(id=request_id).one()
+    return render_template('_history_row.html', leave_request=leave_request)
 
 @app.route('/manager/approve/<int:request_id>', methods=['POST'])
 @login_required
@@ -127,26 +374,8 @@ def approve_leave(request_id):
     if current_user.role != 'manager':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    leave_request = LeaveRequest.query.get_or_404(request_id)
-    comments = request.form.get('comments', '')
-    
-    leave_request.status = 'approved'
-    leave_request.manager_id = current_user.id
-    leave_request.manager_comments = comments
-    
-    balance = LeaveBalance.query.filter_by(user_id=leave_request.employee_id).first()
-    days_count = leave_request.days_count
-    
-    if leave_request.leave_type == 'sick':
-        balance.sick_leave -= days_count
-    elif leave_request.leave_type == 'vacation':
-        balance.vacation_leave -= days_count
-    elif leave_request.leave_type == 'personal':
-        balance.personal_leave -= days_count
-    
-    db.session.commit()
-    flash('Leave request approved successfully!', 'success')
-    return redirect(url_for('manager_dashboard'))
+    outcome = _apply_decisions([request_id], 'approve', request.form.get('comments', ''))[request_id]
+    return _decision_response(request_id, outcome)
 
 @app.route('/manager/reject/<int:request_id>', methods=['POST'])
 @login_required
@@ -154,48 +383,314 @@ def reject_leave(request_id):
     if current_user.role != 'manager':
         return jsonify({'error': 'Unauthorized'}), 403
     
-    leave_request = LeaveRequest.query.get_or_404(request_id)
-    comments = request.form.get('comments', '')
-    
-    leave_request.status = 'rejected'
-    leave_request.manager_id = current_user.id
-    leave_request.manager_comments = comments
-    
-    db.session.commit()
-    flash('Leave request rejected.', 'success')
+    outcome = _apply_decisions([request_id], 'reject', request.form.get('comments', ''))[request_id]
+    return _decision_response(request_id, outcome)
+
+@app.route('/manager/events')
+@login_required
+def manager_events():
+    """Server-Sent Events: new, approved and rejected leave requests as they happen."""
+    if current_user.role != 'manager':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    try:
+        last_event_id = int(request.headers.get('Last-Event-ID', ''))
+    except ValueError:
+        last_event_id = None
+    opened = live.hub.open(last_event_id)
+    if opened is None:
+        return app.response_class('Too many live streams; try again later.\n', status=503, mimetype='text/plain')
+    # The stream can stay open for minutes; don't hold a pooled connection meanwhile
+    db.session.close()
+    response = app.response_class(stream_with_context(live.events(*opened)), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/manager/decisions', methods=['POST'])
+@login_required
+def bulk_decide():
+    if current_user.role != 'manager':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    payload = request.get_json(silent=True) if request.is_json else None
+    if payload is not None:
+        decision = payload.get('decision')
+        raw_ids = payload.get('ids') or []
+    else:
+        decision = request.form.get('decision')
+        raw_ids = request.form.getlist('ids')
+    try:
+        request_ids = [int(request_id) for request_id in raw_ids]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'ids must be integers'}), 400
+    if decision not in DECISION_STATUSES or not request_ids:
+        return jsonify({'error': 'decision must be approve or reject and ids must not be empty'}), 400
+    if len(request_ids) > app.config.get('MAX_BULK_DECISIONS', 500):
+        return jsonify({'error': 'Too many requests in one batch'}), 400
+
+    comments = payload.get('comments', '') if payload is not None else request.form.get('comments', '')
+    results = _apply_decisions(request_ids, decision, comments)
+    if payload is not None:
+        return jsonify({'results': [{'id': request_id, 'outcome': outcome} for request_id, outcome in results.items()]})
+
+    done = sum(1 for outcome in results.values() if outcome == DECISION_STATUSES[decision])
+    flash(f'{done} of {len(results)} leave requests {DECISION_STATUSES[decision]}.', 'success' if done == len(results) else 'error')
     return redirect(url_for('manager_dashboard'))
 
+def _analytics_range():
+    this_month = analytics.month_start(date.today())
+    last_month = analytics.parse_month(request.args.get('to'), this_month)
+    first_month = analytics.parse_month(request.args.get('from'), last_month.replace(year=last_month.year - 1))
+    return first_month, last_month
+
+@app.route('/manager/analytics')
+@read_only
+@login_required
+def leave_analytics():
+    if current_user.role != 'manager':
+        flash('Access denied. Manager privileges required.', 'error')
+        return redirect(url_for('dashboard'))
+
+    try:
+        first_month, last_month = _analytics_range()
+    except ValueError:
+        flash('Months must be given as YYYY-MM.', 'error')
+        return redirect(url_for('leave_analytics'))
+    status = request.args.get('status', 'approved')
+    usage = analytics.monthly_usage(first_month, last_month, status)
+    top = analytics.top_employees(first_month, last_month, status)
+    return render_template('analytics.html', usage=usage, top=top, status=status,
+                           month_labels=[month.strftime('%b %Y') for month in usage],
+                           first_month=first_month, last_month=last_month, leave_types=list(BALANCE_COLUMNS))
+
+@app.route('/api/analytics/leave-usage')
+@read_only
+@login_required
+def leave_usage_api():
+    if current_user.role != 'manager':
+        return jsonify({'error': 'Unauthorized'}), 403
+
+    try:
+        first_month, last_month = _analytics_range()
+    except ValueError:
+        return jsonify({'error': 'from and to must be YYYY-MM'}), 400
+    usage = analytics.monthly_usage(first_month, last_month, request.args.get('status', 'approved'))
+    return jsonify([{'month': month.strftime('%Y-%m'), 'days': days} for month, days in usage.items()])
+
+def _export_filters(args):
+    return {
+        'start': _parse_window_date(args.get('from')),
+        'end': _parse_window_date(args.get('to')),
+        'status': args.get('status') or None,
+        'employee_email': args.get('employee') or None,
+    }
+
+@app.route('/manager/export.<fmt>')
+@read_only
+@login_required
+def export_leave(fmt):
+    if current_user.role != 'manager':
+        return jsonify({'error': 'Unauthorized'}), 403
+    if fmt not in exports.FORMATS:
+        abort(404)
+
+    try:
+        filters = _export_filters(request.args)
+    except ValueError:
+        return jsonify({'error': 'from and to must be ISO dates'}), 400
+    rows = exports.leave_rows(**filters, batch_size=app.config.get('EXPORT_BATCH_SIZE', 1000))
+    response = app.response_class(stream_with_context(exports.render(fmt, rows)), mimetype=exports.FORMATS[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename=leave-requests-{date.today().isoformat()}.{fmt}'
+    return response
+
+@app.route('/manager/search')
+@read_only
+@login_required
+def search_requests():
+    if current_user.role != 'manager':
+        flash('Access denied. Manager privileges required.', 'error')
+        return redirect(url_for('dashboard'))
+
+    text = request.args.get('q', '').strip()
+    status = request.args.get('status') if request.args.get('status') in ('pending', 'approved', 'rejected') else None
+    leave_type = request.args.get('leave_type') if request.args.get('leave_type') in BALANCE_COLUMNS else None
+    try:
+        start = _parse_window_date(request.args.get('from'))
+        end = _parse_window_date(request.args.get('to'))
+    except ValueError:
+        flash('Dates must be given as YYYY-MM-DD.', 'error')
+        start = end = None
+    cursor = request.args.get('cursor')
+    results, next_cursor = search.search(text, status=status, leave_type=leave_type, start=start, end=end,
+                                         cursor=cursor, page_size=app.config.get('MANAGER_PAGE_SIZE', 25))
+    filters = {'q': text, 'status': status, 'leave_type': leave_type,
+               'from': start.isoformat() if start else None, 'to': end.isoformat() if end else None}
+    return render_template('search.html', results=results, filters=filters, cursor=cursor,
+                           next_cursor=next_cursor, leave_types=list(BALANCE_COLUMNS))
+
+@app.route('/manager/staffing')
+@read_only
+@login_required
+def staffing():
+    if current_user.role != 'manager':
+        flash('Access denied. Manager privileges required.', 'error')
+        return redirect(url_for('dashboard'))
+
+    try:
+        start = _parse_window_date(request.args.get('start')) or date.today()
+    except ValueError:
+        start = date.today()
+    # The occupancy index doesn't reach further back
+    start = max(start, horizon_start())
+    days = min(max(request.args.get('days', 14, type=int), 1), 92)
+    end = start + timedelta(days=days - 1)
+
+    daily = occupancy.daily_counts(start, end)
+    selected = request.args.get('day')
+    try:
+        selected_day = _parse_window_date(selected) or start
+    except ValueError:
+        selected_day = start
+    out_ids = occupancy.who_is_out(selected_day)
+    out_users = User.query.filter(User.id.in_(out_ids)).order_by(User.first_name, User.email).all() if out_ids else []
+
+    return render_template('staffing.html', daily=daily, start=start, end=end, days=days,
+                           peak=occupancy.peak_absences(start, end),
+                           selected_day=selected_day, out_users=out_users)
+
 @app.route('/calendar')
+@read_only
 @login_required
 def calendar():
-    approved_leaves = LeaveRequest.query.filter_by(status='approved').all()
-    return render_template('calendar.html', approved_leaves=approved_leaves)
+    return render_template('calendar.html')
+
+def _parse_window_date(value):
+    # FullCalendar sends ISO8601 timestamps; only the date part matters here
+    if not value:
+        return None
+    return datetime.strptime(value[:10], '%Y-%m-%d').date()
+
+def _approved_window(window_start, window_end):
+    """(ETag, last modified, JSON body) of the approved leave overlapping a window."""
+    def load():
+        filters = [LeaveRequest.status == 'approved']
+        if window_start:
+            filters.append(LeaveRequest.end_date >= window_start)
+        if window_end:
+            filters.append(LeaveRequest.start_date < window_end)
+
+        rows = db.session.query(
+            LeaveRequest.leave_type,
+            LeaveRequest.start_date,
+            LeaveRequest.end_date,
+            User.first_name,
+            User.email,
+            LeaveRequest.updated_at,
+            User.updated_at,
+        ).join(User, LeaveRequest.employee_id == User.id).filter(*filters).all()
+
+        leaves_updated = max((row[5] for row in rows if row[5]), default=None)
+        users_updated = max((row[6] for row in rows if row[6]), default=None)
+        last_modified = max((ts for ts in (leaves_updated, users_updated) if ts), default=None)
+        version = f"{window_start}:{window_end}:{len(rows)}:{leaves_updated}:{users_updated}"
+
+        events = []
+        for leave_type, start_date, end_date, first_name, email, _, _ in rows:
+            events.append({
+                'title': f"{first_name or email} - {leave_type.capitalize()}",
+                'start': start_date.isoformat(),
+                'end': end_date.isoformat(),
+                'color': '#3b82f6' if leave_type == 'vacation' else '#ef4444' if leave_type == 'sick' else '#8b5cf6'
+            })
+        return hashlib.sha1(version.encode()).hexdigest(), last_modified, json.dumps(events)
+
+    return app_cache.app_cache.get_or_load(
+        f'calendar:{window_start}:{window_end}',
+        [app_cache.table_scope('leave_requests'), app_cache.table_scope('users'), 'approved'],
+        load)
 
 @app.route('/api/calendar-events')
+@read_only
 @login_required
 def calendar_events():
-    approved_leaves = LeaveRequest.query.filter_by(status='approved').all()
-    events = []
-    
-    for leave in approved_leaves:
-        employee = User.query.get(leave.employee_id)
-        events.append({
-            'title': f"{employee.first_name or employee.email} - {leave.leave_type.capitalize()}",
-            'start': leave.start_date.isoformat(),
-            'end': leave.end_date.isoformat(),
-            'color': '#3b82f6' if leave.leave_type == 'vacation' else '#ef4444' if leave.leave_type == 'sick' else '#8b5cf6'
-        })
-    
-    return jsonify(events)
+    try:
+        window_start = _parse_window_date(request.args.get('start'))
+        window_end = _parse_window_date(request.args.get('end'))
+    except ValueError:
+        return jsonify({'error': 'start and end must be ISO dates'}), 400
+
+    # Unchanged windows are answered from the cache without touching the database
+    etag, last_modified, body = _approved_window(window_start, window_end)
+
+    response = app.response_class(mimetype='application/json')
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+
+    response.set_data(body)
+    return response
+
+@app.route('/calendar/subscribe', methods=['GET', 'POST'])
+@primary_only
+@login_required
+def calendar_subscribe():
+    user = db.session.get(User, current_user.id)
+    if request.method == 'POST':
+        # Rotating the token revokes every existing subscription link
+        user.calendar_token = None
+    if not user.calendar_token:
+        feeds.ensure_token(user)
+        db.session.commit()
+        if request.method == 'POST':
+            flash('Calendar links reset. Re-subscribe with the new links.', 'success')
+            return redirect(url_for('calendar_subscribe'))
+
+    scopes = [scope for scope in feeds.SCOPES if scope != 'team' or current_user.role == 'manager']
+    urls = {scope: url_for('calendar_feed', token=user.calendar_token, scope=scope, _external=True) for scope in scopes}
+    return render_template('calendar_feeds.html', urls=urls)
+
+@app.route('/feeds/<token>/<scope>.ics')
+@read_only
+def calendar_feed(token, scope):
+    if scope not in feeds.SCOPES:
+        abort(404)
+    user = db.session.query(User.id, User.role).filter_by(calendar_token=token).first()
+    if user is None:
+        abort(404)
+    if scope == 'team' and user.role != 'manager':
+        abort(403)
+
+    key = feeds.feed_key(scope, user)
+    version, updated_at = feeds.version_of(key)
+    since = feeds.window_start()
+    etag = feeds.etag_for(key, version, since)
+
+    response = app.response_class(mimetype='text/calendar')
+    response.set_etag(etag)
+    response.last_modified = updated_at
+    response.cache_control.private = True
+    response.cache_control.max_age = app.config.get('FEED_MAX_AGE', 300)
+    response.make_conditional(request)
+    if response.status_code == 304:
+        return response
+
+    response.set_data(feeds.cached_render(scope, user, etag, since))
+    return response
 
 @app.route('/toggle-role')
+@primary_only
 @login_required
 def toggle_role():
-    if current_user.role == 'employee':
-        current_user.role = 'manager'
-    else:
-        current_user.role = 'employee'
+    new_role = 'manager' if current_user.role == 'employee' else 'employee'
+    User.query.filter_by(id=current_user.id).update({'role': new_role})
     db.session.commit()
-    flash(f'Role switched to {current_user.role}', 'success')
+    user_cache.invalidate(current_user.id)
+    flash(f'Role switched to {new_role}', 'success')
     return redirect(url_for('dashboard'))
 
@@ -0,0 +1,192 @@
+import re
+
+from sqlalchemy import cast, column, func, literal_column, select, table, tuple_
+from sqlalchemy.dialects.postgresql import REGCONFIG
+from sqlalchemy.orm import joinedload
+
+from app import db
+from models import LeaveRequest
+
+TERM = re.compile(r'\w+')
+
+# Relative weight of reason, manager comments, employee name and email in SQLite's ranking
+_SQLITE_WEIGHTS = (1.0, 0.5, 2.0, 2.0)
+
+_SQLITE_DDL = (
+    # Rowid is the leave request id; the index keeps its own copy of the text
+    """CREATE VIRTUAL TABLE IF NOT EXISTS leave_search USING fts5(
+        reason, manager_comments, employee_name, employee_email, tokenize='porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS leave_search_insert AFTER INSERT ON leave_requests BEGIN
+        INSERT INTO leave_search (rowid, reason, manager_comments, employee_name, employee_email)
+        SELECT NEW.id, NEW.reason, COALESCE(NEW.manager_comments, ''),
+               TRIM(COALESCE(u.first_name, '') || ' ' || COALESCE(u.last_name, '')), u.email
+        FROM users AS u WHERE u.id = NEW.employee_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS leave_search_update
+    AFTER UPDATE OF reason, manager_comments, employee_id ON leave_requests BEGIN
+        DELETE FROM leave_search WHERE rowid = OLD.id;
+        INSERT INTO leave_search (rowid, reason, manager_comments, employee_name, employee_email)
+        SELECT NEW.id, NEW.reason, COALESCE(NEW.manager_comments, ''),
+               TRIM(COALESCE(u.first_name, '') || ' ' || COALESCE(u.last_name, '')), u.email
+        FROM users AS u WHERE u.id = NEW.employee_id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS leave_search_delete AFTER DELETE ON leave_requests BEGIN
+        DELETE FROM leave_search WHERE rowid = OLD.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS leave_search_user AFTER UPDATE OF first_name, last_name, email ON users BEGIN
+        UPDATE leave_search
+        SET employee_name = TRIM(COALESCE(NEW.first_name, '') || ' ' || COALESCE(NEW.last_name, '')),
+            employee_email = NEW.email
+        WHERE rowid IN (SELECT id FROM leave_requests WHERE employee_id = NEW.id);
+    END""",
+)
+
+_SQLITE_FILL = """
+    INSERT INTO leave_search (rowid, reason, manager_comments, employee_name, employee_email)
+    SELECT r.id, r.reason, COALESCE(r.manager_comments, ''),
+           TRIM(COALESCE(u.first_name, '') || ' ' || COALESCE(u.last_name, '')), u.email
+    FROM leave_requests AS r JOIN users AS u ON u.id = r.employee_id
+"""
+
+# Names and emails are indexed unstemmed ('simple'); free text with English stemming.
+# Weights A-C rank a name match above the reason, and the reason above comments.
+_POSTGRES_DOCUMENT = """
+    setweight(to_tsvector('simple', concat_ws(' ', u.first_name, u.last_name,
+                                              regexp_replace(u.email, '[@.]', ' ', 'g'))), 'A')
+    || setweight(to_tsvector('english', r.reason), 'B')
+    || setweight(to_tsvector('english', coalesce(r.manager_comments, '')), 'C')
+"""
+
+_POSTGRES_DDL = (
+    """CREATE TABLE IF NOT EXISTS leave_search (
+        leave_request_id INTEGER PRIMARY KEY REFERENCES leave_requests (id) ON DELETE CASCADE,
+        document TSVECTOR NOT NULL)""",
+    'CREATE INDEX IF NOT EXISTS ix_leave_search_document ON leave_search USING GIN (document)',
+    f"""CREATE OR REPLACE FUNCTION leave_search_sync() RETURNS trigger AS $$
+    BEGIN
+        IF TG_TABLE_NAME = 'users' THEN
+            UPDATE leave_search AS s SET document = {_POSTGRES_DOCUMENT}
+            FROM leave_requests AS r JOIN users AS u ON u.id = r.employee_id
+            WHERE r.employee_id = NEW.id AND s.leave_request_id = r.id;
+        ELSE
+            INSERT INTO leave_search (leave_request_id, document)
+            SELECT r.id, {_POSTGRES_DOCUMENT}
+            FROM leave_requests AS r JOIN users AS u ON u.id = r.employee_id WHERE r.id = NEW.id
+            ON CONFLICT (leave_request_id) DO UPDATE SET document = EXCLUDED.document;
+        END IF;
+        RETURN NULL;
+    END $$ LANGUAGE plpgsql""",
+    'DROP TRIGGER IF EXISTS leave_search_requests ON leave_requests',
+    """CREATE TRIGGER leave_search_requests
+    AFTER INSERT OR UPDATE OF reason, manager_comments, employee_id ON leave_requests
+    FOR EACH ROW EXECUTE FUNCTION leave_search_sync()""",
+    'DROP TRIGGER IF EXISTS leave_search_users ON users',
+    """CREATE TRIGGER leave_search_users AFTER UPDATE OF first_name, last_name, email ON users
+    FOR EACH ROW EXECUTE FUNCTION leave_search_sync()""",
+)
+
+_POSTGRES_FILL = f"""
+    INSERT INTO leave_search (leave_request_id, document)
+    SELECT r.id, {_POSTGRES_DOCUMENT}
+    FROM leave_requests AS r JOIN users AS u ON u.id = r.employee_id
+    ON CONFLICT (leave_request_id) DO NOTHING
+"""
+
+
+def supported(dialect_name):
+    return dialect_name in ('sqlite', 'postgresql')
+
+
+def install(connection, rebuild=False):
+    """Create the search index and the triggers that keep it current.
+
+    Safe to run repeatedly. The index is filled from every leave request when
+    it is empty, or always with ``rebuild``. Returns the rows indexed.
+    """
+    dialect = connection.dialect.name
+    if not supported(dialect):
+        return 0
+    for statement in _SQLITE_DDL if dialect == 'sqlite' else _POSTGRES_DDL:
+        connection.exec_driver_sql(statement)
+    if rebuild:
+        connection.exec_driver_sql('DELETE FROM leave_search')
+    elif connection.exec_driver_sql('SELECT 1 FROM leave_search LIMIT 1').first():
+        return 0
+    return connection.exec_driver_sql(_SQLITE_FILL if dialect == 'sqlite' else _POSTGRES_FILL).rowcount
+
+
+def terms(text):
+    return TERM.findall(text or '')[:16]
+
+
+def _match(dialect, words):
+    """(index table, its leave request id column, WHERE clause, score) for
+    requests containing every word; lower scores rank first.
+
+    Words are passed as bound values, and the last one also matches as a
+    prefix so partial names work.
+    """
+    if dialect == 'sqlite':
+        index = table('leave_search', column('rowid'))
+        query = ' '.join(f'"{word}"' for word in words) + '*'
+        return (index, index.c.rowid, literal_column('leave_search').op('MATCH')(query),
+                func.bm25(literal_column('leave_search'), *_SQLITE_WEIGHTS))
+
+    index = table('leave_search', column('leave_request_id'), column('document'))
+    tsquery = None
+    for position, word in enumerate(words):
+        word = word + ':*' if position == len(words) - 1 else word
+        # Either config: the reason is stemmed, names are not
+        either = func.to_tsquery(cast('english', REGCONFIG), word).op('||')(
+            func.to_tsquery(cast('simple', REGCONFIG), word))
+        tsquery = either if tsquery is None else tsquery.op('&&')(either)
+    return (index, index.c.leave_request_id, index.c.document.op('@@')(tsquery),
+            -func.ts_rank_cd(index.c.document, tsquery))
+
+
+def _encode_cursor(score, leave_id):
+    return f'{score!r}_{leave_id}'
+
+
+def _decode_cursor(value):
+    if not value:
+        return None
+    try:
+        score, leave_id = value.rsplit('_', 1)
+        return float(score), int(leave_id)
+    except ValueError:
+        return None
+
+
+def search(text, status=None, leave_type=None, start=None, end=None, cursor=None, page_size=25):
+    """Leave requests matching every word of ``text``, best match first.
+
+    ``start`` and ``end`` keep requests overlapping that range. Returns the
+    page of LeaveRequests (with their employee loaded) and the cursor of the
+    next page, or None when there are no more.
+    """
+    words = terms(text)
+    if not words:
+        return [], None
+    index, key, matches, score = _match(db.session.get_bind().dialect.name, words)
+    score = score.label('score')
+    query = (select(LeaveRequest.id, score).select_from(index)
+             .join(LeaveRequest, LeaveRequest.id == key).where(matches))
+    if status:
+        query = query.where(LeaveRequest.status == status)
+    if leave_type:
+        query = query.where(LeaveRequest.leave_type == leave_type)
+    if start:
+        query = query.where(LeaveRequest.end_date >= start)
+    if end:
+        query = query.where(LeaveRequest.start_date <= end)
+    position = _decode_cursor(cursor)
+    if position:
+        query = query.where(tuple_(score.element, LeaveRequest.id) > position)
+    rows = db.session.execute(query.order_by(score.element, LeaveRequest.id).limit(page_size + 1)).all()
+
+    next_cursor = _encode_cursor(rows[page_size - 1].score, rows[page_size - 1].id) if len(rows) > page_size else None
+    rows = rows[:page_size]
+    loaded = {leave_request.id: leave_request for leave_request in LeaveRequest.query.options(
+        joinedload(LeaveRequest.employee)).filter(LeaveRequest.id.in_([leave_id for leave_id, _ in rows]))}
+    return [loaded[leave_id] for leave_id, _ in rows if leave_id in loaded], next_cursor
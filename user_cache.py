@@ -0,0 +1,94 @@
+from collections import OrderedDict
+import threading
+import time
+
+from flask_login import UserMixin
+
+from app import app, db
+
+# Everything Flask-Login, the routes and the templates read off current_user
+CACHED_FIELDS = ('id', 'email', 'first_name', 'last_name', 'profile_image_url', 'role', 'region')
+
+
+class CachedUser(UserMixin):
+    """Read-only snapshot of a User row served as ``current_user``.
+
+    Writes must go through the database (then ``user_cache.invalidate``);
+    assigning attributes here is not persisted.
+    """
+
+    def __init__(self, fields):
+        for name in CACHED_FIELDS:
+            setattr(self, name, fields.get(name))
+
+    def __repr__(self):
+        return f'<CachedUser {self.id}>'
+
+
+class LocalLRU:
+    """Bounded in-process store with per-entry expiry."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class UserCache:
+    """Caches the fields of User rows needed to authenticate a request.
+
+    Entries go through app_cache under the ``users`` table scope and the
+    user's own scope, so a committed change (a role switch, say) reaches
+    every worker process on its next request.
+    """
+
+    @staticmethod
+    def _key(user_id):
+        return f'user:{user_id}'
+
+    @staticmethod
+    def _fields(user_id):
+        from models import User
+        row = db.session.query(*(getattr(User, name) for name in CACHED_FIELDS)).filter(User.id == user_id).first()
+        return dict(zip(CACHED_FIELDS, row)) if row is not None else None
+
+    def load(self, user_id):
+        import app_cache
+        fields = app_cache.app_cache.get_or_load(
+            self._key(user_id), [app_cache.table_scope('users'), app_cache.user_scope(user_id)],
+            lambda: self._fields(user_id), ttl=app.config.get('USER_CACHE_TTL', 60))
+        return CachedUser(fields) if fields is not None else None
+
+    def invalidate(self, user_id):
+        import app_cache
+        app_cache.app_cache.invalidate([app_cache.user_scope(user_id)])
+
+
+user_cache = UserCache()
@@ -0,0 +1,78 @@
+from array import array
+from datetime import date, timedelta
+
+from app import app, db
+from models import Holiday
+from user_cache import LocalLRU
+
+# Weekday numbers (Monday is 0) that are not worked, per region
+WEEKENDS = {
+    'default': (5, 6),
+    'SA': (4, 5),
+    'IL': (4, 5),
+    'NP': (5,),
+}
+
+_years = LocalLRU(app.config.get('WORKDAY_CACHE_SIZE', 256))
+
+
+def default_region():
+    return app.config.get('WORKDAY_REGION', 'default')
+
+
+def region_of(user):
+    """The region whose calendar applies to ``user`` (a User, CachedUser or None)."""
+    return getattr(user, 'region', None) or default_region()
+
+
+def weekend(region):
+    configured = app.config.get('WORKDAY_WEEKENDS', {})
+    return configured.get(region) or WEEKENDS.get(region) or WEEKENDS['default']
+
+
+def _build_year(region, year):
+    """Prefix sums: entry ``n`` is the number of working days among the first ``n`` days of ``year``."""
+    holidays = {day for (day,) in db.session.query(Holiday.day).filter(
+        Holiday.region == region, Holiday.day >= date(year, 1, 1), Holiday.day <= date(year, 12, 31))}
+    weekend_days = set(weekend(region))
+    prefix = array('H', [0])
+    day = date(year, 1, 1)
+    while day.year == year:
+        prefix.append(prefix[-1] + (day.weekday() not in weekend_days and day not in holidays))
+        day += timedelta(days=1)
+    return prefix
+
+
+def _year(region, year):
+    key = (region, year)
+    prefix = _years.get(key)
+    if prefix is None:
+        prefix = _build_year(region, year)
+        # Holiday edits reach running workers within the TTL
+        _years.set(key, prefix, app.config.get('WORKDAY_CACHE_TTL', 300))
+    return prefix
+
+
+def duration(start, end, region=None):
+    """Working days in the inclusive range ``start``..``end``."""
+    if end < start:
+        return 0
+    region = region or default_region()
+    first = _year(region, start.year)
+    if start.year == end.year:
+        return first[end.timetuple().tm_yday] - first[start.timetuple().tm_yday - 1]
+    total = first[-1] - first[start.timetuple().tm_yday - 1]
+    for year in range(start.year + 1, end.year):
+        total += _year(region, year)[-1]
+    return total + _year(region, end.year)[end.timetuple().tm_yday]
+
+
+def is_working_day(day, region=None):
+    prefix = _year(region or default_region(), day.year)
+    index = day.timetuple().tm_yday
+    return prefix[index] > prefix[index - 1]
+
+
+def forget():
+    """Drop the cached calendars of this process, e.g. after editing holidays."""
+    _years.clear()
@@ -0,0 +1,29 @@
+# wsgi.py
+#
+# Production entry point. Serve with the settings in gunicorn.conf.py:
+#
+#   gunicorn            (reads gunicorn.conf.py, which points at wsgi:app)
+
+import os
+
+from app import app, db
+import log_config
+
+# Each worker gets its own hashing pool; split the cores between them
+_workers = int(os.environ.get('WEB_CONCURRENCY') or os.cpu_count() or 1)
+app.config.setdefault('PASSWORD_HASH_WORKERS', max(1, (os.cpu_count() or 1) // _workers))
+
+import routes  # noqa: E402,F401
+import commands  # noqa: E402,F401
+import metrics  # noqa: E402,F401
+
+
+def after_fork():
+    """Reset per-process state a preloaded app inherited from the master."""
+    log_config.after_fork()
+    metrics.after_fork()
+    with app.app_context():
+        # Pooled connections opened in the master must not be shared; leave
+        # them open for the master and start this worker's pools empty
+        for engine in db.engines.values():
+            engine.dispose(close=False)